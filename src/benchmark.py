@@ -23,6 +23,7 @@
 #
 #   Check performance of pyarmor.
 #
+import json
 import logging
 import os
 import shutil
@@ -30,9 +31,7 @@ import sys
 import subprocess
 import time
 
-from ctypes import c_int, c_void_p, py_object, pythonapi, PYFUNCTYPE
-
-import pytransform
+from timeit import default_timer
 
 OBF_MODULE_MODE = 'none', 'des', 'aes'
 OBF_CODE_MODE = 'none', 'fast', 'aes', 'wrap'
@@ -40,6 +39,30 @@ OBF_CODE_MODE = 'none', 'fast', 'aes', 'wrap'
 PYARMOR_PATH = os.path.dirname(__file__)
 PYARMOR = 'pyarmor.py'
 
+# Each scenario is (title, action, args), "%s" in the title is replaced
+# with "no_obfuscated" or "obfuscated"
+SCENARIOS = (
+    ('import_first_%s_module', 'cold_import'),
+    ('re_import_%s_module', 're_import'),
+    ('import_many_%s_modules', 'import_copy'),
+    ('run_empty_%s_code_object', 'empty'),
+    ('run_%s_1k_bytecode', 'one_thousand'),
+    ('run_%s_10k_bytecode', 'ten_thousand'),
+    ('call_1000_%s_1k_bytecode', 'call_1k_function', 1000),
+    ('call_1000_%s_10k_bytecode', 'call_10k_function', 1000),
+    ('call_10000_%s_1k_bytecode', 'call_1k_function', 10000),
+    ('call_10000_%s_10k_bytecode', 'call_10k_function', 10000),
+)
+
+KINDS = 'no_obfuscated', 'obfuscated'
+
+# The test modules of pybench, the others are the framework of pybench
+PYBENCH_TESTS = ('Arithmetic', 'Calls', 'Constructs', 'Dict', 'Exceptions',
+                 'Imports', 'Instances', 'Lists', 'Lookups', 'NewInstances',
+                 'Numbers', 'Strings', 'Tuples', 'With')
+
+process_time = getattr(time, 'process_time', None) or time.clock
+
 
 def make_test_script(filename):
     lines = [
@@ -75,23 +98,23 @@ def call_pyarmor(args):
     p.wait()
 
 
-def obffuscate_scripts(output, filename,
-                       mod_mode, code_mode, wrap_mode, adv_mode):
+def obffuscate_scripts(output, filenames, mod_mode, code_mode, wrap_mode,
+                       adv_mode, restrict_mode='0', manifest=None):
     project = os.path.join(output, 'project')
     if os.path.exists(project):
         shutil.rmtree(project)
 
     args = [sys.executable, PYARMOR, 'init', '--src', output,
-            '--entry', filename, project]
+            '--entry', ','.join(filenames), project]
     call_pyarmor(args)
 
     args = [sys.executable, PYARMOR, 'config',
-            '--manifest', 'include %s' % filename,
+            '--manifest', manifest or 'include %s' % ' '.join(filenames),
             '--obf-mod', mod_mode,
             '--obf-code', code_mode,
             '--wrap-mode', wrap_mode,
             '--advanced', adv_mode,
-            '--restrict-mode', '0',
+            '--restrict-mode', restrict_mode,
             '--package-runtime', '0',
             project]
     call_pyarmor(args)
@@ -100,283 +123,342 @@ def obffuscate_scripts(output, filename,
     call_pyarmor(args)
 
     for s in os.listdir(os.path.join(project, 'dist')):
-        shutil.copy(os.path.join(project, 'dist', s), output)
-
-
-def metricmethod(func):
-    if not hasattr(time, 'process_time'):
-        time.process_time = time.clock
-
-    def wrap(*args, **kwargs):
-        t1 = time.process_time()
-        result = func(*args, **kwargs)
-        t2 = time.process_time()
-        logging.info('%-50s: %10.6f ms', func.__name__, (t2 - t1) * 1000)
-        return result
-    return wrap
-
-
-@metricmethod
-def verify_license(m):
-    try:
-        prototype = PYFUNCTYPE(py_object)
-        dlfunc = prototype(('get_registration_code', m))
-        code = dlfunc()
-    except Exception:
-        logging.warning('Verify license failed')
-        code = ''
-    return code
-
-
-@metricmethod
-def init_pytransform(m):
-    major, minor = sys.version_info[0:2]
-    # Python2.5 no sys.maxsize but sys.maxint
-    # bitness = 64 if sys.maxsize > 2**32 else 32
-    prototype = PYFUNCTYPE(c_int, c_int, c_int, c_void_p)
-    init_module = prototype(('init_module', m))
-    init_module(major, minor, pythonapi._handle)
-
-    prototype = PYFUNCTYPE(c_int, c_int, c_int, c_int)
-    init_runtime = prototype(('init_runtime', m))
-    init_runtime(0, 0, 0, 0)
-
-
-@metricmethod
-def load_pytransform():
-    return pytransform._load_library(PYARMOR_PATH, is_runtime=1)
-
-
-@metricmethod
-def total_extra_init_time():
-    m = load_pytransform()
-    init_pytransform(m)
-    verify_license(m)
-
-
-@metricmethod
-def import_first_no_obfuscated_module(name):
-    return __import__(name)
-
-
-@metricmethod
-def import_first_obfuscated_module(name):
-    return __import__(name)
-
-
-@metricmethod
-def re_import_no_obfuscated_module(name):
-    return __import__(name)
-
-
-@metricmethod
-def re_import_obfuscated_module(name):
-    return __import__(name)
-
-
-@metricmethod
-def run_empty_obfuscated_code_object(foo):
-    return foo.empty()
-
-
-@metricmethod
-def run_obfuscated_1k_bytecode(foo):
-    return foo.one_thousand()
-
-
-@metricmethod
-def run_obfuscated_10k_bytecode(foo):
-    return foo.ten_thousand()
-
-
-@metricmethod
-def run_empty_no_obfuscated_code_object(foo):
-    return foo.empty()
-
-
-@metricmethod
-def run_no_obfuscated_1k_bytecode(foo):
-    return foo.one_thousand()
-
-
-@metricmethod
-def run_no_obfuscated_10k_bytecode(foo):
-    return foo.ten_thousand()
-
-
-@metricmethod
-def import_many_obfuscated_modules(name, n=100):
-    for i in range(n):
-        __import__(name % i)
-
-
-@metricmethod
-def import_many_no_obfuscated_modules(name, n=100):
+        src = os.path.join(project, 'dist', s)
+        if os.path.isdir(src):
+            dst = os.path.join(output, s)
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            shutil.copytree(src, dst)
+        else:
+            shutil.copy(src, output)
+
+
+def summary(samples):
+    '''Return the statistics of samples in milliseconds.'''
+    data = sorted([x * 1000 for x in samples])
+    n = len(data)
+    mean = sum(data) / n
+    median = data[n // 2] if n % 2 else (data[n // 2 - 1] + data[n // 2]) / 2
+    stdev = (sum([(x - mean) ** 2 for x in data]) / (n - 1)) ** 0.5 \
+        if n > 1 else 0.0
+    return dict(n=n, median=median, mean=mean, stdev=stdev,
+                min=data[0], max=data[-1])
+
+
+def measure(func, args=(), repeat=5, warmup=1):
+    '''Call func `warmup` times, then call it `repeat` times to get the
+    wall time and cpu time of each call.'''
+    for i in range(warmup):
+        func(*args)
+    walls, cpus = [], []
+    for i in range(repeat):
+        t1, c1 = default_timer(), process_time()
+        func(*args)
+        c2, t2 = process_time(), default_timer()
+        walls.append(t2 - t1)
+        cpus.append(c2 - c1)
+    return dict(wall=summary(walls), cpu=summary(cpus))
+
+
+def measure_cold_import(name, repeat=5, warmup=1):
+    '''Import module in a new process each time, so the time to load and
+    initialize the runtime library is included.'''
+    lines = [
+        'import time',
+        'from timeit import default_timer',
+        'clock = getattr(time, "process_time", None) or time.clock',
+        't, c = default_timer(), clock()',
+        'import %s' % name,
+        'print(repr((default_timer() - t, clock() - c)))',
+    ]
+    walls, cpus = [], []
+    for i in range(warmup + repeat):
+        output = subprocess.check_output([sys.executable, '-c',
+                                          '\n'.join(lines)])
+        t, c = eval(output.decode().strip().splitlines()[-1])
+        if i >= warmup:
+            walls.append(t)
+            cpus.append(c)
+    return dict(wall=summary(walls), cpu=summary(cpus))
+
+
+def measure_script(script, repeat=5, warmup=1):
+    '''Run script in a new process each time, the cpu time is got from the
+    children times, it's always 0 in Windows.'''
+    walls, cpus = [], []
+    with open(os.devnull, 'w') as null:
+        for i in range(warmup + repeat):
+            c1 = sum(os.times()[2:4])
+            t1 = default_timer()
+            subprocess.check_call([sys.executable, script], stdout=null)
+            t2 = default_timer()
+            c2 = sum(os.times()[2:4])
+            if i >= warmup:
+                walls.append(t2 - t1)
+                cpus.append(c2 - c1)
+    return dict(wall=summary(walls), cpu=summary(cpus))
+
+
+def make_module_copies(name, n):
+    with open(name + '.py') as f:
+        lines = f.readlines()
+    if lines and lines[0].find('pyarmor_runtime') > 0:
+        lines = lines[2:]
     for i in range(n):
-        __import__(name % i)
-
-
-@metricmethod
-def call_1000_no_obfuscated_1k_bytecode(foo):
-    return foo.call_1k_function(1000)
-
-
-@metricmethod
-def call_1000_obfuscated_1k_bytecode(foo):
-    return foo.call_1k_function(1000)
-
-
-@metricmethod
-def call_1000_no_obfuscated_10k_bytecode(foo):
-    return foo.call_10k_function(1000)
-
-
-@metricmethod
-def call_1000_obfuscated_10k_bytecode(foo):
-    return foo.call_10k_function(1000)
+        with open('%s_%s.py' % (name, i), 'w') as f:
+            f.write(''.join(lines))
+
+
+def import_copy(name, counter):
+    __import__('%s_%s' % (name, counter[0]))
+    counter[0] += 1
+
+
+def run_scenario(scenario, name, repeat=5, warmup=1):
+    action = scenario[1]
+    if action == 'cold_import':
+        return measure_cold_import(name, repeat, warmup)
+    m = __import__(name)
+    if action == 're_import':
+        return measure(__import__, (name,), repeat, warmup)
+    if action == 'import_copy':
+        make_module_copies(name, warmup + repeat)
+        return measure(import_copy, (name, [0]), repeat, warmup)
+    return measure(getattr(m, action), scenario[2:], repeat, warmup)
+
+
+def log_result(title, result):
+    wall, cpu = result['wall'], result['cpu']
+    logging.info('%-50s: %10.6f ms (stdev %.6f, cpu %.6f)',
+                 title, wall['median'], wall['stdev'], cpu['median'])
+
+
+def run_suite(names, workloads=None, repeat=5, warmup=1):
+    '''Run all the scenarios, return a dict like this
+
+        {
+            "import_first_module": {
+                "no_obfuscated": {"wall": {...}, "cpu": {...}},
+                "obfuscated": {"wall": {...}, "cpu": {...}}
+            },
+            ...
+        }
+    '''
+    results = {}
+    for scenario in SCENARIOS:
+        title = scenario[0].replace('_%s', '')
+        results[title] = {}
+        for kind, name in zip(KINDS, names):
+            result = run_scenario(scenario, name, repeat, warmup)
+            log_result(scenario[0] % kind, result)
+            results[title][kind] = result
+        logging.info('')
 
+    for script in workloads or []:
+        title = 'run_script_%s' % script
+        results[title] = {}
+        for kind, name in zip(KINDS, (script, 'ob_' + script)):
+            result = measure_script(name, repeat, warmup)
+            log_result('run_%s_script_%s' % (kind, script), result)
+            results[title][kind] = result
+        logging.info('')
 
-@metricmethod
-def call_10000_no_obfuscated_1k_bytecode(foo):
-    return foo.call_1k_function(10000)
+    return results
 
 
-@metricmethod
-def call_10000_obfuscated_1k_bytecode(foo):
-    return foo.call_1k_function(10000)
+def run_pybench(path, filename, rounds, compare=None, output=None):
+    '''Run pybench suite in the `path` and save the result to `filename`.
 
+    If `compare` is set, print the comparison with it, and save the
+    results of each test to json file `output`.'''
+    import gc
+    import pickle
+    sys.path.insert(0, os.path.abspath(path))
+    import pybench
+    import Setup
 
-@metricmethod
-def call_10000_no_obfuscated_10k_bytecode(foo):
-    return foo.call_10k_function(10000)
+    gc.disable()
+    bench = pybench.Benchmark(filename, warp=Setup.Warp_factor,
+                              calibration_runs=pybench.CALIBRATION_RUNS)
+    bench.rounds = rounds
+    bench.load_tests(Setup)
+    bench.calibrate()
+    bench.run()
+    with open(filename, 'wb') as f:
+        pickle.dump(bench, f)
 
+    if compare is None:
+        return
+    with open(compare, 'rb') as f:
+        other = pickle.load(f)
+    bench.print_comparison(other)
+
+    results = {}
+    for name, test in sorted(bench.tests.items()):
+        if name not in other.tests:
+            continue
+        t1, t0 = test.stat(), other.tests[name].stat()
+        results[name] = dict(
+            no_obfuscated=dict(min=t0[0] * 1000, avg=t0[1] * 1000),
+            obfuscated=dict(min=t1[0] * 1000, avg=t1[1] * 1000),
+            overhead=(t1[1] / t0[1] - 1) * 100 if t0[1] else None)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def bootstrap_pybench(output, modes):
+    src = os.path.join(PYARMOR_PATH, 'examples', 'pybench')
+    if not os.path.exists(os.path.join(src, 'pybench.py')):
+        logging.warning('No pybench found in %s', src)
+        return False
+
+    if os.path.exists(output) and output.endswith('.benchtest'):
+        logging.info('Clean output path: %s', output)
+        shutil.rmtree(output)
+
+    logging.info('Copy pybench to %s', output)
+    ignore = shutil.ignore_patterns('__pycache__', '*.pyc', '*.pybench')
+    for x in ('pybench', 'obpybench'):
+        shutil.copytree(src, os.path.join(output, x), ignore=ignore)
+
+    logging.info('Obffuscate pybench test modules ...')
+    path = os.path.join(output, 'obpybench')
+    manifest = 'include Setup.py %s, recursive-include package *.py' % \
+        ' '.join([x + '.py' for x in PYBENCH_TESTS])
+    obffuscate_scripts(path, ['Setup.py'], *modes, manifest=manifest)
+    with open(os.path.join(path, 'Setup.py')) as f:
+        if f.read().find('pyarmor') == -1:
+            logging.info('Something is wrong to obsfucate pybench')
+            return False
+
+    logging.info('Copy benchmark.py to %s', output)
+    shutil.copy('benchmark.py', output)
+    return True
+
+
+def bootstrap(output, name, obname, modes, workloads=None):
+    filename = os.path.join(output, name + '.py')
+    obfilename = os.path.join(output, obname + '.py')
 
-@metricmethod
-def call_10000_obfuscated_10k_bytecode(foo):
-    return foo.call_10k_function(10000)
+    if os.path.exists(output) and output.endswith('.benchtest'):
+        logging.info('Clean output path: %s', output)
+        shutil.rmtree(output)
+    logging.info('Create output path: %s', output)
+    os.makedirs(output)
+
+    logging.info('Generate test script %s ...', filename)
+    make_test_script(filename)
+    shutil.copy(filename, obfilename)
+
+    filenames = [os.path.basename(obfilename)]
+    for script in workloads or []:
+        x = os.path.basename(script)
+        logging.info('Copy workload script %s ...', script)
+        shutil.copy(script, os.path.join(output, x))
+        shutil.copy(script, os.path.join(output, 'ob_' + x))
+        filenames.append('ob_' + x)
+
+    logging.info('Obffuscate test scripts ...')
+    obffuscate_scripts(output, filenames, *modes)
+    if not os.path.exists(obfilename):
+        logging.info('Something is wrong to obsfucate the script')
+        return False
+    logging.info('Generate obffuscated script %s', obfilename)
+
+    logging.info('Copy benchmark.py to %s', output)
+    shutil.copy('benchmark.py', output)
 
+    logging.info('')
+    logging.info('Now change to "%s"', output)
+    logging.info('Run "%s benchmark.py".', sys.executable)
+    return True
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('action', nargs='?', default='run',
+                        choices=('bootstrap', 'run', 'pybench'))
+    parser.add_argument('modes', nargs='*', metavar='MODE',
+                        help='obf_mod, obf_code, wrap_mode, advanced and '
+                        'restrict mode used by bootstrap')
+    parser.add_argument('--workload', action='append', metavar='SCRIPT',
+                        help='Run this script as one scenario')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('-O', '--output', metavar='FILE',
+                        help='Save the results to this json file')
+    parser.add_argument('--pybench', action='store_true',
+                        help='Run pybench suite instead of test script')
+    parser.add_argument('--path', help='The path of pybench suite')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Save pybench result to this file')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare pybench result with this file')
+    args = parser.parse_args(argv)
+
+    if args.action == 'pybench':
+        run_pybench(args.path, args.save, args.repeat, args.compare,
+                    args.output)
+        return 0
 
-def main():
     if not os.path.exists('benchmark.py'):
         logging.warning('Please change current path to %s', PYARMOR_PATH)
-        return
+        return 1
 
     output = '.benchtest'
     name = 'bfoo'
-    filename = os.path.join(output, name + '.py')
-
     obname = 'obfoo'
-    obfilename = os.path.join(output, obname + '.py')
-
-    if len(sys.argv) > 1 and 'bootstrap'.startswith(sys.argv[1]):
-        if len(sys.argv) < 6:
-            sys.argv.extend(['1', '1', '1', '0'])
-        obf_mod, obf_code, wrap_mode, adv_mode = sys.argv[2:6]
-
-        if os.path.exists(output) and output.endswith('.benchtest'):
-            logging.info('Clean output path: %s', output)
-            shutil.rmtree(output)
-        logging.info('Create output path: %s', output)
-        os.makedirs(output)
-
-        logging.info('Generate test script %s ...', filename)
-        make_test_script(filename)
-
-        logging.info('Obffuscate test script ...')
-        shutil.copy(filename, obfilename)
-        obffuscate_scripts(output, os.path.basename(obfilename),
-                           obf_mod, obf_code, wrap_mode, adv_mode)
-        if not os.path.exists(obfilename):
-            logging.info('Something is wrong to obsfucate the script')
-            return
-        logging.info('Generate obffuscated script %s', obfilename)
-
-        logging.info('Copy benchmark.py to %s', output)
-        shutil.copy('benchmark.py', output)
-
-        logging.info('')
-        logging.info('Now change to "%s"', output)
-        logging.info('Run "%s benchmark.py".', sys.executable)
-        return
-
-    filename = os.path.basename(filename)
-    if os.path.exists(filename):
-        logging.info('Test script: %s', filename)
-    else:
-        logging.warning('Test script: %s not found', filename)
-        logging.info('Run "%s benchmark.py bootstrap" first.', sys.executable)
-        return
-
-    obfilename = os.path.basename(obfilename)
-    if os.path.exists(obfilename):
-        logging.info('Obfuscated script: %s', obfilename)
-    else:
-        logging.warning('Obfuscated script: %s not found', obfilename)
-        logging.info('Run "%s benchmark.py bootstrap" first.', sys.executable)
-        return
 
+    if args.action == 'bootstrap':
+        modes = args.modes + ['1', '1', '1', '0', '0'][len(args.modes):]
+        if args.pybench:
+            return 0 if bootstrap_pybench(output, modes[:5]) else 1
+        return 0 if bootstrap(output, name, obname, modes[:5],
+                              args.workload) else 1
+
+    if args.pybench:
+        cmd = [sys.executable, 'benchmark.py', 'pybench',
+               '--repeat', str(args.repeat)]
+        logging.info('Run pybench suite with plain test modules ...')
+        subprocess.check_call(cmd + ['--path', 'pybench',
+                                     '--save', 'plain.pybench'])
+        logging.info('Run pybench suite with obfuscated test modules ...')
+        if args.output:
+            cmd.extend(['-O', args.output])
+        subprocess.check_call(cmd + ['--path', 'obpybench',
+                                     '--save', 'obfuscated.pybench',
+                                     '--compare', 'plain.pybench'])
+        return 0
+
+    for x in (name, obname):
+        if not os.path.exists(x + '.py'):
+            logging.warning('Test script: %s.py not found', x)
+            logging.info('Run "%s benchmark.py bootstrap" first.',
+                         sys.executable)
+            return 1
+    logging.info('Test script: %s.py', name)
+    logging.info('Obfuscated script: %s.py', obname)
+    logging.info('Each scenario runs %d times after %d warmup runs',
+                 args.repeat, args.warmup)
     logging.info('--------------------------------------')
-
-    # It doens't work for super mode
-    # logging.info('')
-    # total_extra_init_time()
-
-    logging.info('')
-    foo = import_first_no_obfuscated_module(name)
-    obfoo = import_first_obfuscated_module(obname)
-
-    logging.info('')
-    foo = re_import_no_obfuscated_module(name)
-    obfoo = re_import_obfuscated_module(obname)
-
-    logging.info('')
-    n = 10
-    logging.info('--- Import %d modules ---', n)
-    for i in range(n):
-        shutil.copy(filename, filename.replace('.py', '_%s.py' % i))
-        with open(obfilename) as f:
-            lines = f.readlines()
-        with open(obfilename.replace('.py', '_%s.py' % i), 'w') as f:
-            f.write(lines[2] if lines[0].find('pyarmor_runtime') > 0 \
-                    else ''.join(lines))
-    import_many_no_obfuscated_modules('bfoo_%s', n)
-    import_many_obfuscated_modules('obfoo_%s', n)
-
-    logging.info('')
-    run_empty_no_obfuscated_code_object(foo)
-    run_empty_obfuscated_code_object(obfoo)
-
-    logging.info('')
-    run_no_obfuscated_1k_bytecode(foo)
-    run_obfuscated_1k_bytecode(obfoo)
-
-    logging.info('')
-    run_no_obfuscated_10k_bytecode(foo)
-    run_obfuscated_10k_bytecode(obfoo)
-
-    logging.info('')
-    call_1000_no_obfuscated_1k_bytecode(foo)
-    call_1000_obfuscated_1k_bytecode(obfoo)
-
-    logging.info('')
-    call_1000_no_obfuscated_10k_bytecode(foo)
-    call_1000_obfuscated_10k_bytecode(obfoo)
-
     logging.info('')
-    call_10000_no_obfuscated_1k_bytecode(foo)
-    call_10000_obfuscated_1k_bytecode(obfoo)
 
-    logging.info('')
-    call_10000_no_obfuscated_10k_bytecode(foo)
-    call_10000_obfuscated_10k_bytecode(obfoo)
+    workloads = [os.path.basename(x) for x in args.workload or []]
+    results = run_suite((name, obname), workloads, args.repeat, args.warmup)
 
-    logging.info('')
     logging.info('--------------------------------------')
 
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
 
 if __name__ == '__main__':
     logging.basicConfig(
         level=logging.INFO,
         format='%(message)s',
     )
-    main()
+    sys.exit(main(sys.argv[1:]))
@@ -27,10 +27,12 @@ Again, this is not a formal definition! Just a "taste" of the module.
 import os
 import shutil
 import sys
+import tempfile
+
+from zipfile import ZipInfo
 
 from wheel.wheelfile import WheelFile
-from wheel.cli.pack import pack as wheel_pack
-from pyarmor.pyarmor import main as pyarmor_main
+from pyarmor.pyarmor import obfuscate_many
 
 from setuptools.build_meta import build_wheel as setuptools_build_wheel, \
     get_requires_for_build_wheel, \
@@ -39,33 +41,49 @@ from setuptools.build_meta import build_wheel as setuptools_build_wheel, \
     build_sdist
 
 
-def _wheel_unpack(path, dest='.'):
+def _copy_zipinfo(info):
+    zinfo = ZipInfo(info.filename, info.date_time)
+    zinfo.external_attr = info.external_attr
+    zinfo.compress_type = info.compress_type
+    return zinfo
+
+
+def _wheel_rewrite(path, output, obf_options):
+    '''Read the wheel `path` entry by entry, obfuscate the scripts of the
+    package in memory, append the runtime files, and write the new wheel
+    to `output` in one pass. RECORD is made by WheelFile with hashes.'''
     with WheelFile(path) as wf:
         namever = wf.parsed_filename.group('namever')
-        destination = os.path.join(dest, namever)
-        sys.stdout.flush()
-        wf.extractall(destination)
-    return namever
-
-
-def _wheel_append_runtime_files(build_path, namever, pkgname):
-    namelist = []
-    for name in os.listdir(os.path.join(build_path, pkgname)):
-        if name.startswith('pytransform'):
-            path = os.path.join(build_path, pkgname, name)
-            n = len(path) + 1
-            if os.path.isdir(path):
-                for root, dirs, files in os.walk(path):
-                    prefix = root[n:].replace('\\', '/')
-                    for x in files:
-                        namelist.append(prefix + '/' + x)
+        pkgname = namever.split('-')[0]
+        prefix = pkgname + '/'
+        distinfo = namever + '.dist-info/'
+
+        members, others, metadata = {}, [], []
+        for info in wf.infolist():
+            name = info.filename
+            if name.startswith(prefix):
+                members[name[len(prefix):]] = info
+            elif name.startswith(distinfo):
+                if name != distinfo + 'RECORD':
+                    metadata.append(info)
             else:
-                namelist.append(name)
+                others.append(info)
+
+        def iter_members():
+            for name, info in members.items():
+                yield name, wf.read(info)
+
+        with WheelFile(output, 'w') as out:
+            for info in others:
+                out.writestr(_copy_zipinfo(info), wf.read(info))
+
+            for name, data in obfuscate_many(iter_members(), **obf_options):
+                info = members.get(name)
+                out.writestr(prefix + name if info is None
+                             else _copy_zipinfo(info), data)
 
-    wheel_record = os.path.join(build_path, namever + '.dist-info', 'RECORD')
-    with open(wheel_record, 'a') as f:
-        for name in namelist:
-            f.write(pkgname + '/' + name + ',,\n')
+            for info in metadata:
+                out.writestr(_copy_zipinfo(info), wf.read(info))
 
 
 def _fix_config(config_settings, obf_options):
@@ -76,7 +94,7 @@ def _fix_config(config_settings, obf_options):
         if k in ('pyarmor.advanced', ':env:.pyarmor-advanced'):
             if v not in ('2', '3', '4', '5'):
                 raise ConfigurationError('Invalid pyarmor.advanced')
-            obf_options.extend(['--advanced', v])
+            obf_options['advanced'] = int(v)
             break
 
     config_settings = config_settings or {}
@@ -95,8 +113,8 @@ def _fix_config(config_settings, obf_options):
 
 def build_wheel(wheel_directory, config_settings=None,
                 metadata_directory=None):
-    obf_options = ['obfuscate', '--enable-suffix', '--in-place',
-                   '-r', '--bootstrap', '3']
+    obf_options = dict(enable_suffix=True, bootstrap_code=3,
+                       entries=['__init__.py'], runtime=True, jobs=0)
     config_settings = _fix_config(config_settings, obf_options)
 
     # Build wheel by setuptools
@@ -106,21 +124,15 @@ def build_wheel(wheel_directory, config_settings=None,
         metadata_directory=metadata_directory
     )
 
-    # Unpack wheel and replace the original .py with obfuscated ones
+    # Replace the original .py with obfuscated ones and append runtime
+    # files to wheel
     result_wheel = os.path.join(wheel_directory, result_basename)
-    namever = _wheel_unpack(result_wheel, wheel_directory)
-
-    pkgname = namever.split('-')[0]
-    build_path = os.path.join(wheel_directory, namever)
-
-    obf_options.append(os.path.join(build_path, pkgname, '__init__.py'))
-    pyarmor_main(obf_options)
-
-    # Append runtime files of obfuscated scripts to wheel
-    _wheel_append_runtime_files(build_path, namever, pkgname)
-
-    # Pack the patched wheel again
-    wheel_pack(build_path, wheel_directory, None)
-
-    shutil.rmtree(build_path)
+    build_path = tempfile.mkdtemp(dir=wheel_directory)
+    try:
+        output = os.path.join(build_path, result_basename)
+        _wheel_rewrite(result_wheel, output, obf_options)
+        os.remove(result_wheel)
+        shutil.move(output, result_wheel)
+    finally:
+        shutil.rmtree(build_path)
     return result_basename
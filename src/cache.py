@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import os
+import sys
+import time
+
+from tempfile import mkstemp
+
+from config import version, core_version
+
+
+def make_key(*args):
+    '''Return the hash of all the arguments, pyarmor version and Python
+    version are always included.'''
+    h = hashlib.sha256()
+    for x in (version, core_version, sys.version_info[:2]) + args:
+        x = x if isinstance(x, bytes) else repr(x).encode('utf-8')
+        h.update(('%d:' % len(x)).encode())
+        h.update(x)
+    return h.hexdigest()
+
+
+class ObfuscatedCache(object):
+    '''Content addressed cache of obfuscated scripts.
+
+    Each item is saved as one file named by the hash of all the inputs of
+    one obfuscation. The modified time of the item is updated on each hit,
+    so the least recently used items are removed first when pruning. The
+    total size of the items is recorded in the file "usage", so it needn't
+    list all the items to check whether the cache is full.
+
+    The cache path could be shared by many machines, an item is written to
+    a temporary file and then renamed, the readers never get a partial one.
+    '''
+
+    def __init__(self, path, maxsize=0):
+        self.path = path
+        self.maxsize = maxsize
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def _write(self, filename, data):
+        path = os.path.dirname(filename)
+        tmpname = None
+        try:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            fd, tmpname = mkstemp(suffix='.tmp', dir=path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmpname, filename)
+        except (IOError, OSError) as e:
+            logging.debug('Write cache file %s failed: %s', filename, e)
+            if tmpname and os.path.exists(tmpname):
+                os.remove(tmpname)
+            return False
+        return True
+
+    def put(self, key, data):
+        if self._write(self._filename(key), data):
+            self._add_usage(len(data))
+
+    def _usage_file(self):
+        return os.path.join(self.path, 'usage')
+
+    def _add_usage(self, size):
+        '''Append the size of new item to the usage file. The writers
+        may lose some records if they're running at the same time, it's
+        only used to decide when to prune the cache.'''
+        try:
+            with open(self._usage_file(), 'a') as f:
+                f.write('%d\n' % size)
+        except (IOError, OSError) as e:
+            logging.debug('Update cache usage failed: %s', e)
+
+    def _set_usage(self, size):
+        if os.path.exists(self.path):
+            self._write(self._usage_file(), ('%d\n' % size).encode())
+
+    def usage(self):
+        '''Return the estimated total size of the items by the usage file,
+        or None if it's unknown.'''
+        try:
+            with open(self._usage_file(), 'r') as f:
+                sizes = [int(x) for x in f.read().split()]
+        except (IOError, OSError, ValueError):
+            return None
+        if len(sizes) > 1000:
+            self._set_usage(sum(sizes))
+        return sum(sizes)
+
+    def items(self):
+        '''Return list of (filename, size, mtime) of all the items.'''
+        result = []
+        if not os.path.exists(self.path):
+            return result
+        for sub in os.listdir(self.path):
+            path = os.path.join(self.path, sub)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                filename = os.path.join(path, name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                result.append((filename, st.st_size, st.st_mtime))
+        return result
+
+    def stats(self):
+        '''Return the number and total size of the items.'''
+        items = self.items()
+        return len(items), sum([x[1] for x in items])
+
+    def prune(self, maxsize=None):
+        '''Remove the least recently used items until the total size is
+        not greater than `maxsize`. Return the number and size of removed
+        items.'''
+        if maxsize is None:
+            maxsize = self.maxsize
+        items = self.items()
+        total = sum([x[1] for x in items])
+        expired = time.time() - 3600
+        n, size = 0, 0
+        for filename, fsize, mtime in sorted(items, key=lambda x: x[2]):
+            if total <= maxsize and not (filename.endswith('.tmp')
+                                         and mtime < expired):
+                continue
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= fsize
+            n, size = n + 1, size + fsize
+        self._set_usage(total)
+        return n, size
+
+    def autoprune(self):
+        '''Same as prune, but do nothing if the estimated size is not
+        greater than the limit, so the items needn't be listed after each
+        build. It's slow to list a large cache in NFS path.'''
+        usage = self.usage()
+        if usage is not None and usage <= self.maxsize:
+            return 0, 0
+        return self.prune()
@@ -33,7 +33,11 @@ entry_lines = 'from %spytransform%s import pyarmor_runtime\n', \
               'pyarmor_runtime(%s)\n'
 protect_code_template = 'protect_code%s.pt'
 
+# The payload of obfuscated script in compact format
+compact_payload = "__import__('binascii').a2b_base64('%s')"
+
 config_filename = '.pyarmor_config'
+build_manifest_filename = '.pyarmor_manifest'
 capsule_filename = '.pyarmor_capsule.zip'
 license_filename = 'license.lic'
 default_output_path = 'dist'
@@ -23,6 +23,27 @@ After that, use the data file in other obfuscated scripts. For example,
     with data.Safestr() as text:
         ...
 
+For big data file, build the data module by chunks, for example,
+
+    python build_data_module.py --chunk 65536 -O dist model.bin
+
+The data is only decoded when it's read, and only the requested part is
+decoded. The data module also provides these functions
+
+    # Return the decoded bytes as bytearray
+    buf = data.read(offset, n)
+    ...
+    data.clean_str(buf)
+
+    # Wipe the decoded bytes as exiting the context
+    with data.Safebytes(offset, n) as buf:
+        ...
+
+    # Decode the data chunk by chunk, each chunk is wiped once the next
+    # one is got
+    for buf in data.iterchunks():
+        ...
+
 This script encodes the string data by a simple way (xor), DO NOT
 generate data module by this script directly. It's recommend to write
 your own script to generate data module base on it or not.
@@ -34,7 +55,7 @@ import random
 import sys
 
 from os import makedirs
-from os.path import basename, exists, join as join_path, splitext
+from os.path import basename, exists, getsize, join as join_path, splitext
 
 #
 # The template of data module
@@ -63,6 +84,93 @@ class Safestr(object):
 
 '''
 
+#
+# The template of chunked data module
+#
+# Each chunk is decoded by bytearray.translate for each key, all of the
+# decoded bytes are in the bytearray, so they could be wiped
+#
+chunk_template = '''
+try:
+    from pytransform import clean_str
+except ImportError:
+    def clean_str(*args):
+        for obj in args:
+            if isinstance(obj, bytearray):
+                obj[:] = bytearray(len(obj))
+
+_tables = []
+
+
+def _decode(i, start, end):
+    key = {key}
+    if not _tables:
+        _tables.extend([bytes(bytearray([x ^ k for x in range(256)]))
+                        for k in key])
+    n = len(key)
+    buf = bytearray(_chunks[i][start:end])
+    for j in range(min(n, len(buf))):
+        t = buf[j::n].translate(_tables[(start + j) % n])
+        buf[j::n] = t
+        clean_str(t)
+    return buf
+
+
+def read(offset=0, n=-1):
+    offset = min(max(offset, 0), size)
+    if n < 0 or offset + n > size:
+        n = size - offset
+    result = bytearray(n)
+    pos = 0
+    while pos < n:
+        i, start = divmod(offset + pos, chunk_size)
+        buf = _decode(i, start, min(chunk_size, start + n - pos))
+        result[pos:pos+len(buf)] = buf
+        pos += len(buf)
+        clean_str(buf)
+    return result
+
+
+def iterchunks(offset=0, n=-1):
+    end = size if n < 0 else min(offset + n, size)
+    while offset < end:
+        buf = read(offset, min(chunk_size - offset % chunk_size,
+                               end - offset))
+        offset += len(buf)
+        try:
+            yield buf
+        finally:
+            clean_str(buf)
+
+
+class Safebytes(object):
+
+    def __init__(self, offset=0, n=-1):
+        self._range = offset, n
+
+    def __enter__(self):
+        self._value = read(*self._range)
+        return self._value
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        clean_str(self._value)
+        del self._value
+
+
+class Safestr(object):
+
+    def __enter__(self):
+        data = read()
+        self._value = data.decode({encoding})
+        clean_str(data)
+        return self._value
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        clean_str(self._value)
+        del self._value
+
+'''
+
 
 def key(xlist):
     while 1:
@@ -80,6 +188,38 @@ def build_module(filename, keylen=32, encoding=''):
     return template.format(data=s, key=str(keylist), encoding=encoding)
 
 
+def xor_chunk(data, tables):
+    '''Xor bytearray `data` in place by translate tables, the key list
+    starts from the first byte of `data`.'''
+    n = len(tables)
+    for i in range(min(n, len(data))):
+        data[i::n] = data[i::n].translate(tables[i])
+    return data
+
+
+def iter_module(filename, chunk, keylen=32, encoding=''):
+    '''Build chunked data module from `filename`, yield the source code
+    piece by piece, so the data file needn't be loaded to memory.'''
+    if chunk <= 0:
+        raise RuntimeError('Invalid chunk size %s' % chunk)
+    keylist = [random.randint(0, 255) for i in range(keylen)]
+    tables = [bytes(bytearray([x ^ k for x in range(256)]))
+              for k in keylist]
+
+    yield chunk_template.format(key=str(keylist), encoding=encoding)
+
+    size = getsize(filename)
+    yield 'size = %d\nchunk_size = %d\n_chunks = (\n' % (size, chunk)
+    with open(filename, 'rb') as f:
+        while True:
+            data = bytearray(f.read(chunk))
+            if not data:
+                break
+            s = repr(bytes(xor_chunk(data, tables)))
+            yield '    %s%s,\n' % ('' if s[0] == 'b' else 'b', s)
+    yield ')\n'
+
+
 def main(argv):
     parser = argparse.ArgumentParser(
         prog='build-data-module',
@@ -89,6 +229,9 @@ def main(argv):
     parser.add_argument('-n', '--key', default=32, type=int,
                         help='length of key list used to xor data')
     parser.add_argument('-c', '--encoding', help='encoding of data file')
+    parser.add_argument('-s', '--chunk', default=0, type=int, metavar='SIZE',
+                        help='encode data by chunks of SIZE bytes, the '
+                        'data module could be read by range')
     parser.add_argument('-f', '--force', action='store_true',
                         help='overwrite the exists module file')
     parser.add_argument('-O', '--output', metavar='PATH',
@@ -104,22 +247,28 @@ def main(argv):
             logging.info('Make output path: %s', args.output)
             makedirs(args.output)
 
-        def output(filename, code):
+        def output(filename, lines):
             name = splitext(basename(filename))[0] + '.py'
             target = join_path(args.output, name)
             if exists(target) and not args.force:
                 raise RuntimeError('Data module "%s" exists' % target)
             logging.info('Write data module to "%s"', target)
             with open(target, 'w') as f:
-                f.write(code)
+                f.writelines(lines)
     else:
-        def output(filename, code):
-            print(code)
+        def output(filename, lines):
+            sys.stdout.writelines(lines)
+            sys.stdout.write('\n')
 
     random.seed()
     for filename in args.files:
-        code = build_module(filename, keylen=args.key, encoding=encoding)
-        output(filename, code)
+        if args.chunk:
+            lines = iter_module(filename, args.chunk, keylen=args.key,
+                                encoding=encoding)
+        else:
+            lines = [build_module(filename, keylen=args.key,
+                                  encoding=encoding)]
+        output(filename, lines)
 
 
 if __name__ == '__main__':
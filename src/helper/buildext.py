@@ -16,14 +16,26 @@ build it by any c compiler, for example
     gcc $(python-config --cflags) $(python-config --ldflags) \\
         -shared -o dist/foo$(python-config --extension-suffix) \\
         dist/foo.c
+
+The extensions are built by multiple processes, and the object files
+are saved in the cache of pyarmor, the unchanged scripts aren't compiled
+again. All the scripts could be built to one shared library, import
+this library once, then all the modules in it could be imported
+
+    python buildext.py -l _mylib dist/
+    python -c "import _mylib; import foo"
 '''
 import argparse
 import glob
+import hashlib
 import logging
 import os
-import random
+import shutil
 import sys
 
+from binascii import a2b_base64, hexlify, unhexlify
+from random import Random
+
 from distutils.core import setup, Extension
 from distutils.ccompiler import new_compiler
 from distutils.sysconfig import customize_compiler
@@ -32,6 +44,11 @@ from sysconfig import get_config_var, get_path
 
 logger = logging.getLogger('buildext')
 
+# The prefix of payload in compact format, refer to compact_payload in
+# config.py. This script could be run alone, so it doesn't import utils,
+# and decode_payload is a copy of utils.decode_payload
+COMPACT_PREFIX = "__import__('binascii').a2b_base64('"
+
 c_extension_template = '''
 #define PYARMOR_RUNTIME "pyarmor_runtime"
 
@@ -251,19 +268,117 @@ main(int argc, char *argv[])
 '''
 
 
-def make_macro_for_customized_bytecodes(bytecodes):
+c_library_template = '''
+/* Generated by PyArmor Helper 0.1 */
+#include "Python.h"
+
+static const char *module_table[] = { MODULE_TABLE NULL };
+
+static const char *finder_code = FINDER_CODE;
+
+static int
+init_library(PyObject *m)
+{
+  const char **p;
+  PyObject *r, *s;
+  PyObject *d = PyModule_GetDict(m);
+  PyObject *names = PyList_New(0);
+
+  if (!names)
+    return -1;
+  for (p = module_table; *p; p++) {
+    s = Py_BuildValue("s", *p);
+    if (!s || PyList_Append(names, s)) {
+      Py_XDECREF(s);
+      Py_DECREF(names);
+      return -1;
+    }
+    Py_DECREF(s);
+  }
+  if (PyDict_SetItemString(d, "__modules__", names)) {
+    Py_DECREF(names);
+    return -1;
+  }
+  Py_DECREF(names);
+
+  if (PyDict_SetItemString(d, "__builtins__", PyEval_GetBuiltins()))
+    return -1;
+  r = PyRun_String(finder_code, Py_file_input, d, d);
+  if (!r)
+    return -1;
+  Py_DECREF(r);
+  return 0;
+}
+
+#if (PY_MAJOR_VERSION >= 3)
+
+static struct PyModuleDef module = {
+    PyModuleDef_HEAD_INIT,
+    "XYZXYZ",
+    NULL,
+    -1,
+    NULL
+};
+
+PyMODINIT_FUNC
+PyInit_XYZXYZ(void)
+{
+  PyObject *m = PyModule_Create(&module);
+  if (m && init_library(m)) {
+    Py_DECREF(m);
+    m = NULL;
+  }
+  return m;
+}
+
+#else
+# error "Building library only works for Python 3"
+#endif
+'''
+
+# Install a finder to import the modules in the table from this library
+finder_code = '''
+import sys
+
+class ModuleTableFinder(object):
+
+    def __init__(self, name, modules):
+        self.name = name
+        prefix = name.rpartition('.')[0]
+        self.modules = set([prefix + '.' + x if prefix else x
+                            for x in modules])
+
+    def _filename(self):
+        return sys.modules[self.name].__file__
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname in self.modules:
+            from importlib.machinery import ExtensionFileLoader
+            from importlib.util import spec_from_file_location
+            filename = self._filename()
+            loader = ExtensionFileLoader(fullname, filename)
+            return spec_from_file_location(fullname, filename, loader=loader)
+
+sys.meta_path.insert(0, ModuleTableFinder(__name__, __modules__))
+del ModuleTableFinder
+'''
+
+
+def make_macro_for_customized_bytecodes(bytecodes, seed=None):
     n = len(bytecodes)
-    i = random.randrange(0, n)
-    j = random.randrange(0, n)
-    k = random.randrange(0, 256)
+    rand = Random(seed)
+    i = rand.randrange(0, n)
+    j = rand.randrange(0, n)
+    k = rand.randrange(0, 256)
     bytecodes[i] -= 1
     bytecodes[j] ^= k
+    # Restore them in the reverse order, i may be same as j
     return r'''
 #define CUSTOMIZE_BYTECODES(bytecodes) do { \
-        bytecodes[%s] ++;                  \
         bytecodes[%s] ^= %s;               \
+        bytecodes[%s] ++;                  \
     } while (0)
-''' % (i, j, k)
+''' % (j, k, i)
 
 
 def makedirs(path, exist_ok=False):
@@ -271,7 +386,40 @@ def makedirs(path, exist_ok=False):
         os.makedirs(path)
 
 
-def make_c_source(filename, output=None, extra=None):
+def decode_payload(payload):
+    if payload.startswith(COMPACT_PREFIX):
+        return a2b_base64(payload[len(COMPACT_PREFIX):-2])
+    if payload.startswith("b'\\x"):
+        return unhexlify(payload[2:-1].replace('\\x', ''))
+    return eval(payload)
+
+
+def get_customized_seed(bytecodes, nocache=False):
+    '''Return the random seed to customize the bytecodes. The seed is
+    saved in the cache by the bytecodes, so the same script gets the same
+    .c file next time, and its object file could be got from the cache.
+    If the cache is not used, it's a new seed each time.'''
+    seed = hexlify(os.urandom(16)).decode()
+    path = None if nocache else get_cache_path()
+    if path is None:
+        return seed
+
+    data = b'buildext-seed:' + bytes(bytearray(bytecodes))
+    key = hashlib.sha256(data).hexdigest()
+    filename = os.path.join(path, key[:2], key[2:])
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return f.read().strip()
+
+    makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmpname, 'w') as f:
+        f.write(seed)
+    os.rename(tmpname, filename)
+    return seed
+
+
+def make_c_source(filename, output=None, extra=None, nocache=False):
     logger.info('Analysis "%s"', filename)
 
     name = os.path.basename(filename).rsplit('.', 1)[0]
@@ -286,7 +434,8 @@ def make_c_source(filename, output=None, extra=None):
                 pyarmor_name, parastr = line.strip().split('(', 1)
                 paras = parastr.strip()[:-1].split(',')
                 cipher_mode = paras[-1]
-                cipher_code = list(bytearray(eval(paras[-2])))
+                cipher_code = list(bytearray(decode_payload(
+                    paras[-2].strip())))
                 break
 
     if pyarmor_name.find('pyarmor') == -1:
@@ -301,7 +450,8 @@ def make_c_source(filename, output=None, extra=None):
     logger.info('super mode is %s', super_mode)
     logger.info('cipher mode is %s', cipher_mode)
 
-    customized_macro = make_macro_for_customized_bytecodes(cipher_code)
+    seed = get_customized_seed(cipher_code, nocache=nocache)
+    customized_macro = make_macro_for_customized_bytecodes(cipher_code, seed)
 
     macros = [
         '/* Generated by PyArmor Helper 0.1 */',
@@ -333,7 +483,16 @@ def build_extensions(sources):
           ext_modules=[Extension(k, sources=[v]) for k, v in modules])
 
 
-def make_extensions(sources, executable=False):
+_compiler = None
+
+
+def get_compiler():
+    '''Return `(cc, cflags, ldflags)`, it's only made once in each
+    process.'''
+    global _compiler
+    if _compiler is not None:
+        return _compiler
+
     cc = new_compiler()
     customize_compiler(cc)
 
@@ -352,25 +511,157 @@ def make_extensions(sources, executable=False):
     logger.debug('CFLAGS %s', cflags)
     logger.debug('LDFLAGS %s', ldflags)
 
-    objects = cc.object_filenames(sources)
-    cc.compile(sources, extra_preargs=cflags)
-
+    _compiler = cc, cflags, ldflags
+    return _compiler
+
+
+def get_cache_path():
+    '''Return the path to save object files, it's same as the cache of
+    obfuscated scripts, so the objects are pruned with them. Return None
+    if the cache is disabled by PYARMOR_CACHE_SIZE=0.'''
+    if int(os.getenv('PYARMOR_CACHE_SIZE', '512')) > 0:
+        home = os.getenv('PYARMOR_HOME', os.path.join('~', '.pyarmor'))
+        path = os.getenv('PYARMOR_CACHE', os.path.join(home, 'cache'))
+        return os.path.join(os.path.abspath(os.path.expanduser(path)),
+                            'scripts')
+
+
+def make_object_key(source):
+    '''Return the cache key of the .c file `source`.'''
+    cc, cflags, ldflags = get_compiler()
+    h = hashlib.sha256()
+    for x in (sys.version, cc.compiler_type,
+              getattr(cc, 'compiler_so', None), cc.include_dirs, cflags):
+        h.update(repr(x).encode())
+    with open(source, 'rb') as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def compile_object(source, nocache=False):
+    '''Compile the .c file `source`, return the object file. The object
+    is copied from the cache if the source, compiler and flags are same.'''
+    cc, cflags, ldflags = get_compiler()
+    obj = cc.object_filenames([source])[0]
+
+    path = None if nocache else get_cache_path()
+    if path is not None:
+        key = make_object_key(source)
+        cached = os.path.join(path, key[:2], key[2:])
+        if os.path.exists(cached):
+            logger.info('Use cached object for "%s"', source)
+            shutil.copyfile(cached, obj)
+            os.utime(cached, None)
+            return obj
+
+    logger.info('Compile "%s"', source)
+    cc.compile([source], extra_preargs=cflags)
+
+    if path is not None:
+        makedirs(os.path.dirname(cached), exist_ok=True)
+        tmpname = '%s.%d.tmp' % (cached, os.getpid())
+        shutil.copyfile(obj, tmpname)
+        os.rename(tmpname, cached)
+    return obj
+
+
+def _build_worker(args):
+    source, executable, nocache = args
+    cc, cflags, ldflags = get_compiler()
+    obj = compile_object(source, nocache)
     if executable:
-        def cc_link(src, obj):
-            output = cc.executable_filename(src[:-2])
-            logger.info('Generate executable "%s"', output)
-            cc.link_executable([obj], output, extra_postargs=ldflags)
+        output = cc.executable_filename(source[:-2])
+        logger.info('Generate executable "%s"', output)
+        cc.link_executable([obj], output, extra_postargs=ldflags)
     else:
-        def cc_link(src, obj):
-            output = cc.shared_object_filename(src[:-2])
-            logger.info('Generate extension "%s"', output)
-            cc.link_shared_object([obj], output, extra_postargs=ldflags)
+        output = cc.shared_object_filename(source[:-2])
+        logger.info('Generate extension "%s"', output)
+        cc.link_shared_object([obj], output, extra_postargs=ldflags)
+    os.remove(obj)
+    return output
 
-    for src, obj in zip(sources, objects):
-        cc_link(src, obj)
+
+def _compile_worker(args):
+    return compile_object(*args)
+
+
+def run_jobs(func, tasks, jobs=0):
+    '''Run `func` for each task by `jobs` processes, 0 means the number of
+    cpus. Return the list of results in the order of tasks.'''
+    if jobs == 0:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    jobs = min(jobs, len(tasks))
+
+    if jobs < 2:
+        return [func(x) for x in tasks]
+
+    from multiprocessing import Pool
+    logger.info('Build with %d processes', jobs)
+    pool = Pool(jobs)
+    try:
+        results = pool.map(func, tasks)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def make_extensions(sources, executable=False, jobs=0, nocache=False):
+    tasks = [(x, executable, nocache) for x in sources]
+    return run_jobs(_build_worker, tasks, jobs)
+
+
+def make_c_literal(code):
+    lines = []
+    for line in code.splitlines(True):
+        line = line.replace('\\', '\\\\').replace('"', '\\"')
+        lines.append('"%s"' % line.replace('\n', '\\n'))
+    return '\n'.join(lines)
+
+
+def make_library(sources, name, jobs=0, nocache=False):
+    '''Build all the .c files to one shared library `name` in the path of
+    the sources. The library has a module table of all the modules, once
+    it's imported, the modules in the table are imported from this library
+    directly. It only works for Python 3, because Python 2 only loads one
+    module from each shared library.
+
+    All the sources must be in the same path, the modules are registered
+    in the package of the library.'''
+    if sys.version_info[0] < 3:
+        raise RuntimeError('Building library only works for Python 3')
+    paths = set([os.path.dirname(os.path.abspath(x)) for x in sources])
+    if len(paths) > 1:
+        raise RuntimeError('All the scripts in the library must be in the '
+                           'same path, but got %s' % ', '.join(sorted(paths)))
+    names = [os.path.basename(x)[:-2] for x in sources]
+    if len(set(names)) != len(names):
+        raise RuntimeError('Duplicated module names in the library')
+    if name in names:
+        raise RuntimeError('The library name "%s" is used by module' % name)
+
+    libsrc = os.path.join(os.path.dirname(sources[0]), name + '.c')
+    logger.info('Write "%s"', libsrc)
+    table = ''.join(['"%s", ' % x for x in names])
+    with open(libsrc, 'w') as f:
+        f.write(c_library_template
+                .replace('MODULE_TABLE', table)
+                .replace('FINDER_CODE', make_c_literal(finder_code))
+                .replace('XYZXYZ', name))
+
+    tasks = [(x, nocache) for x in sources + [libsrc]]
+    objects = run_jobs(_compile_worker, tasks, jobs)
+
+    cc, cflags, ldflags = get_compiler()
+    output = cc.shared_object_filename(libsrc[:-2])
+    logger.info('Generate library "%s" with %d modules', output, len(names))
+    cc.link_shared_object(objects, output, extra_postargs=ldflags)
 
     logger.debug('Clean all .o files')
     [os.remove(x) for x in objects]
+    return libsrc, output
 
 
 def excepthook(type, exc, traceback):
@@ -406,6 +697,13 @@ def main():
                         action='store_true',
                         dest='inplace',
                         help='remove script after build (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=0, metavar='N',
+                        help='build by N processes, 0 means the number of '
+                        'cpus (default: %(default)s)')
+    parser.add_argument('-l', '--library', metavar='NAME',
+                        help='build all the scripts to one shared library')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the cache of object files')
     parser.add_argument('scripts',
                         metavar='PATH',
                         nargs='+',
@@ -427,14 +725,25 @@ def main():
             logger.warning('Ignore %s', pat)
     filelist.sort()
 
-    random.seed()
-    sources = [make_c_source(x, extra=args.executable) for x in filelist]
+    if args.library and args.executable:
+        raise RuntimeError('Could not build executable to library')
+
+    nocache = args.no_cache or not args.build
+    sources = [make_c_source(x, extra=args.executable, nocache=nocache)
+               for x in filelist]
     sources = [x for x in sources if x]
 
-    if args.build:
-        make_extensions(sources, executable=args.executable)
+    if args.build and sources:
+        if args.library:
+            libsrc = make_library(sources, args.library, jobs=args.jobs,
+                                  nocache=args.no_cache)[0]
+        else:
+            make_extensions(sources, executable=args.executable,
+                            jobs=args.jobs, nocache=args.no_cache)
         if not args.debug:
             [os.remove(x) for x in sources]
+            if args.library:
+                os.remove(libsrc)
 
     if args.inplace and sources:
         logger.info('Remove obfuscated scripts')
@@ -19,6 +19,11 @@ If also possible to merge one script, for example:
 
     python merge.py py27/foo.py py36/foo.py py35/foo.py
 
+The scripts are merged by multiple processes, use `-j 1` to disable it.
+Check the scripts could be merged or not, but do not write any file:
+
+    python merge.py --check py38/ py27/
+
 '''
 import argparse
 import logging
@@ -27,8 +32,15 @@ import shutil
 import struct
 import sys
 
+from binascii import a2b_base64, b2a_base64, hexlify, unhexlify
+
 logger = logging.getLogger('merge')
 
+# The prefix of payload in compact format, refer to compact_payload in
+# config.py. This script could be run alone, so it doesn't import utils,
+# and decode_payload is a copy of utils.decode_payload
+COMPACT_PREFIX = "__import__('binascii').a2b_base64('"
+
 
 def is_pyscript(filename):
     return os.path.splitext(filename)[-1].lower() in ('.py', '.pyw')
@@ -37,19 +49,58 @@ def is_pyscript(filename):
 def makedirs(path, exist_ok=False):
     if not (exist_ok and os.path.exists(path)):
         if path:
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError:
+                # It may be made by other workers at the same time
+                if not (exist_ok and os.path.isdir(path)):
+                    raise
+
+
+def decode_payload(payload):
+    if payload.startswith(COMPACT_PREFIX):
+        return a2b_base64(payload[len(COMPACT_PREFIX):-2])
+    if payload.startswith("b'\\x"):
+        return unhexlify(payload[2:-1].replace('\\x', ''))
+    return eval(payload)
+
+
+def encode_hex(data):
+    '''Return the escaped string like "\\x12\\x34" of `data`, all the
+    bytes are handled by slice assignment other than a Python loop.'''
+    h = hexlify(data)
+    n = len(data)
+    s = bytearray(n * 4)
+    s[0::4] = b'\\' * n
+    s[1::4] = b'x' * n
+    s[2::4] = h[0::2]
+    s[3::4] = h[1::2]
+    return s.decode()
+
+
+def write_payload(f, pieces, compact=False):
+    '''Write the payload made of `pieces` to file `f` piece by piece, the
+    pieces may be memoryview of the original payloads.'''
+    if compact:
+        data = bytearray()
+        for x in pieces:
+            data += x
+        f.write("%s%s')" % (COMPACT_PREFIX, b2a_base64(data).decode().strip()))
+    else:
+        f.write("b'")
+        for x in pieces:
+            f.write(encode_hex(x))
+        f.write("'")
 
 
 def parse_script(filename):
-    n = 0
     with open(filename) as f:
-        for s in f.readlines():
+        for n, s in enumerate(f):
             if s.startswith('__pyarmor') or s.startswith('pyarmor('):
                 fs = s[s.find('__file__'):s.rfind(')')].split(', ')
-                code = eval(fs[-2])
+                code = memoryview(decode_payload(fs[-2]))
                 flag = int(fs[-1])
                 break
-            n += 1
         else:
             return None, None, None, None
 
@@ -59,23 +110,30 @@ def parse_script(filename):
     valid = False
 
     while left_size > 0:
-        pymajor, pyminor = struct.unpack("BB", code[offset+9:offset+11])
-        size, = struct.unpack("i", code[offset+56:offset+60])
+        if left_size < 60:
+            break
+        pymajor, pyminor = struct.unpack_from("BB", code, offset+9)
+        size, = struct.unpack_from("i", code, offset+56)
         if not size:
             valid = True
             size = left_size
+        elif size < 0 or size > left_size:
+            break
         left_size -= size
         infos.append([offset, size, (pymajor, pyminor)])
         offset += size
 
     if not valid:
-        raise RuntimeError('Invalid header in this script')
+        raise RuntimeError('Invalid header in the script "%s"' % filename)
 
     return n, flag, code, infos
 
 
-def merge_scripts(scripts, output):
-    refscript = scripts.pop(0)
+def merge_scripts(scripts, output, check=False):
+    '''Merge the obfuscated `scripts` to `output`, the first one is the
+    reference script. If `check` is True, only check the headers of all
+    the scripts, no file is written. Return the merged Python versions.'''
+    refscript = scripts[0]
     logger.info('Parse reference script %s', refscript)
     refn, reflag, refcode, refinfos = parse_script(refscript)
 
@@ -86,7 +144,7 @@ def merge_scripts(scripts, output):
     merged_vers = []
     pieces = []
 
-    for script in reversed(scripts):
+    for script in reversed(scripts[1:]):
         logger.info('Parse script %s', script)
         n, flag, code, pyinfos = parse_script(script)
         if code is None:
@@ -118,24 +176,63 @@ def merge_scripts(scripts, output):
         merged_vers.append(ver)
         pieces.append(refcode[offset:offset+size])
 
-    scode = '\\x' + '\\x'.join(['%02x' % c
-                                for c in bytearray(b''.join(pieces))])
-
-    with open(scripts[0]) as f:
-        lines = f.readlines()
-
-    s = lines[refn]
-    i = s.find(', b')
-    j = s.rfind(',')
-    lines[refn] = s[:i+4] + scode + s[j-1:]
+    if check:
+        logger.info('Check script %s OK: %s', refscript, ', '.join(
+            ['%d.%d' % ver for ver in merged_vers]))
+        return merged_vers
 
     logger.info('Write merged script: %s', output)
     for ver in merged_vers:
         logger.info('\t* Python %d.%d', *ver)
 
     makedirs(os.path.dirname(output), exist_ok=True)
-    with open(output, 'w') as f:
-        f.write(''.join(lines))
+    with open(scripts[1] if len(scripts) > 1 else refscript) as f:
+        with open(output, 'w') as fo:
+            for n, s in enumerate(f):
+                if n != refn:
+                    fo.write(s)
+                    continue
+                i = s.find('__file__, ') + len('__file__, ')
+                fo.write(s[:i])
+                write_payload(fo, pieces, s.startswith(COMPACT_PREFIX, i))
+                fo.write(s[s.rfind(','):])
+    return merged_vers
+
+
+def _init_worker(level):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)-8s %(message)s')
+    logger.setLevel(level)
+
+
+def _merge_worker(args):
+    return merge_scripts(*args)
+
+
+def merge_many(tasks, jobs=0):
+    '''Run `merge_scripts` for each item `(scripts, output, check)` of
+    `tasks` by `jobs` processes, 0 means the number of cpus.'''
+    if jobs == 0:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    jobs = min(jobs, len(tasks))
+
+    if jobs < 2:
+        for task in tasks:
+            merge_scripts(*task)
+        return
+
+    from multiprocessing import Pool
+    logger.info('Merge scripts with %d processes', jobs)
+    chunksize = max(1, min(16, len(tasks) // (jobs * 4)))
+    pool = Pool(jobs, _init_worker, (logger.getEffectiveLevel(),))
+    try:
+        for x in pool.imap_unordered(_merge_worker, tasks, chunksize):
+            pass
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def merge_runtimes(paths, output):
@@ -254,6 +351,12 @@ def main():
                         help='print debug log (default: %(default)s)')
     parser.add_argument('-n', '--no-runtime', action='store_true',
                         help='Ignore runtime files')
+    parser.add_argument('-j', '--jobs', type=int, default=0, metavar='N',
+                        help='Merge scripts by N processes, 0 means the '
+                        'number of cpus (default: %(default)s)')
+    parser.add_argument('--check', action='store_true',
+                        help='Only check the headers of all the scripts, '
+                        'do not write any file')
     parser.add_argument('path', nargs='+',
                         help="Path or obfuscated script")
 
@@ -270,18 +373,25 @@ def main():
         output = output if is_pyscript(output) \
             else os.path.join(output, os.path.basename(args.path[0]))
 
-        merge_scripts(args.path, output)
+        merge_scripts(args.path, output, args.check)
+        if args.check:
+            return
 
     else:
         if output and is_pyscript(output):
             raise RuntimeError('--output must be a path when mergeing path')
 
         logging.info('Merging obfuscated scripts...')
-        for name in find_scripts(args.path):
-            merge_scripts([os.path.join(p, name) for p in args.path],
-                          os.path.join(output, name))
+        merge_many([([os.path.join(p, name) for p in args.path],
+                     os.path.join(output, name), args.check)
+                    for name in find_scripts(args.path)], args.jobs)
         logging.info('Merging obfuscated scripts OK')
 
+        if args.check:
+            logger.info('Check all the scripts in %s OK',
+                        str(args.path)[1:-1])
+            return
+
         if not args.no_runtime:
             logging.info('Merging runtime files...')
             merge_runtimes(args.path, output)
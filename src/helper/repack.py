@@ -57,6 +57,7 @@ import sys
 import zlib
 
 from subprocess import check_call
+from tempfile import mkdtemp
 
 from PyInstaller.archive.writers import ZlibArchiveWriter, CArchiveWriter
 from PyInstaller.archive.readers import CArchiveReader
@@ -84,41 +85,65 @@ class ZlibArchive(ZlibArchiveReader):
         self.lib.read(4)
 
 
+CHUNK_SIZE = 1 << 20
+
+
+def copy_range(src, dst, offset, size):
+    '''Copy `size` bytes at `offset` of file `src` to opened file `dst`.'''
+    with open(src, 'rb') as f:
+        f.seek(offset, os.SEEK_SET)
+        while size > 0:
+            data = f.read(min(size, CHUNK_SIZE))
+            if not data:
+                raise RuntimeError('Unexpected end of file "%s"' % src)
+            dst.write(data)
+            size -= len(data)
+
+
 class CArchiveWriter2(CArchiveWriter):
 
     def add(self, entry):
+        '''The entry is `(patched, dlen, ulen, flag, typcd, nm, pathnm)`.
+        If it's not patched, `pathnm` is `(filename, offset)`, the data is
+        copied from this range of the original bundle as it is.'''
         patched, dlen, ulen, flag, typcd, nm, pathnm = entry
         where = self.lib.tell()
 
         logger.debug('Add item "%s"', nm)
 
-        if is_darwin and patched and typcd == 'b':
+        if not patched:
+            copy_range(pathnm[0], self.lib, pathnm[1], dlen)
+            self.toc.add(where, dlen, ulen, flag, typcd, nm)
+            return
+
+        logger.info('Replace item "%s" with "%s"', nm, pathnm)
+        if is_darwin and typcd == 'b':
             from PyInstaller.depend import dylib
             dylib.mac_set_relative_dylib_deps(pathnm, os.path.basename(pathnm))
 
-        fh = open(pathnm, 'rb')
-        filedata = fh.read()
-        fh.close()
-
-        if patched:
-            logger.info('Replace item "%s" with "%s"', nm, pathnm)
+        with open(pathnm, 'rb') as fh:
             if typcd in ('s', 'M'):
-                code = compile(filedata, '<%s>' % nm, 'exec')
-                filedata = marshal.dumps(code)
-                ulen = len(filedata)
+                code = compile(fh.read(), '<%s>' % nm, 'exec')
+                ulen = self._write_chunks([marshal.dumps(code)], flag)
             else:
-                ulen = len(filedata)
-
-        if flag == 1 and patched:
-            comprobj = zlib.compressobj(self.LEVEL)
-            self.lib.write(comprobj.compress(filedata))
-            self.lib.write(comprobj.flush())
-        else:
-            self.lib.write(filedata)
+                ulen = self._write_chunks(
+                    iter(lambda: fh.read(CHUNK_SIZE), b''), flag)
 
         dlen = self.lib.tell() - where
         self.toc.add(where, dlen, ulen, flag, typcd, nm)
 
+    def _write_chunks(self, chunks, flag):
+        '''Write the chunks, compress them if `flag` is 1. Return the
+        uncompressed size.'''
+        comprobj = zlib.compressobj(self.LEVEL) if flag == 1 else None
+        ulen = 0
+        for data in chunks:
+            ulen += len(data)
+            self.lib.write(comprobj.compress(data) if comprobj else data)
+        if comprobj:
+            self.lib.write(comprobj.flush())
+        return ulen
+
 
 def makedirs(path, exist_ok=False):
     if not (exist_ok and os.path.exists(path)):
@@ -173,23 +198,58 @@ def append_runtime_files(logic_toc, obfpath):
     logger.info('Append runtime files OK')
 
 
-def repack_pyz(pyz, obfpath, cipher=None, clean=False):
+def _compile_worker(args):
+    name, pyfile = args
+    with open(pyfile, 'r') as f:
+        source = f.read()
+    return name, pyfile, marshal.dumps(compile(source, '<%s>' % name, 'exec'))
+
+
+def compile_scripts(items, jobs=0):
+    '''Compile the scripts `(name, pyfile)` by `jobs` processes, 0 means
+    the number of cpus. Yield `(name, pyfile, marshaled code)`.'''
+    if jobs == 0:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    jobs = min(jobs, len(items))
+
+    if jobs < 2:
+        for x in items:
+            yield _compile_worker(x)
+        return
+
+    from multiprocessing import Pool
+    logger.info('Compile obfuscated scripts with %d processes', jobs)
+    chunksize = max(1, min(16, len(items) // (jobs * 4)))
+    pool = Pool(jobs)
+    try:
+        for x in pool.imap_unordered(_compile_worker, items, chunksize):
+            yield x
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def repack_pyz(pyz, obfpath, cipher=None, clean=False, jobs=0):
     code_dict = {}
     obflist = []
 
+    items = []
     n = len(obfpath) + 1
     for dirpath, dirnames, filenames in os.walk(obfpath):
         for pyfile in [x for x in filenames if x.endswith('.py')]:
             pyfile = os.path.join(dirpath, pyfile)
-            logger.info('Compile %s', pyfile)
             name = pyfile[n:].replace('\\', '.').replace('/', '.')[:-3]
             if name.endswith('__init__.py'):
                 name = name[:-len('__init__.py')].strip('.')
-            with open(pyfile, 'r') as f:
-                source = f.read()
-            logger.debug('Got obfuscated item: %s', name)
-            code_dict[name] = compile(source, '<%s>' % name, 'exec')
-            obflist.append(name)
+            items.append((name, pyfile))
+
+    for name, pyfile, data in compile_scripts(items, jobs):
+        logger.info('Compile %s', pyfile)
+        logger.debug('Got obfuscated item: %s', name)
+        code_dict[name] = marshal.loads(data)
+        obflist.append(name)
     logger.info('Got %d obfuscated items', len(obflist))
 
     logger.info('Patching PYZ file "%s"', pyz)
@@ -197,12 +257,13 @@ def repack_pyz(pyz, obfpath, cipher=None, clean=False):
 
     logic_toc = []
     for name in arch.toc:
-        logger.debug('Extract %s', name)
-        typ, obj = arch.extract(name)
         if name in obflist:
             logger.info('Replace item "%s" with obfsucated one', name)
             obflist.remove(name)
+            typ = arch.toc[name][0]
         else:
+            logger.debug('Extract %s', name)
+            typ, obj = arch.extract(name)
             code_dict[name] = obj
         pathname = '__init__.py' if typ == PYZ_TYPE_PKG else name
         logic_toc.append((name, pathname, 'PYMODULE'))
@@ -264,7 +325,7 @@ def repack_exe(path, obfname, logic_toc, obfentry, codesign=None):
     logger.info('Generate patched bundle "%s" successfully', obfname)
 
 
-def repacker(executable, obfpath, entry=None, codesign=None):
+def repacker(executable, obfpath, entry=None, codesign=None, jobs=0):
     logger.info('Repack PyInstaller bundle "%s"', executable)
 
     obfpath = os.path.normpath(obfpath)
@@ -281,36 +342,39 @@ def repacker(executable, obfpath, entry=None, codesign=None):
     if not os.path.exists(obfentry):
         raise RuntimeError('No obfuscated script "%s" found', obfentry)
 
-    path = os.path.join(name + '_extracted')
+    path = mkdtemp(prefix=name + '_extracted_')
     logger.info('Extracted bundle files to "%s"', path)
-    makedirs(path, exist_ok=True)
-
-    for item in arch.toc:
-        logger.debug('toc: %s', item)
-        dpos, dlen, ulen, flag, typcd, nm = item
-        pathnm = os.path.join(path, nm)
-        makedirs(os.path.dirname(pathnm), exist_ok=True)
-        with arch.lib:
-            arch.lib.seek(arch.pkg_start + dpos)
-            with open(pathnm, 'wb') as f:
-                f.write(arch.lib.read(dlen))
-
+    try:
+        # Only the replaced items are extracted, the others are copied from
+        # the original bundle when writing the patched PKG
+        for item in arch.toc:
+            logger.debug('toc: %s', item)
+            dpos, dlen, ulen, flag, typcd, nm = item
             if nm.endswith('.pyz') and typcd in ('z', 'Z'):
+                pathnm = os.path.join(path, nm)
+                makedirs(os.path.dirname(pathnm), exist_ok=True)
+                with open(pathnm, 'wb') as f:
+                    copy_range(executable, f, arch.pkg_start + dpos, dlen)
                 logger.info('Extract pyz file "%s"', pathnm)
-                repack_pyz(pathnm, obfpath)
+                repack_pyz(pathnm, obfpath, jobs=jobs)
                 patched = 1
             elif name == nm:
                 patched = 1
                 pathnm = obfentry
             else:
                 patched = 0
+                pathnm = executable, arch.pkg_start + dpos
             logic_toc.append((patched, dlen, ulen, flag, typcd, nm, pathnm))
 
-    append_runtime_files(logic_toc, obfpath)
+        append_runtime_files(logic_toc, obfpath)
 
-    obfname = os.path.join(name + '_obf' + ext)
-    shutil.copy2(executable, obfname)
-    repack_exe(path, obfname, logic_toc, obfentry, codesign=codesign)
+        obfname = os.path.join(name + '_obf' + ext)
+        shutil.copy2(executable, obfname)
+        repack_exe(path, obfname, logic_toc, obfentry, codesign=codesign)
+    finally:
+        if logger.getEffectiveLevel() > logging.DEBUG:
+            logger.info('Remove temporary path "%s"', path)
+            shutil.rmtree(path)
 
 
 def excepthook(type, exc, traceback):
@@ -337,6 +401,9 @@ def main():
                         help="Entry script if it's different from bundle name")
     parser.add_argument('--codesign-identity',
                         help="Code signing identity (macOS only).")
+    parser.add_argument('-j', '--jobs', type=int, default=0, metavar='N',
+                        help='Compile obfuscated scripts by N processes, '
+                        '0 means the number of cpus (default: %(default)s)')
     parser.add_argument('executable', metavar='executable',
                         help="PyInstaller archive")
 
@@ -345,7 +412,8 @@ def main():
         logger.setLevel(logging.DEBUG)
     else:
         sys.excepthook = excepthook
-    repacker(args.executable, args.obfpath, args.entry, args.codesign_identity)
+    repacker(args.executable, args.obfpath, args.entry, args.codesign_identity,
+             args.jobs)
 
 
 if __name__ == '__main__':
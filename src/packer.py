@@ -44,12 +44,12 @@ import shutil
 import sys
 
 from codecs import open as codecs_open
-from distutils.util import get_platform
 from glob import glob
 from json import load as json_load
 from py_compile import compile as compile_file
 from shlex import split
 from subprocess import Popen, PIPE, STDOUT
+from sysconfig import get_platform
 from zipfile import PyZipFile
 
 import polyfills.argparse as argparse
@@ -100,30 +100,99 @@ def relpath(path, start=os.curdir):
         return path
 
 
+def _compile_worker(filename):
+    compile_file(filename, filename + 'c')
+    return filename
+
+
+def compile_scripts(filelist, jobs=0):
+    '''Compile the scripts by `jobs` processes, 0 means the number of
+    cpus. The script is ignored if its .pyc file is newer than it.'''
+    filelist = [x for x in filelist if not (
+        os.path.exists(x + 'c') and
+        os.path.getmtime(x + 'c') >= os.path.getmtime(x))]
+    if jobs == 0:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    jobs = min(jobs, len(filelist))
+
+    if jobs < 2:
+        for x in filelist:
+            _compile_worker(x)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(jobs)
+        try:
+            pool.map(_compile_worker, filelist)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return filelist
+
+
+def _copy_zip_member(src, dst, zinfo, end):
+    '''Copy the local header and compressed data of `zinfo` in the opened
+    file `src` to the ZipFile `dst` as it is, `end` is the offset of the
+    next member.'''
+    src.seek(zinfo.header_offset)
+    data = src.read(end - zinfo.header_offset)
+    zinfo.header_offset = dst.fp.tell()
+    dst.fp.write(data)
+    dst.start_dir = dst.fp.tell()
+    dst.filelist.append(zinfo)
+    dst.NameToInfo[zinfo.filename] = zinfo
+
+
 @logaction
-def update_library(obfdist, libzip):
+def update_library(obfdist, libzip, jobs=0):
     '''Update compressed library generated by py2exe or cx_Freeze, replace
 the original scripts with obfuscated ones.
 
+    Only the members which have obfuscated scripts are replaced, the
+    others are copied as raw compressed data. The obfuscated scripts are
+    compiled by `jobs` processes, and only if they're changed.
     '''
     # # It's simple ,but there are duplicated .pyc files
     # with PyZipFile(libzip, 'a') as f:
     #     f.writepy(obfdist)
-    filelist = []
-    for root, dirs, files in os.walk(obfdist):
-        filelist.extend([os.path.join(root, s) for s in files])
-
     with PyZipFile(libzip, 'r') as f:
-        namelist = f.namelist()
-        f.extractall(obfdist)
+        infolist = f.infolist()
+        start_dir = f.start_dir
+    members = set([x.filename for x in infolist])
 
-    for s in filelist:
-        if s.lower().endswith('.py'):
-            compile_file(s, s + 'c')
-
-    with PyZipFile(libzip, 'w') as f:
-        for name in namelist:
-            f.write(os.path.join(obfdist, name), name)
+    names = {}
+    for root, dirs, files in os.walk(obfdist):
+        for x in files:
+            if x.lower().endswith('.py'):
+                filename = os.path.join(root, x)
+                name = relpath(filename, obfdist).replace('\\', '/') + 'c'
+                if name in members:
+                    names[name] = filename
+
+    n = len(compile_scripts(list(names.values()), jobs))
+    logging.info('Compile %d of %d obfuscated scripts', n, len(names))
+
+    offsets = sorted([x.header_offset for x in infolist]) + [start_dir]
+    ends = dict(zip(offsets[:-1], offsets[1:]))
+
+    tmpname = libzip + '.tmp'
+    n = 0
+    with open(libzip, 'rb') as src:
+        with PyZipFile(tmpname, 'w') as dst:
+            for zinfo in infolist:
+                if zinfo.filename in names:
+                    logging.debug('Replace %s', zinfo.filename)
+                    dst.write(names[zinfo.filename] + 'c', zinfo.filename,
+                              compress_type=zinfo.compress_type)
+                    n += 1
+                else:
+                    _copy_zip_member(src, dst, zinfo,
+                                     ends[zinfo.header_offset])
+    logging.info('Replace %d of %d items in %s', n, len(infolist), libzip)
+
+    os.remove(libzip)
+    os.rename(tmpname, libzip)
 
 
 @logaction
@@ -172,6 +241,15 @@ setup script to build the bundle.
 
 
 def call_pyarmor(args):
+    if os.getenv('PYARMOR_SERVER'):
+        from server import request
+        logging.info('Send command to pyarmor server: %s', ' '.join(args))
+        returncode, output = request(args)
+        logging.info('\n%s', output)
+        if returncode != 0:
+            raise RuntimeError('Run command failed')
+        return
+
     s = os.path.join(os.path.dirname(__file__), 'pyarmor.py')
     run_command([sys.executable, s] + list(args))
 
@@ -255,6 +333,11 @@ def _pyi_makespec(hookpath, src, script, packcmd, modname='pytransform'):
     run_command(cmdlist)
 
 
+def _read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
 def _guess_encoding(filename):
     with open(filename, 'rb') as f:
         line = f.read(80)
@@ -343,6 +426,52 @@ def _patch_specfile(obfdist, src, specfile, hookpath=None, encoding=None,
     return os.path.normpath(patched_file)
 
 
+def _sync_path(src, dst, excludes=()):
+    '''Copy the changed files in the path `src` to `dst`, remove the files
+    not in `src`. The unchanged files in `dst` are kept as they are, so
+    PyInstaller needn't analysis them again. The top paths of `dst` in
+    `excludes` are ignored. Return the number of copied files.'''
+    from filecmp import cmp
+    n = 0
+    for root, dirs, files in os.walk(src):
+        path = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for x in files:
+            a, b = os.path.join(root, x), os.path.join(path, x)
+            if not (os.path.exists(b) and cmp(a, b, shallow=False)):
+                shutil.copy2(a, b)
+                n += 1
+
+    for root, dirs, files in os.walk(dst):
+        rpath = os.path.relpath(root, dst)
+        if rpath == os.curdir:
+            dirs[:] = [x for x in dirs if x not in excludes]
+        for x in files:
+            if not os.path.exists(os.path.join(src, rpath, x)):
+                logging.info('Remove obsolete file %s', x)
+                os.remove(os.path.join(root, x))
+    return n
+
+
+def _make_digest(*args):
+    from hashlib import sha256
+    return sha256(repr(args).encode('utf-8')).hexdigest()
+
+
+def _load_pack_state(filename):
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json_load(f)
+    return {}
+
+
+def _save_pack_state(filename, state):
+    from json import dump as json_dump
+    with open(filename, 'w') as f:
+        json_dump(state, f)
+
+
 def _pyinstaller(src, entry, output, options, xoptions, args):
     '''
     Args:
@@ -354,6 +483,7 @@ def _pyinstaller(src, entry, output, options, xoptions, args):
         args - cli arguments
     '''
     clean = args.clean
+    incremental = args.incremental
     licfile = args.license_file
     if licfile in ('no', 'outer') or args.no_license:
         licfile = False
@@ -391,19 +521,30 @@ def _pyinstaller(src, entry, output, options, xoptions, args):
         logging.info('Remove build path')
         shutil.rmtree(obfdist)
 
+    # In incremental mode, the scripts are obfuscated to a new path first,
+    # then only the changed ones are copied to the build path
+    obfnew = obfdist + '-new' if incremental else obfdist
+    if incremental and os.path.exists(obfnew):
+        shutil.rmtree(obfnew)
+
     logging.info('Run PyArmor to obfuscate scripts...')
     licargs = ['--with-license', licfile] if licfile else \
         ['--with-license', 'outer'] if licfile is False else []
     if hasattr(args, 'project'):
         if xoptions:
             logging.warning('Ignore xoptions as packing project')
-        call_pyarmor(['build', '-B', '-O', obfdist, '--package-runtime', '0']
+        call_pyarmor(['build', '-B', '-O', obfnew, '--package-runtime', '0']
                      + licargs + [args.project])
     else:
-        call_pyarmor(['obfuscate', '-O', obfdist, '--package-runtime', '0',
+        call_pyarmor(['obfuscate', '-O', obfnew, '--package-runtime', '0',
                       '-r', '--exclude', output]
                      + licargs + xoptions + [script])
 
+    if incremental:
+        n = _sync_path(obfnew, obfdist, excludes=['temp'])
+        logging.info('Update %d changed files in build path', n)
+        shutil.rmtree(obfnew)
+
     obftemp = os.path.join(obfdist, 'temp')
     if not os.path.exists(obftemp):
         logging.info('Create temp path: %s', obftemp)
@@ -423,7 +564,24 @@ def _pyinstaller(src, entry, output, options, xoptions, args):
     if runmodname is None:
         raise RuntimeError('No runtime module found')
 
-    if args.setup is None:
+    # The .spec file is reused if the options aren't changed, and the
+    # cache of PyInstaller is reused if any path of sys.path isn't changed
+    statefile = os.path.join(obftemp, 'pack.json')
+    state = _load_pack_state(statefile) if incremental else {}
+    patched_spec = specfile[:-5] + '-patched.spec'
+    spec_digest = _make_digest(
+        sys.executable, os.path.abspath(src), script, packcmd, runmodname,
+        supermode, os.path.abspath(obfdist),
+        _read_file(specfile) if args.setup else None)
+    deps_digest = _make_digest([(x, os.path.getmtime(x)) for x in sys.path
+                                if os.path.isdir(x)])
+    reuse = state.get('spec') == spec_digest and \
+        os.path.exists(specfile) and os.path.exists(patched_spec)
+
+    if reuse:
+        logging.info('Reuse .spec file %s', specfile)
+        hookpath = None if args.setup is None else obftemp
+    elif args.setup is None:
         logging.info('Run PyInstaller to generate .spec file...')
         _pyi_makespec(obftemp, src, script, packcmd, runmodname)
         if not os.path.exists(specfile):
@@ -441,15 +599,27 @@ def _pyinstaller(src, entry, output, options, xoptions, args):
     if not supermode:
         _make_hook_pytransform(hookfile, obfdist, encoding)
 
-    logging.info('Patching .spec file...')
-    patched_spec = _patch_specfile(obfdist, src, specfile, hookpath,
-                                   encoding, runmodname)
-    logging.info('Save patched .spec file to %s', patched_spec)
+    if reuse:
+        logging.info('Reuse patched .spec file %s', patched_spec)
+    else:
+        logging.info('Patching .spec file...')
+        patched_spec = _patch_specfile(obfdist, src, specfile, hookpath,
+                                       encoding, runmodname)
+        logging.info('Save patched .spec file to %s', patched_spec)
+
+    cleanopt = [] if reuse and state.get('deps') == deps_digest \
+        else ['--clean']
+    if not cleanopt:
+        logging.info('Reuse the cache of PyInstaller')
 
     logging.info('Run PyInstaller with patched .spec file...')
-    run_command([sys.executable] + initcmd + ['-y', '--clean', patched_spec])
+    run_command([sys.executable] + initcmd + ['-y'] + cleanopt +
+                [patched_spec])
 
-    if not args.keep:
+    if incremental:
+        _save_pack_state(statefile, dict(spec=spec_digest, deps=deps_digest))
+        logging.info('Keep build files for the next incremental packing')
+    elif not args.keep:
         if args.setup is None:
             logging.info('Remove .spec file %s', specfile)
             os.remove(specfile)
@@ -598,6 +768,9 @@ def add_arguments(parser):
                         help='Remove cached .spec file before packing')
     parser.add_argument('--keep', '--debug', dest='keep', action="store_true",
                         help='Do not remove build files after packing')
+    parser.add_argument('--incremental', action="store_true",
+                        help='Keep build files, only obfuscate the changed '
+                        'scripts and reuse .spec file in the next packing')
     parser.add_argument('entry', metavar='SCRIPT', nargs=1,
                         help='Entry script or project path')
 
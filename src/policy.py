@@ -0,0 +1,156 @@
+'''Profile guided obfuscation policy.
+
+Run a workload against the plain scripts by cProfile, find the hottest
+functions, and save them to a policy file. The policy file is a json
+file like this
+
+    {
+        "action": "exclude",
+        "functions": {
+            "pkg/server.py": ["handle", "parse_header"]
+        },
+        "profile": [
+            {"module": "pkg/server.py", "name": "handle", "line": 12,
+             "calls": 100000, "time": 0.8, "cumtime": 3.2},
+            ...
+        ]
+    }
+
+The keys of "functions" are the paths relative to the source path. When
+obfuscating the scripts with this policy, the action is
+
+    exclude: the functions are not obfuscated, they're matched by name
+    nowrap: the module is obfuscated with wrap mode 0
+
+The item "profile" is only for reference, it's not used by obfuscating.
+'''
+import json
+import logging
+import os
+import subprocess
+import sys
+
+ACTIONS = 'exclude', 'nowrap'
+
+
+def _run_profile(script, args, statsfile):
+    cmd = [sys.executable, '-m', 'cProfile', '-o', statsfile, script]
+    logging.info('Run workload: %s', ' '.join([script] + list(args)))
+    ret = subprocess.call(cmd + list(args))
+    if ret:
+        logging.warning('The workload exits with %d', ret)
+    if not os.path.exists(statsfile):
+        raise RuntimeError('No profile data generated by %s' % script)
+
+
+def _load_stats(statsfile, src):
+    from pstats import Stats
+    prefix = os.path.normcase(os.path.abspath(src)) + os.sep
+    result = []
+    for (filename, line, name), v in Stats(statsfile).stats.items():
+        filename = os.path.normcase(os.path.abspath(filename))
+        if not filename.startswith(prefix) or name.startswith('<'):
+            continue
+        result.append(dict(
+            module=filename[len(prefix):].replace('\\', '/'), name=name,
+            line=line, calls=v[1], time=v[2], cumtime=v[3]))
+    return result
+
+
+def _count_functions(src):
+    '''Return the number of functions in all the scripts of `src`.'''
+    def count(co):
+        return sum([count(x) + 1 for x in co.co_consts
+                    if hasattr(x, 'co_code')])
+
+    n = 0
+    for root, dirs, files in os.walk(src):
+        for x in files:
+            if os.path.splitext(x)[-1].lower() not in ('.py', '.pyw'):
+                continue
+            filename = os.path.join(root, x)
+            try:
+                with open(filename, 'rb') as f:
+                    n += count(compile(f.read(), filename, 'exec'))
+            except Exception as e:
+                logging.debug('Ignore %s: %s', filename, e)
+    return n
+
+
+def make_policy(script, args=(), src=None, top=10, budget=5.0,
+                action='exclude', sort='calls'):
+    '''Profile the workload `script` with `args`, return the policy of
+    the hottest functions in the path `src`.
+
+    At most `top` functions are selected, and no more than `budget`
+    percent of all the functions in `src`.'''
+    if action not in ACTIONS:
+        raise RuntimeError('Invalid policy action "%s"' % action)
+    if src is None:
+        src = os.path.dirname(os.path.abspath(script))
+
+    from tempfile import mkstemp
+    fd, statsfile = mkstemp(suffix='.prof')
+    os.close(fd)
+    os.remove(statsfile)
+    try:
+        _run_profile(script, args, statsfile)
+        stats = _load_stats(statsfile, src)
+    finally:
+        if os.path.exists(statsfile):
+            os.remove(statsfile)
+
+    total = _count_functions(src)
+    n = min(top, int(total * budget / 100))
+    if n == 0 and stats and budget > 0:
+        # The budget is less than one function in a small source path,
+        # but the hottest one should be selected still
+        n = min(top, 1)
+    logging.info('Found %d functions in %s, %d are called by workload',
+                 total, src, len(stats))
+    logging.info('Select %d hottest functions by %s, budget is %s%%',
+                 n, sort, budget)
+    if n == 0:
+        logging.warning('No function is selected, please check the workload '
+                        'and the options "--top" and "--budget"')
+
+    stats.sort(key=lambda x: (x[sort], x['cumtime']), reverse=True)
+    functions = {}
+    for x in stats[:n]:
+        logging.info('\t%s:%s %s (%d calls, %.3fs)', x['module'],
+                     x['line'], x['name'], x['calls'], x['time'])
+        names = functions.setdefault(x['module'], [])
+        if x['name'] not in names:
+            names.append(x['name'])
+
+    return dict(action=action, functions=functions, profile=stats[:100])
+
+
+def save_policy(policy, filename):
+    with open(filename, 'w') as f:
+        json.dump(policy, f, indent=2)
+
+
+def load_policy(filename):
+    if not os.path.exists(filename):
+        raise RuntimeError('No policy file %s found' % filename)
+    with open(filename) as f:
+        policy = json.load(f)
+    if policy.get('action', 'exclude') not in ACTIONS:
+        raise RuntimeError('Invalid policy action "%s" in %s'
+                           % (policy.get('action'), filename))
+    return policy
+
+
+def apply_policy(policy, name, options):
+    '''Update the obfuscating options of script `name` by the policy,
+    `name` is the path relative to the source path.'''
+    if not policy:
+        return options
+    names = policy['functions'].get(name.replace('\\', '/'))
+    if names:
+        if policy.get('action', 'exclude') == 'exclude':
+            options['excludes'] = sorted(names)
+        else:
+            options['wrap_mode'] = 0
+    return options
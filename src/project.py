@@ -36,27 +36,33 @@
 #
 #    2.0: Add license_file, bootstrap_code
 #         Remove attribute capsule
+#    2.1: Add jobs
+#    2.2: Add policy
+#    2.3: Add rules
 #
+import hashlib
 import os
 import time
-from distutils.filelist import FileList
-from distutils.text_file import TextFile
+from fnmatch import fnmatch
 from glob import glob
 from io import StringIO
 from json import dump as json_dump, load as json_load
 
 from config import config_filename, default_output_path, \
-                   default_manifest_template
+                   default_manifest_template, build_manifest_filename
 
 
 class Project(dict):
 
-    VERSION = 2, 0
+    VERSION = 2, 3
 
     OBF_MODULE_MODE = 'none', 'des', 'aes'
 
     OBF_CODE_MODE = 'none', 'fast', 'aes', 'wrap'
 
+    RULE_OPTIONS = 'obf_code', 'obf_mod', 'wrap_mode', 'restrict_mode', \
+        'advanced_mode', 'plugins'
+
     DEFAULT_VALUE = \
         ('version', '.'.join([str(x) for x in VERSION])), \
         ('name', None), \
@@ -79,10 +85,14 @@ class Project(dict):
         ('package_runtime', 1), \
         ('enable_suffix', 0), \
         ('license_file', None), \
+        ('jobs', 1), \
+        ('policy', None), \
+        ('rules', None), \
         ('build_time', 0.)
 
     def __init__(self, *args, **kwargs):
         self._path = ''
+        self._hashes = {}
         for k, v in Project.DEFAULT_VALUE:
             kwargs.setdefault(k, v)
         super(Project, self).__init__(*args, **kwargs)
@@ -98,6 +108,9 @@ class Project(dict):
             v = self[name] if name in self else None
             return v if v in ('no', 'outer') \
                 else self._format_path(v) if v else None
+        elif name == 'policy':
+            v = self.get(name)
+            return self._format_path(v) if v else None
         if name in self:
             return self[name]
         raise AttributeError(name)
@@ -128,6 +141,13 @@ class Project(dict):
             or self.license_file.endswith('license.lic'), \
             'Invalid license file'
 
+        for rule in self.get('rules') or []:
+            assert isinstance(rule, dict) and 'pattern' in rule, \
+                'Each rule must be a dict with key "pattern"'
+            for k in rule:
+                assert k == 'pattern' or k in Project.RULE_OPTIONS, \
+                    'Invalid key "%s" in the rule "%s"' % (k, rule['pattern'])
+
         if self.restrict_mode == 0 and self.license_file is not None:
             raise RuntimeError('"--restrict 0" is ignored by license file'
                                '"%s", set it to 1 if outer license is used'
@@ -177,22 +197,73 @@ class Project(dict):
             comode = self.obf_code_mode
         return Project.map_obfuscate_mode(mode, comode)
 
-    def get_build_files(self, force=False, excludes=[]):
+    def get_rule_options(self, name):
+        '''Return the options of all the rules matched by the script `name`,
+        the rules are matched in order, the later one overrides the former.'''
+        result = {}
+        name = name.replace('\\', '/')
+        for rule in self.get('rules') or []:
+            if fnmatch(name, rule['pattern']):
+                result.update([(k, v) for k, v in rule.items()
+                               if k != 'pattern'])
+        return result
+
+    def get_build_files(self, force=False, excludes=[], output=None,
+                        options=None):
+        '''Return the files need to be built again.
+
+        The build manifest saves the source hash and the options hash of
+        each file in the last build. A file is built again if any of them
+        is changed, or the output file is missing. The argument `options`
+        is a function to get the options hash of one file.
+        '''
         mlist = self.manifest.split(',') + excludes
         files = self.build_manifest(mlist, self.src)
 
-        if force:
+        manifest = self.load_build_manifest()
+        if force or manifest.get('output') != output:
             return files
 
+        records = manifest.get('files', {})
         results = []
-        buildtime = self.get('build_time', 1.)
         for x in files:
-            if os.path.getmtime(os.path.join(self.src, x)) > buildtime:
+            if records.get(x) != self.get_build_record(x, options) or \
+               not os.path.exists(os.path.join(output, x)):
                 results.append(x)
         return results
 
+    def get_removed_files(self, files):
+        '''Return the files built last time but not in the list now.'''
+        records = self.load_build_manifest().get('files', {})
+        return sorted(set(records) - set(files))
+
+    def get_build_record(self, name, options=None):
+        if name not in self._hashes:
+            with open(os.path.join(self.src, name), 'rb') as f:
+                self._hashes[name] = hashlib.sha256(f.read()).hexdigest()
+        return [self._hashes[name], options(name) if options else '']
+
+    def _build_manifest_filename(self):
+        return os.path.join(self._path, build_manifest_filename)
+
+    def load_build_manifest(self):
+        filename = self._build_manifest_filename()
+        if not os.path.exists(filename):
+            return {}
+        with open(filename, 'r') as f:
+            return json_load(f)
+
+    def save_build_manifest(self, files, output=None, options=None):
+        records = dict([(x, self.get_build_record(x, options))
+                        for x in files])
+        with open(self._build_manifest_filename(), 'w') as f:
+            json_dump(dict(output=output, files=records), f, indent=2)
+
     @classmethod
     def build_manifest(cls, manifest, path=None):
+        from distutils.filelist import FileList
+        from distutils.text_file import TextFile
+
         infile = StringIO()
         infile.write('\n'.join(manifest))
         infile.seek(0)
@@ -242,6 +313,23 @@ class Project(dict):
             lines.append('%22s: %s' % (k, v))
         return '\n'.join(lines)
 
+    def info_rules(self):
+        '''Return the effective modes of each script resolved by rules.'''
+        names = 'obf_code', 'obf_mod', 'wrap_mode', 'restrict_mode', \
+            'advanced_mode'
+        titles = 'obf_code', 'obf_mod', 'wrap', 'restrict', 'advanced'
+        lines = ['%-40s %s %s' % ('script', ' '.join([
+            x.rjust(8) for x in titles]), 'plugins')]
+        for x in sorted(self.get_build_files(True)):
+            if os.path.splitext(x)[-1].lower() not in ('.py', '.pyw'):
+                continue
+            options = dict([(k, self.get(k)) for k in Project.RULE_OPTIONS])
+            options.update(self.get_rule_options(x))
+            lines.append(('%-40s %s %s' % (x.replace('\\', '/'), ' '.join([
+                str(options[k]).rjust(8) for k in names]),
+                ','.join(options['plugins'] or []))).rstrip())
+        return '\n'.join(lines)
+
 
 if __name__ == '__main__':
     project = Project()
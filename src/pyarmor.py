@@ -29,6 +29,8 @@ bind obfuscated scripts to fixed machine or expire obfuscated scripts.
 
 '''
 
+import hashlib
+import json
 import logging
 import os
 import shutil
@@ -45,15 +47,18 @@ from config import version, version_info, purchase_info, buy_url, help_url, \
 
 
 from project import Project
+from policy import make_policy, save_policy, load_policy, apply_policy
 from utils import make_capsule, make_runtime, relpath, make_bootstrap_script,\
                   make_license_key, make_entry, show_hd_info, copy_runtime, \
                   build_path, make_project_command, get_registration_code, \
-                  pytransform_bootstrap, encrypt_script, search_plugins, \
+                  pytransform_bootstrap, obfuscate_files, search_plugins, \
                   get_platform_list, download_pytransform, update_pytransform,\
                   check_cross_platform, compatible_platform_names, \
                   get_name_suffix, get_bind_key, make_super_bootstrap, \
                   make_protection_code, DEFAULT_CAPSULE, PYARMOR_PATH, \
-                  get_product_key, is_pyscript, is_trial_version
+                  get_product_key, is_pyscript, is_trial_version, \
+                  get_obfuscated_cache, get_cache_path, obfuscate_sources, \
+                  make_bundle
 from register import activate_regcode, register_keyfile, query_keyinfo
 
 import packer
@@ -77,6 +82,24 @@ def _format_entry(entry, src):
         return ','.join(result)
 
 
+def _check_rule_modes(rule, restrict, advanced):
+    '''The modes in the rule could not change the runtime files.'''
+    n = rule.get('restrict_mode', restrict)
+    if (n == 0) != (restrict == 0):
+        raise RuntimeError('The rule "%s" could not change restrict mode '
+                           'from %s to %s' % (rule['pattern'], restrict, n))
+    n = rule.get('advanced_mode', advanced)
+    _check_advanced_value(n)
+    n = 2 if n == 5 else n
+    # The runtime is bootstrapped with advanced=1 only if advanced mode is
+    # 1, the other scripts could not enable or disable it
+    if (n == 1) != (advanced == 1) or \
+       (n in (2, 4)) != (advanced in (2, 4)) or \
+       (n in (3, 4)) != (advanced in (3, 4)):
+        raise RuntimeError('The rule "%s" could not change advanced mode '
+                           'from %s to %s' % (rule['pattern'], advanced, n))
+
+
 def _check_advanced_value(advanced):
     pyver = '.'.join([str(x) for x in sys.version_info[:2]])
     if pyver in ('2.7', '3.7', '3.8', '3.9', '3.10'):
@@ -169,6 +192,9 @@ def _config(args):
     if args.license_file is not None:
         args.license_file = _relpath(args.license_file)
         logging.info('Format license file to %s', args.license_file)
+    if args.policy:
+        args.policy = _relpath(args.policy)
+        logging.info('Format policy file to %s', args.policy)
     if args.entry:
         src = os.path.abspath(args.src) if args.src else project.src
         args.entry = _format_entry(args.entry, src)
@@ -207,6 +233,9 @@ def _info(args):
     project = Project()
     project.open(args.project)
     logging.info('Project %s information\n%s', args.project, project.info())
+    if project.get('rules'):
+        logging.info('Obfuscation modes resolved by rules\n%s',
+                     project.info_rules())
 
 
 @arcommand
@@ -311,7 +340,6 @@ def _build(args):
         else:
             excludes = []
 
-        files = project.get_build_files(args.force, excludes=excludes)
         soutput = os.path.join(output, os.path.basename(src)) \
             if project.get('is_package') else output
 
@@ -322,10 +350,6 @@ def _build(args):
         logging.info('Read product key from capsule')
         prokey = get_product_key(capsule)
 
-        logging.info('%s increment build',
-                     'Disable' if args.force else 'Enable')
-        logging.info('Search scripts from %s', src)
-
         logging.info('Obfuscate scripts with mode:')
         if hasattr(project, 'obf_mod'):
             obf_mod = project.obf_mod
@@ -354,39 +378,90 @@ def _build(args):
         entries = [build_path(s.strip(), project.src)
                    for s in project.entry.split(',')] if project.entry else []
         adv_mode = (advanced - 2) if advanced in (3, 4) else advanced
+        plugins = project.plugins if hasattr(project, 'plugins') else None
 
-        for x in sorted(files):
-            a, b = os.path.join(src, x), os.path.join(soutput, x)
-            logging.info('\t%s -> %s', x, relpath(b))
-
-            d = os.path.dirname(b)
-            if not os.path.exists(d):
-                os.makedirs(d)
+        policy = None
+        if project.policy:
+            logging.info('Use policy file: %s', project.policy)
+            policy = load_policy(project.policy)
 
-            if not is_pyscript(a):
-                shutil.copy2(a, b)
-                continue
+        rules = project.get('rules') or []
+        for rule in rules:
+            _check_rule_modes(rule, restrict, advanced)
 
-            if hasattr(project, 'plugins'):
-                plugins = search_plugins(project.plugins)
-            else:
-                plugins = None
+        def task_plugins(x):
+            return project.get_rule_options(x).get('plugins', plugins)
 
-            if entries and (os.path.abspath(a) in entries):
+        def task_options(x):
+            if entries and (os.path.abspath(os.path.join(src, x)) in entries):
                 is_entry, pcode = 1, protection
             else:
                 is_entry, pcode = 0, 0
+            rule = project.get_rule_options(x)
+            if 'advanced_mode' in rule:
+                n = rule['advanced_mode']
+                spp, n = (1, 2) if n == 5 else (False, n)
+                adv = (n - 2) if n in (3, 4) else n
+            else:
+                spp, adv = sppmode, adv_mode
+            return apply_policy(policy, x, dict(
+                obf_code=rule.get('obf_code', obf_code),
+                obf_mod=rule.get('obf_mod', obf_mod),
+                wrap_mode=rule.get('wrap_mode', wrap_mode),
+                adv_mode=adv, rest_mode=rule.get('restrict_mode', restrict),
+                entry=is_entry, protection=pcode, platforms=platforms,
+                rpath=project.runtime_path, suffix=suffix, sppmode=spp))
+
+        digest = [prokey, relative, supermode, plugins, rules]
+        allplugins = set(plugins or [])
+        for rule in rules:
+            allplugins.update(rule.get('plugins') or [])
+        for name, filename, x in search_plugins(sorted(allplugins)) or []:
+            if filename != '<plugin>':
+                with open(filename, 'rb') as f:
+                    digest.append(f.read())
+        digest = _make_build_digest(*digest)
+
+        def options_hash(x):
+            return _make_build_digest(digest, task_options(x))
+
+        logging.info('%s increment build',
+                     'Disable' if args.force else 'Enable')
+        logging.info('Search scripts from %s', src)
+        files = project.get_build_files(args.force, excludes=excludes,
+                                        output=soutput, options=options_hash)
+        allfiles = project.get_build_files(True, excludes=excludes)
+        for x in project.get_removed_files(allfiles):
+            filename = os.path.join(soutput, x)
+            if os.path.exists(filename):
+                logging.info('Remove obsolete file "%s"', relpath(filename))
+                os.remove(filename)
+
+        tasks = []
+        for x in sorted(files):
+            a, b = os.path.join(src, x), os.path.join(soutput, x)
 
-            encrypt_script(prokey, a, b, obf_code=obf_code, obf_mod=obf_mod,
-                           wrap_mode=wrap_mode, adv_mode=adv_mode,
-                           rest_mode=restrict, entry=is_entry,
-                           protection=pcode, platforms=platforms,
-                           plugins=plugins, rpath=project.runtime_path,
-                           suffix=suffix, sppmode=sppmode)
+            d = os.path.dirname(b)
+            if not os.path.exists(d):
+                os.makedirs(d)
+
+            tasks.append((x, a, b, task_plugins(x), task_options(x)))
 
-            if supermode:
+        jobs = project.get('jobs', 1) if args.jobs is None else args.jobs
+        errors = []
+        for task, error in obfuscate_files(prokey, tasks, jobs):
+            x, a, b = task[:3]
+            if error:
+                errors.append((x, error))
+            elif supermode and is_pyscript(a):
                 make_super_bootstrap(a, b, soutput, relative, suffix=suffix)
 
+        failed = set([x for x, error in errors])
+        built = [x for x in allfiles if x not in failed]
+        project.save_build_manifest(built, output=soutput,
+                                    options=options_hash)
+        _check_obfuscate_errors(errors)
+
         logging.info('%d scripts has been obfuscated', len(files))
         project['build_time'] = time.time()
         project.save(args.project)
@@ -434,6 +509,136 @@ def licenses(name='reg-001', expired=None, bind_disk=None, bind_mac=None,
     return make_license_key(capsule, fmt + name + extra_data, key=key)
 
 
+def obfuscate_many(items, output=None, advanced=0, restrict=1, wrap_mode=1,
+                   obf_code=1, obf_mod=1, plugins=None, entries=None,
+                   protection=None, bootstrap_code=1, enable_suffix=False,
+                   platforms=None, runtime=False, jobs=1, home=None,
+                   compact=False):
+    '''Obfuscate the scripts in memory without any temporary file.
+
+    `items` is an iterable of `(name, source)`, `name` is the relative
+    path in the package, for example "pkg/foo.py", `source` is string or
+    bytes. The item is kept as it is if it's not a script.
+
+    The other options are same as the command `obfuscate`, `entries` is
+    a list of names, `protection` is the protection code or the template
+    file for the entries, default is no protection code. If `compact` is
+    True, the payload of the scripts except entries is encoded in base64,
+    it only works with `restrict` 0.
+
+    If `output` is None, it returns a generator of `(name, data)`, the
+    items are obfuscated one by one when iterating. Otherwise `output`
+    could be an opened ZipFile, TarFile or a function `f(name, data)`,
+    all the items are written to it and the list of names is returned.
+
+    If `runtime` is True, the runtime package is generated and appended
+    to the items, and the cross protection code is inserted to the entries
+    unless `protection` is set. Otherwise make the runtime files by command
+    `runtime` with same `advanced`, `enable_suffix` and `platforms`.
+    '''
+    if home:
+        _set_volatile_home(home)
+    else:
+        _clean_volatile_home()
+
+    pytransform_bootstrap()
+
+    if compact and restrict:
+        raise RuntimeError('Option compact only works with restrict mode 0')
+
+    _check_advanced_value(advanced)
+    sppmode, advanced = (1, 2) if advanced == 5 else (False, advanced)
+    supermode = advanced in (2, 4)
+    vmenabled = advanced in (3, 4)
+    platforms = check_cross_platform(compatible_platform_names(platforms),
+                                     supermode, vmenabled)
+
+    capsule = DEFAULT_CAPSULE
+    if not os.path.exists(capsule):
+        make_capsule(capsule)
+    prokey = get_product_key(capsule)
+
+    suffix = get_name_suffix() if enable_suffix else ''
+    relative = True if bootstrap_code == 3 else False \
+        if bootstrap_code == 2 else False if supermode else None
+    adv_mode = (advanced - 2) if advanced in (3, 4) else advanced
+    entries = set([x.replace('\\', '/') for x in entries or []])
+
+    rfiles = []
+    if runtime:
+        from tempfile import mkdtemp
+        path = mkdtemp()
+        try:
+            checklist = make_runtime(capsule, path, platforms=platforms,
+                                     licfile=None if restrict else
+                                     'no-restrict', package=True,
+                                     suffix=suffix, supermode=supermode)
+            for root, dirs, files in os.walk(path):
+                for x in sorted(files):
+                    filename = os.path.join(root, x)
+                    with open(filename, 'rb') as f:
+                        name = relpath(filename, path).replace('\\', '/')
+                        rfiles.append((name, f.read()))
+        finally:
+            shutil.rmtree(path)
+        if protection is None:
+            protection = make_protection_code(
+                (relative, checklist, suffix),
+                multiple=len(platforms) > 1, supermode=supermode)
+
+    def build_tasks():
+        for name, source in items:
+            is_entry = name.replace('\\', '/') in entries
+            kwargs = dict(
+                wrap_mode=wrap_mode, obf_code=obf_code, obf_mod=obf_mod,
+                adv_mode=adv_mode, rest_mode=restrict, entry=is_entry,
+                protection=(is_entry and protection) or 0, suffix=suffix,
+                sppmode=sppmode, compact=compact)
+            bootstrap = dict(supermode=True, relative=relative,
+                             suffix=suffix) if supermode else \
+                dict(relative=relative, suffix=suffix, advanced=advanced) \
+                if is_entry and bootstrap_code else None
+            yield name, source, plugins, kwargs, bootstrap
+
+    from itertools import chain
+    results = chain(obfuscate_sources(prokey, build_tasks(), jobs,
+                                      sppmode=bool(sppmode)), rfiles)
+    if output is None:
+        return results
+
+    names = []
+    for name, data in results:
+        _write_archive_item(output, name, data)
+        names.append(name)
+    return names
+
+
+def obfuscate_source(source, name, **kwargs):
+    '''Obfuscate one script in memory, return the obfuscated string.
+
+    `name` is the relative path of this script in the package, the other
+    arguments are same as `obfuscate_many`.
+    '''
+    return list(obfuscate_many([(name, source)], **kwargs))[0][1]
+
+
+def _write_archive_item(output, name, data):
+    if hasattr(output, 'writestr'):
+        output.writestr(name, data)
+    elif hasattr(output, 'addfile'):
+        from tarfile import TarInfo
+        from io import BytesIO
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        info = TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = time.time()
+        output.addfile(info, BytesIO(data))
+    else:
+        output(name, data)
+
+
 @arcommand
 def _licenses(args):
     '''Generate licenses for obfuscated scripts.'''
@@ -580,6 +785,12 @@ def _obfuscate(args):
     vmenabled = advanced in (3, 4)
     restrict = args.restrict
 
+    if args.bundle and (supermode or args.in_place):
+        raise RuntimeError('Option --bundle doesn\'t work with %s'
+                           % ('super mode' if supermode else '--in-place'))
+    if args.compact and restrict:
+        raise RuntimeError('Option --compact only works with "--restrict 0"')
+
     platforms = compatible_platform_names(platforms)
     logging.info('Target platforms: %s', platforms if platforms else 'Native')
     platforms = check_cross_platform(platforms, supermode, vmenabled)
@@ -722,34 +933,53 @@ def _obfuscate(args):
                 multiple=len(platforms) > 1,
                 supermode=supermode)
 
+    policy = None
+    if args.policy:
+        logging.info('Use policy file: %s', args.policy)
+        policy = load_policy(args.policy)
+
     logging.info('Start obfuscating the scripts...')
     adv_mode = (advanced - 2) if advanced in (3, 4) else advanced
+    tasks = []
     for x in sorted(files):
         if os.path.isabs(x):
             a, b = x, os.path.join(output, os.path.basename(x))
         else:
             a, b = os.path.join(path, x), os.path.join(output, x)
-        logging.info('\t%s -> %s', x, relpath(b))
         is_entry = os.path.abspath(a) in elist
         protection = is_entry and cross_protection
-        plugins = search_plugins(args.plugins)
 
         d = os.path.dirname(b)
         if not os.path.exists(d):
             os.makedirs(d)
 
-        encrypt_script(prokey, a, b, wrap_mode=args.wrap_mode,
-                       obf_code=args.obf_code, obf_mod=args.obf_mod,
-                       adv_mode=adv_mode, rest_mode=restrict, entry=is_entry,
-                       protection=protection, platforms=platforms,
-                       plugins=plugins, suffix=suffix, sppmode=sppmode)
-
-        if supermode:
+        tasks.append((x, a, b, args.plugins, apply_policy(policy, relpath(
+            a, path), dict(
+                wrap_mode=args.wrap_mode, obf_code=args.obf_code,
+                obf_mod=args.obf_mod, adv_mode=adv_mode, rest_mode=restrict,
+                entry=is_entry, protection=protection, platforms=platforms,
+                suffix=suffix, sppmode=sppmode, compact=args.compact))))
+
+    errors = []
+    modules = []
+    for task, error in obfuscate_files(prokey, tasks, args.jobs):
+        x, a, b = task[:3]
+        if error:
+            errors.append((x, error))
+        elif supermode:
             make_super_bootstrap(a, b, output, relative, suffix=suffix)
-        elif is_entry and bootstrap:
+        elif task[-1]['entry'] and bootstrap:
             name = os.path.abspath(a)[len(path)+1:]
             make_entry(name, path, output, relative=relative, suffix=suffix,
                        advanced=advanced)
+        elif not task[-1]['entry']:
+            modules.append(relpath(b, output))
+    _check_obfuscate_errors(errors)
+
+    if args.bundle:
+        logging.info('Pack obfuscated modules to bundle file ...')
+        filename, n = make_bundle(output, modules, suffix=suffix)
+        logging.info('Pack %d modules to %s', n, relpath(filename))
 
     logging.info('Obfuscate %d scripts OK.', len(files))
 
@@ -764,39 +994,152 @@ def _check(args):
     logging.info('Check project OK.')
 
 
+def _mode_list(choices):
+    '''Return argument type for a list of modes separated by comma.'''
+    def parse(value):
+        try:
+            modes = [int(x) for x in value.split(',')]
+        except ValueError:
+            modes = None
+        if not modes or [x for x in modes if x not in choices]:
+            raise argparse.ArgumentTypeError(
+                'invalid choice: %r (choose from %s)'
+                % (value, ', '.join([str(x) for x in choices])))
+        return modes
+    return parse
+
+
 @arcommand
 def _benchmark(args):
-    '''Run benchmark test in current machine.'''
+    '''Run benchmark test in current machine.
+
+Each option of obfuscation mode could be a list separated by comma, all
+the combinations of these modes are tested one by one. For example,
+
+    pyarmor benchmark -m 1,2 -c 0,1 -O result.json
+
+Each scenario runs 5 times by default, the median and standard
+deviation of the wall time, and the cpu time are shown.
+
+Run pybench suite with the plain and obfuscated test modules:
+
+    pyarmor benchmark --pybench
+
+Compare the results with baseline, and report the scenarios which are
+slower than the baseline more than 10% by default:
+
+    pyarmor benchmark --compare baseline.json'''
+    from itertools import product
+    from platform import platform
+
+    modes = args.obf_mod, args.obf_code, args.wrap_mode, args.adv_mode, \
+        args.restrict_mode
     logging.info('Python version: %d.%d', *sys.version_info[:2])
     logging.info('Start benchmark test ...')
     logging.info('Obfuscate module mode: %s', args.obf_mod)
     logging.info('Obfuscate code mode: %s', args.obf_code)
     logging.info('Obfuscate wrap mode: %s', args.wrap_mode)
     logging.info('Obfuscate advanced value: %s', args.adv_mode)
+    logging.info('Obfuscate restrict mode: %s', args.restrict_mode)
+    logging.info('Repeat %d times after %d warmup runs',
+                 args.repeat, args.warmup)
 
-    logging.info('Benchmark bootstrap ...')
     path = os.path.normpath(os.path.dirname(__file__))
-    p = subprocess.Popen(
-        [sys.executable, 'benchmark.py', 'bootstrap', str(args.obf_mod),
-         str(args.obf_code), str(args.wrap_mode), str(args.adv_mode)],
-        cwd=path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    p.wait()
-    logging.info('Benchmark bootstrap OK.')
-
-    logging.info('Run benchmark test ...')
     benchtest = os.path.join(path, '.benchtest')
-    p = subprocess.Popen([sys.executable, 'benchmark.py'], cwd=benchtest)
-    p.wait()
+    workloads = [os.path.abspath(x) for x in args.workloads or []]
+    for x in workloads:
+        if not os.path.exists(x):
+            raise RuntimeError('No workload script %s found' % x)
+    options = ['--repeat', str(args.repeat), '--warmup', str(args.warmup)]
+    for x in workloads:
+        options.extend(['--workload', x])
+    if args.pybench:
+        options.append('--pybench')
+
+    report = dict(python='%d.%d.%d' % sys.version_info[:3],
+                  platform=platform(), version=version,
+                  repeat=args.repeat, warmup=args.warmup, results=[])
+    for m in product(*modes):
+        name = 'm%d-c%d-w%d-a%d-r%d' % m
+        logging.info('')
+        logging.info('Benchmark bootstrap with mode %s ...', name)
+        cmd = [sys.executable, 'benchmark.py', 'bootstrap']
+        p = subprocess.Popen(cmd + [str(x) for x in m] + options,
+                             cwd=path, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        output = p.communicate()[0]
+        if p.returncode:
+            logging.warning('Benchmark bootstrap failed:\n%s',
+                            output.decode())
+            continue
+        logging.info('Benchmark bootstrap OK.')
+
+        logging.info('Run benchmark test ...')
+        p = subprocess.Popen([sys.executable, 'benchmark.py', 'run',
+                              '-O', 'result.json'] + options, cwd=benchtest)
+        p.wait()
+        if p.returncode:
+            logging.warning('Benchmark test failed')
+            continue
+
+        with open(os.path.join(benchtest, 'result.json')) as f:
+            report['results'].append(dict(
+                mode=name, obf_mod=m[0], obf_code=m[1], wrap_mode=m[2],
+                advanced=m[3], restrict_mode=m[4]))
+            key = 'pybench' if args.pybench else 'scenarios'
+            report['results'][-1][key] = json.load(f)
 
     if args.debug:
         logging.info('Test scripts are saved in the path: %s', benchtest)
-    else:
+    elif os.path.exists(benchtest):
         logging.info('Remove test path: %s', benchtest)
         shutil.rmtree(benchtest)
 
+    if not report['results']:
+        raise RuntimeError('Benchmark test failed for all the modes')
+
+    if args.output:
+        logging.info('Save benchmark results to %s', args.output)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        _compare_benchmark(report, args.compare, args.threshold)
+
     logging.info('Finish benchmark test.')
 
 
+def _compare_benchmark(report, filename, threshold):
+    logging.info('Compare benchmark results with %s', filename)
+    with open(filename) as f:
+        baseline = dict([(x['mode'], x) for x in json.load(f)['results']])
+
+    def median(result):
+        x = result['obfuscated']
+        return x['wall']['median'] if 'wall' in x else x['avg']
+
+    n = 0
+    for item in report['results']:
+        if item['mode'] not in baseline:
+            logging.info('No baseline for mode %s', item['mode'])
+            continue
+        for key in ('scenarios', 'pybench'):
+            scenarios = baseline[item['mode']].get(key, {})
+            for title, result in sorted(item.get(key, {}).items()):
+                if title not in scenarios:
+                    continue
+                old, new = median(scenarios[title]), median(result)
+                if old > 0 and (new - old) * 100 / old > threshold:
+                    n += 1
+                    logging.warning('Regression %s %s: %.6f ms -> %.6f ms '
+                                    '(+%.1f%%)', item['mode'], title, old,
+                                    new, (new - old) * 100 / old)
+    if n:
+        raise RuntimeError('Found %d regressions (threshold is %s%%)'
+                           % (n, threshold))
+    logging.info('No regression found (threshold is %s%%)', threshold)
+
+
 @arcommand
 def _hdinfo(args):
     print('')
@@ -977,6 +1320,60 @@ def _runtime(args):
         logging.info('Generate bootstrap script "%s" OK', filename)
 
 
+@arcommand
+def _profile(args):
+    '''Run the workload with plain scripts, find the hottest functions and
+    save them to a policy file. The policy file is used by the option
+    "--policy" of the commands obfuscate and config.'''
+    policy = make_policy(args.script, args.args, src=args.src, top=args.top,
+                         budget=args.budget, action=args.action,
+                         sort=args.sort)
+    save_policy(policy, args.output)
+    logging.info('Save policy to %s', args.output)
+
+
+@arcommand
+def _cache(args):
+    '''Show or prune the cache of obfuscated scripts and runtime files.'''
+    cache = get_obfuscated_cache()
+    if cache is None:
+        logging.info('The cache is disabled by PYARMOR_CACHE_SIZE=0')
+        return
+
+    logging.info('Cache path: %s', get_cache_path())
+    rpath = get_cache_path('runtimes')
+    if args.action == 'prune':
+        maxsize = cache.maxsize if args.size is None else args.size << 20
+        n, size = cache.prune(maxsize)
+        logging.info('Remove %d items (%d bytes) from cache', n, size)
+        if os.path.exists(rpath):
+            logging.info('Remove all the cached runtime files')
+            shutil.rmtree(rpath)
+
+    n, size = cache.stats()
+    logging.info('Total %d items (%d bytes), limit size is %d bytes',
+                 n, size, cache.maxsize)
+    n = len(os.listdir(rpath)) if os.path.exists(rpath) else 0
+    logging.info('Total %d cached runtime packages', n)
+
+
+@arcommand
+def _serve(args):
+    '''Serve the commands obfuscate, build, licenses and runtime in a
+    long-lived process. The core library is loaded only once, and each
+    request runs in a forked process.'''
+    import server
+
+    def warmup():
+        try:
+            get_platform_list()
+        except Exception as e:
+            logging.warning('Load platform list failed: %s', e)
+        Project.build_manifest([])
+
+    server.serve(main, path=args.socket, jobs=args.jobs, warmup=warmup)
+
+
 @arcommand
 def _help(args):
     '''Display online documentation, goto man page or questions page.'''
@@ -1050,6 +1447,21 @@ def _check_runtime_license(rsettings, licfile):
     return licfile
 
 
+def _make_build_digest(*args):
+    h = hashlib.sha256()
+    for x in args:
+        h.update(x if isinstance(x, bytes)
+                 else json.dumps(x, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _check_obfuscate_errors(errors):
+    if errors:
+        for name, msg in errors:
+            logging.error('\t%s: %s', name, msg)
+        raise RuntimeError('Obfuscate %d scripts failed' % len(errors))
+
+
 def _version_info(verbose=2):
     trial = ' Trial' if is_trial_version() else ''
     ver = 'PyArmor%s Version %s' % (trial, version)
@@ -1086,6 +1498,8 @@ def _parser():
                         help='Print exception traceback and debugging message')
     parser.add_argument('--home', help='Change pyarmor home path')
     parser.add_argument('--boot', help='Change boot platform')
+    parser.add_argument('--timing', action='store_true',
+                        help='Print the time of each startup phase')
 
     subparsers = parser.add_subparsers(
         title='The most commonly used pyarmor commands are',
@@ -1158,6 +1572,19 @@ def _parser():
                        help='Specify cross protection script')
     cparser.add_argument('--in-place', action='store_true',
                          help=argparse.SUPPRESS)
+    cparser.add_argument('-j', '--jobs', type=int, metavar='N',
+                         help='Obfuscate scripts by N processes, 0 means '
+                         'the number of cpus, default is 1 or the number '
+                         'of cpus for super plus mode')
+    cparser.add_argument('--policy', metavar='FILE',
+                         help='Apply the policy file made by command '
+                         '"profile"')
+    cparser.add_argument('--bundle', action='store_true',
+                         help='Pack all the obfuscated modules except '
+                         'entry scripts to one file')
+    cparser.add_argument('--compact', action='store_true',
+                         help='Encode the payload of obfuscated scripts '
+                         'in base64 instead of hex literal')
 
     cparser.set_defaults(func=_obfuscate)
 
@@ -1303,6 +1730,12 @@ def _parser():
                          help='Make unique runtime files and bootstrap code')
     cparser.add_argument('--with-license', dest='license_file',
                          help='Use this license file other than default')
+    cparser.add_argument('--jobs', type=int, metavar='N',
+                         help='Obfuscate scripts by N processes, 0 means '
+                         'the number of cpus')
+    cparser.add_argument('--policy', metavar='FILE',
+                         help='Apply the policy file made by command '
+                         '"profile", set it to empty string to clear it')
     # cparser.add_argument('--reset', choices=('all', 'glob', 'exact'),
     #                      help='Initialize project scripts by different way')
     # cparser.add_argument('--exclude', dest="exludes", action="append",
@@ -1340,6 +1773,9 @@ def _parser():
                          help='Package runtime files or not')
     cparser.add_argument('--with-license', dest='license_file',
                          help='Use this license file other than default')
+    cparser.add_argument('-j', '--jobs', type=int, metavar='N',
+                         help='Obfuscate scripts by N processes, override '
+                         'project configuration')
     cparser.set_defaults(func=_build)
 
     #
@@ -1389,19 +1825,76 @@ def _parser():
         formatter_class=argparse.RawDescriptionHelpFormatter,
         help='Run benchmark test in current machine'
     )
-    cparser.add_argument('-m', '--obf-mod', choices=(0, 1, 2),
-                         default=2, type=int)
-    cparser.add_argument('-c', '--obf-code', choices=(0, 1, 2),
-                         default=1, type=int)
-    cparser.add_argument('-w', '--wrap-mode', choices=(0, 1),
-                         default=1, type=int)
-    cparser.add_argument('-a', '--advanced', choices=(0, 1, 2, 3, 4, 5),
-                         default=0, dest='adv_mode', type=int)
+    cparser.add_argument('-m', '--obf-mod', type=_mode_list((0, 1, 2)),
+                         default=[2], metavar='{0,1,2}')
+    cparser.add_argument('-c', '--obf-code', type=_mode_list((0, 1, 2)),
+                         default=[1], metavar='{0,1,2}')
+    cparser.add_argument('-w', '--wrap-mode', type=_mode_list((0, 1)),
+                         default=[1], metavar='{0,1}')
+    cparser.add_argument('-a', '--advanced', dest='adv_mode',
+                         type=_mode_list((0, 1, 2, 3, 4, 5)),
+                         default=[0], metavar='{0,1,2,3,4,5}')
+    cparser.add_argument('-r', '--restrict', dest='restrict_mode',
+                         type=_mode_list((0, 1, 2, 3, 4)),
+                         default=[0], metavar='{0,1,2,3,4}')
+    cparser.add_argument('--repeat', type=int, default=5,
+                         help='Run each scenario N times, default is 5')
+    cparser.add_argument('--warmup', type=int, default=1,
+                         help='Warmup runs before measuring, default is 1')
+    cparser.add_argument('--workload', dest='workloads', action='append',
+                         metavar='SCRIPT',
+                         help='Run this script as one scenario')
+    cparser.add_argument('--pybench', action='store_true',
+                         help='Run pybench suite with the plain and '
+                         'obfuscated test modules')
+    cparser.add_argument('-O', '--output', metavar='FILE',
+                         help='Save the results to this json file')
+    cparser.add_argument('--compare', metavar='FILE',
+                         help='Compare the results with this json file')
+    cparser.add_argument('--threshold', type=float, default=10,
+                         metavar='PERCENT',
+                         help='Report the scenarios slower than baseline '
+                         'more than this percent, default is 10')
     cparser.add_argument('-d', '--debug', action='store_true',
                          help='Do not clean the test scripts'
                               'generated in real time')
     cparser.set_defaults(func=_benchmark)
 
+    #
+    # Command: profile
+    #
+    cparser = subparsers.add_parser(
+        'profile',
+        epilog=_profile.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        help='Make obfuscation policy by profiling plain scripts')
+    cparser.add_argument('-O', '--output', metavar='FILE',
+                         default='pyarmor-policy.json',
+                         help='Policy file, default is "%(default)s"')
+    cparser.add_argument('-s', '--src', metavar='PATH',
+                         help='Only profile the scripts in this path, '
+                         'default is the path of workload script')
+    cparser.add_argument('-n', '--top', type=int, default=10, metavar='N',
+                         help='Select at most N hottest functions, '
+                         'default is %(default)s')
+    cparser.add_argument('-b', '--budget', type=float, default=5.0,
+                         metavar='PERCENT',
+                         help='Select no more than PERCENT of all the '
+                         'functions, default is %(default)s')
+    cparser.add_argument('--action', choices=('exclude', 'nowrap'),
+                         default='exclude',
+                         help='Do not obfuscate the hottest functions, or '
+                         'disable wrap mode for their modules')
+    cparser.add_argument('--sort', choices=('calls', 'time'),
+                         default='calls',
+                         help='Sort functions by the number of calls or the '
+                         'internal time')
+    cparser.add_argument('script', metavar='SCRIPT',
+                         help='Workload script')
+    cparser.add_argument('args', nargs=argparse.REMAINDER,
+                         help='The arguments of workload script')
+    cparser.set_defaults(func=_profile)
+
     #
     # Command: capsule
     #
@@ -1497,6 +1990,39 @@ def _parser():
                          help=argparse.SUPPRESS)
     cparser.set_defaults(func=_runtime)
 
+    #
+    # Command: cache
+    #
+    cparser = subparsers.add_parser(
+        'cache',
+        epilog=_cache.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        help='Show or prune the cache of obfuscated scripts and '
+        'runtime files')
+    cparser.add_argument('--size', type=int, metavar='MB',
+                         help='Remove the least recently used items until '
+                         'the cache is not larger than this size')
+    cparser.add_argument('action', nargs='?', default='stats',
+                         choices=('stats', 'prune'),
+                         help='Default is "%(default)s"')
+    cparser.set_defaults(func=_cache)
+
+    #
+    # Command: serve
+    #
+    cparser = subparsers.add_parser(
+        'serve',
+        epilog=_serve.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        help='Serve pyarmor commands in a long-lived process')
+    cparser.add_argument('--socket', metavar='PATH',
+                         help='Unix socket path, default is '
+                         '"~/.pyarmor/pyarmor.sock"')
+    cparser.add_argument('-j', '--jobs', type=int, metavar='N',
+                         help='Run N commands at the same time, default is '
+                         'the number of cpus')
+    cparser.set_defaults(func=_serve)
+
     #
     # Command: man
     #
@@ -1555,12 +2081,26 @@ def _clean_volatile_home():
         os.remove(licfile)
 
 
+def _report_timing(timing):
+    '''Log the time of each startup phase, the first one is the process
+    time used by Python interpreter and importing modules.'''
+    lines = ['%-12s %8.1f ms' % (timing[0][0], timing[0][1] * 1000)]
+    for (name, t), (_, t0) in zip(timing[2:], timing[1:]):
+        lines.append('%-12s %8.1f ms' % (name, (t - t0) * 1000))
+    logging.info('Timing:\n%s', '\n'.join(lines))
+
+
 def main(argv):
+    if not hasattr(time, 'process_time'):
+        time.process_time = time.clock
+    timing = [('startup', time.process_time()), ('', time.time())]
+
     parser = _parser()
     args = parser.parse_args(argv)
     if not hasattr(args, 'func'):
         parser.print_help()
         return
+    timing.append(('parse', time.time()))
 
     if args.silent:
         logging.getLogger().setLevel(100)
@@ -1580,12 +2120,21 @@ def main(argv):
         logging.info('Set boot platform: %s', args.boot)
         os.environ['PYARMOR_PLATFORM'] = args.boot
 
-    if args.func.__name__[1:] not in ('register', 'download'):
+    # These commands need not load the core library
+    if args.func.__name__[1:] not in ('register', 'download', 'cache', 'init',
+                                      'config', 'info', 'check', 'help',
+                                      'profile'):
         pytransform_bootstrap(capsule=DEFAULT_CAPSULE, force=args.boot)
+    timing.append(('bootstrap', time.time()))
 
     logging.info(_version_info(verbose=0))
     logging.info('Python %d.%d.%d', *sys.version_info[:3])
-    args.func(args)
+    try:
+        args.func(args)
+    finally:
+        if args.timing:
+            timing.append(('command', time.time()))
+            _report_timing(timing)
 
 
 def main_entry():
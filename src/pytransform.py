@@ -352,8 +352,9 @@ def _load_library(path=None, is_runtime=0, platid=None, suffix='', advanced=0):
 
 def pyarmor_init(path=None, is_runtime=0, platid=None, suffix='', advanced=0):
     global _pytransform
-    _pytransform = _load_library(path, is_runtime, platid, suffix, advanced)
-    return init_pytransform()
+    _pytransform = _call_phase('_load_library', _load_library, path,
+                               is_runtime, platid, suffix, advanced)
+    return _call_phase('init_pytransform', init_pytransform)
 
 
 def pyarmor_runtime(path=None, suffix='', advanced=0):
@@ -362,7 +363,11 @@ def pyarmor_runtime(path=None, suffix='', advanced=0):
 
     try:
         pyarmor_init(path, is_runtime=1, suffix=suffix, advanced=advanced)
-        init_runtime()
+        _call_phase('init_runtime', init_runtime)
+        filename = os.path.join(os.path.dirname(__file__),
+                                'pytransform%s.bundle' % suffix)
+        if os.path.exists(filename):
+            load_bundle(filename)
     except Exception as e:
         if sys.flags.debug or hasattr(sys, '_catch_pyarmor'):
             raise
@@ -370,6 +375,323 @@ def pyarmor_runtime(path=None, suffix='', advanced=0):
         sys.exit(1)
 
 
+#
+# Bundle, all the obfuscated modules are packed in one file
+#
+#   magic, offset of index, size of index, data of modules, index
+#
+# The index is marshaled dict: {"root": path, "modules": {name: item}}
+# The item is a tuple (offset, size, is_package, relative path)
+#
+BUNDLE_MAGIC = b'PYARMB\x00\x01'
+
+
+class BundleImporter(object):
+    '''Import the obfuscated modules from bundle file.'''
+
+    def __init__(self, filename):
+        import marshal
+        import mmap
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset, size = struct.unpack('<8sQQ', self.data[:24])
+        if magic != BUNDLE_MAGIC:
+            raise PytransformError('Invalid bundle file "%s"' % filename)
+        index = marshal.loads(self.data[offset:offset+size])
+        self.root = os.path.normpath(os.path.join(
+            os.path.dirname(os.path.abspath(filename)), index['root']))
+        self.modules = index['modules']
+
+    def get_filename(self, fullname):
+        return os.path.join(self.root, *self.modules[fullname][3].split('/'))
+
+    def is_package(self, fullname):
+        return self.modules[fullname][2]
+
+    def get_source(self, fullname):
+        return None
+
+    def get_code(self, fullname):
+        offset, size = self.modules[fullname][:2]
+        return compile(self.data[offset:offset+size],
+                       self.get_filename(fullname), 'exec')
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in self.modules:
+            return None
+        from importlib.machinery import ModuleSpec
+        origin = self.get_filename(fullname)
+        spec = ModuleSpec(fullname, self, origin=origin,
+                          is_package=self.is_package(fullname))
+        spec.has_location = True
+        if spec.submodule_search_locations is not None:
+            spec.submodule_search_locations.append(os.path.dirname(origin))
+        return spec
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+    # For Python 2
+    def find_module(self, fullname, path=None):
+        return self if fullname in self.modules else None
+
+    def load_module(self, fullname):
+        from imp import new_module
+        m = sys.modules.setdefault(fullname, new_module(fullname))
+        m.__file__ = self.get_filename(fullname)
+        m.__loader__ = self
+        if self.is_package(fullname):
+            m.__path__ = [os.path.dirname(m.__file__)]
+            m.__package__ = fullname
+        else:
+            m.__package__ = fullname.rpartition('.')[0]
+        try:
+            self.exec_module(m)
+        except BaseException:
+            sys.modules.pop(fullname, None)
+            raise
+        return sys.modules[fullname]
+
+
+def load_bundle(filename):
+    '''Insert the importer of bundle file to `sys.meta_path`.'''
+    filename = os.path.abspath(filename)
+    for x in sys.meta_path:
+        x = getattr(x, 'finder', x)
+        if isinstance(x, BundleImporter) and x.filename == filename:
+            return x
+    importer = BundleImporter(filename)
+    i = 1 if sys.meta_path and isinstance(sys.meta_path[0], _StatsHook) \
+        else 0
+    sys.meta_path.insert(i, importer)
+    return importer
+
+
+#
+# Instrumentation, enabled by `enable_stats` or environment variable
+# PYARMOR_STATS, which value is "1" or the output filename
+#
+_stats = None
+
+
+class RuntimeStats(object):
+    '''The elapsed time of runtime phases and module imports.
+
+    Each phase is a dict with keys: name, start, duration. Each module is
+    a dict with keys: name, filename, obfuscated, start, load, exec,
+    total, self. The time is in seconds, and "start" is relative to the
+    time when the stats is enabled. The "total" is the time of the
+    loader to import the module. The "load" is the time to read code
+    object, which is measured separately before the module is imported,
+    the "exec" is "total" minus "load", for obfuscated module it includes
+    the time to decrypt the code. The "self" is the total time excluding
+    the nested imports.'''
+
+    def __init__(self):
+        import threading
+        import time
+        self.timer = getattr(time, 'perf_counter', time.time)
+        self.origin = self.timer()
+        self.phases = []
+        self.modules = []
+        self._local = threading.local()
+
+    def now(self):
+        return self.timer() - self.origin
+
+    def call_phase(self, name, func, *args):
+        start = self.now()
+        try:
+            return func(*args)
+        finally:
+            self.phases.append(dict(name=name, start=start,
+                                    duration=self.now() - start))
+
+    def enter_module(self):
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append([self.now(), 0.0])
+
+    def leave_module(self, name, filename, obfuscated, load):
+        stack = self._local.stack
+        start, children = stack.pop()
+        total = self.now() - start
+        if stack:
+            stack[-1][1] += total
+        self.modules.append({
+            'name': name, 'filename': filename, 'obfuscated': obfuscated,
+            'start': start, 'load': load, 'exec': total - load,
+            'total': total, 'self': total - children})
+
+    def top(self, n=10, key='self', obfuscated=True):
+        '''Return the slowest `n` modules sorted by `key`.'''
+        modules = [x for x in self.modules
+                   if not obfuscated or x['obfuscated']]
+        return sorted(modules, key=lambda x: x[key], reverse=True)[:n]
+
+    def to_json(self):
+        return dict(pid=os.getpid(), phases=self.phases,
+                    modules=self.modules)
+
+    def to_trace(self):
+        '''Return the events in Chrome trace format.'''
+        pid = os.getpid()
+        events = []
+        for x in self.phases:
+            events.append(dict(name=x['name'], cat='runtime', ph='X',
+                               pid=pid, tid=0, ts=x['start'] * 1e6,
+                               dur=x['duration'] * 1e6))
+        for x in self.modules:
+            args = dict(filename=x['filename'], load=x['load'],
+                        obfuscated=x['obfuscated'])
+            events.append(dict(name=x['name'], cat='import', ph='X',
+                               pid=pid, tid=0, ts=x['start'] * 1e6,
+                               dur=x['total'] * 1e6, args=args))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def dump(self, filename, format='json'):
+        '''Save the stats to `filename`, format is "json" or "trace".'''
+        import json
+        data = self.to_trace() if format == 'trace' else self.to_json()
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=None if format == 'trace' else 2)
+
+
+class _StatsLoader(object):
+
+    def __init__(self, loader, stats):
+        self.loader = loader
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def exec_module(self, module):
+        loader = self.loader
+        spec = getattr(module, '__spec__', None)
+        if spec is not None and spec.loader is self:
+            spec.loader = loader
+        if getattr(module, '__loader__', None) is self:
+            module.__loader__ = loader
+
+        # The standard loaders only run the code object, so run it here
+        # instead of calling loader.exec_module, which reads it again. For
+        # the other loaders peek the source to check whether it's obfuscated
+        t = self.stats.now()
+        if _is_standard_loader(loader):
+            co = loader.get_code(module.__name__)
+            if co is None:
+                raise ImportError('cannot load module %r when get_code() '
+                                  'returns None' % module.__name__)
+            obfuscated = \
+                [x for x in co.co_names if x.startswith('__pyarmor')] != []
+        else:
+            co = None
+            source = loader.get_source(module.__name__) \
+                if hasattr(loader, 'get_source') else None
+            obfuscated = source is not None and \
+                ('\n' + source).find('\n__pyarmor') > -1
+        load = self.stats.now() - t
+
+        self.stats.enter_module()
+        try:
+            if co is None:
+                loader.exec_module(module)
+            else:
+                exec(co, module.__dict__)
+        finally:
+            self.stats.leave_module(module.__name__,
+                                    getattr(module, '__file__', None),
+                                    obfuscated, load)
+
+
+def _is_standard_loader(loader):
+    from importlib.machinery import SourceFileLoader
+    return hasattr(loader, 'get_code') and \
+        getattr(type(loader), 'exec_module', None) is \
+        SourceFileLoader.exec_module
+
+
+class _StatsFinder(object):
+    '''Wrap one finder of `sys.meta_path`, and wrap the loaders found by
+    it to record the import time of each module.'''
+
+    def __init__(self, finder, stats):
+        self.finder = finder
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.finder, name)
+
+    def __eq__(self, other):
+        return self.finder == getattr(other, 'finder', other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.finder)
+
+    def find_spec(self, fullname, path=None, target=None):
+        spec = self.finder.find_spec(fullname, path, target)
+        if spec is not None and hasattr(spec.loader, 'exec_module') \
+           and not isinstance(spec.loader, _StatsLoader):
+            spec.loader = _StatsLoader(spec.loader, self.stats)
+        return spec
+
+
+class _StatsHook(object):
+    '''The first finder of `sys.meta_path`, it finds nothing but wraps the
+    other finders in place, so each finder still runs only once for each
+    import, and the finders added later are wrapped too.'''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def find_spec(self, fullname, path=None, target=None):
+        meta_path = sys.meta_path
+        for i, finder in enumerate(meta_path):
+            if hasattr(finder, 'find_spec') and \
+               not isinstance(finder, (_StatsHook, _StatsFinder)):
+                meta_path[i] = _StatsFinder(finder, self.stats)
+
+
+def enable_stats(output=None, format='json'):
+    '''Start to record the elapsed time of runtime and module imports.
+
+    It should be called before `pyarmor_runtime`. If `output` is set,
+    the stats is saved to this file at exit. Return the stats object.'''
+    global _stats
+    if _stats is None:
+        _stats = RuntimeStats()
+        if sys.version_info[:2] >= (3, 4):
+            sys.meta_path.insert(0, _StatsHook(_stats))
+    if output:
+        import atexit
+        atexit.register(_stats.dump, output, format)
+    return _stats
+
+
+def get_stats():
+    '''Return the stats object, or None if it's not enabled.'''
+    return _stats
+
+
+def _call_phase(name, func, *args):
+    if _stats is None:
+        return func(*args)
+    return _stats.call_phase(name, func, *args)
+
+
+if os.environ.get('PYARMOR_STATS'):
+    enable_stats(None if os.environ['PYARMOR_STATS'] == '1'
+                 else os.environ['PYARMOR_STATS'],
+                 os.environ.get('PYARMOR_STATS_FORMAT', 'json'))
+
+
 # ----------------------------------------------------------
 # End of pytransform
 # ----------------------------------------------------------
@@ -0,0 +1,196 @@
+'''Serve pyarmor commands in a long-lived process.
+
+The server bootstraps the core library once, then forks one child for
+each request, so the child needn't import modules, load the library and
+platform index again. At most `jobs` requests run at the same time, the
+others wait in the queue.
+
+The protocol is one json line each direction over an unix socket. The
+request is
+
+    {"cwd": "/path/to/work", "argv": ["obfuscate", "foo.py"]}
+
+And the response is
+
+    {"returncode": 0, "output": "INFO ..."}
+
+Only the commands in `COMMANDS` are served, and the common options like
+`--home` are not allowed in `argv`.
+
+The thin client only imports standard modules, run it by
+
+    python -m pyarmor.server obfuscate foo.py
+'''
+import json
+import logging
+import os
+import socket
+import sys
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+COMMANDS = 'obfuscate', 'o', 'build', 'b', 'licenses', 'l', 'runtime'
+
+
+def default_socket():
+    home = os.getenv('PYARMOR_HOME', os.path.join('~', '.pyarmor'))
+    return os.getenv('PYARMOR_SERVER', os.path.join(
+        os.path.abspath(os.path.expanduser(home)), 'pyarmor.sock'))
+
+
+def request(argv, cwd=None, path=None):
+    '''Send one command to the server, return (returncode, output).'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path or default_socket())
+        data = dict(cwd=os.path.abspath(cwd or os.getcwd()), argv=list(argv))
+        sock.sendall(json.dumps(data).encode() + b'\n')
+        f = sock.makefile('rb')
+        try:
+            line = f.readline()
+        finally:
+            f.close()
+    finally:
+        sock.close()
+    if not line:
+        raise RuntimeError('No response from pyarmor server')
+    result = json.loads(line.decode())
+    return result['returncode'], result['output']
+
+
+def _run_command(main, req):
+    output = StringIO()
+    handler = logging.StreamHandler(output)
+    handler.setFormatter(logging.Formatter('%(levelname)-8s %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+    sys.stdout = sys.stderr = output
+
+    argv = req.get('argv', [])
+    try:
+        if not argv or argv[0] not in COMMANDS:
+            raise RuntimeError('Only these commands are served: %s'
+                               % ', '.join(COMMANDS))
+        os.chdir(req['cwd'])
+        main(argv)
+        returncode = 0
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else \
+            0 if e.code is None else 1
+    except Exception as e:
+        try:
+            msg = e.args[0] % e.args[1:]
+        except Exception:
+            msg = str(e)
+        logging.error(msg)
+        returncode = 1
+    return dict(returncode=returncode, output=output.getvalue())
+
+
+def _handle_request(main, conn):
+    f = conn.makefile('rb')
+    try:
+        req = json.loads(f.readline().decode())
+        result = _run_command(main, req)
+    except Exception as e:
+        result = dict(returncode=1, output='ERROR    %s\n' % e)
+    finally:
+        f.close()
+    conn.sendall(json.dumps(result).encode() + b'\n')
+
+
+def _check_socket(path):
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        logging.info('Remove stale socket %s', path)
+        os.remove(path)
+        return
+    finally:
+        sock.close()
+    raise RuntimeError('The server is running at %s' % path)
+
+
+def _reap_children(children):
+    while children:
+        pid = os.waitpid(-1, os.WNOHANG)[0]
+        if not pid:
+            break
+        children.discard(pid)
+
+
+def serve(main, path=None, jobs=None, warmup=None):
+    '''Listen at the unix socket `path` and run the requests by `main`.'''
+    if not (hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')):
+        raise RuntimeError('The server only works in the Unix platforms')
+
+    if jobs is None:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    path = path or default_socket()
+    _check_socket(path)
+
+    if warmup is not None:
+        warmup()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Create the socket file with mode 0600 at once, chmod after bind
+    # leaves a window in which others could connect to it
+    mask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(mask)
+    sock.listen(64)
+    # Wake up every second to reap the finished children when it's idle
+    sock.settimeout(1.0)
+    logging.info('Serve pyarmor at %s with %d jobs', path, jobs)
+
+    children = set()
+    try:
+        while True:
+            _reap_children(children)
+            try:
+                conn = sock.accept()[0]
+            except socket.timeout:
+                continue
+            conn.settimeout(None)
+            while len(children) >= jobs:
+                children.discard(os.wait()[0])
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                try:
+                    _handle_request(main, conn)
+                finally:
+                    os._exit(0)
+            conn.close()
+            children.add(pid)
+            logging.debug('Start job in the process %d', pid)
+    except KeyboardInterrupt:
+        logging.info('Server is stopped')
+    finally:
+        sock.close()
+        os.remove(path)
+
+
+def main(argv):
+    try:
+        returncode, output = request(argv)
+    except socket.error as e:
+        sys.stderr.write('Could not connect to pyarmor server %s: %s\n'
+                         % (default_socket(), e))
+        return 2
+    sys.stdout.write(output)
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
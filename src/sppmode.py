@@ -1,5 +1,6 @@
 import ast
 import logging
+import marshal
 import os
 import struct
 import sys
@@ -7,26 +8,28 @@ import sys
 from ctypes import cdll, py_object, pythonapi, PYFUNCTYPE, c_int, c_void_p
 
 _spplib = None
+_sppbuild = None
 
 
 def mixin(obfcode, sppcode=None):
+    from utils import find_payload, decode_payload, encode_payload, \
+        is_compact_payload
     n = 64
-    s = obfcode.find(r", b'") + 4
-    t = obfcode.rfind("',")
+    s, t = find_payload(obfcode)
     if sppcode is None:
         sppcode = b'\x00' * 16
 
-    oh = bytes([int('0x'+x, 16) for x in obfcode[s+2:s+n*4].split(r'\x')])
+    data = decode_payload(obfcode[s:t])
+    oh = data[:n]
     vs = struct.unpack("I", oh[36:40])[0] | 16
     nx = struct.pack("I", struct.unpack("I", oh[32:36])[0] + n)
     bh = oh[:36] + struct.pack("I", vs) + oh[40:56] + nx + oh[60:]
     ph = oh[:32] + struct.pack("I", len(sppcode)) + oh[36:]
 
-    def to_str(code):
-        return r'\x' + '\\x'.join(['%02x' % c for c in bytearray(code)])
-
-    return ''.join([obfcode[:s], to_str(bh), obfcode[s+n*4:t],
-                    to_str(ph), to_str(sppcode), obfcode[t:]])
+    payload = b''.join([bh, data[n:], ph, sppcode])
+    return ''.join([obfcode[:s],
+                    encode_payload(payload, is_compact_payload(obfcode)),
+                    obfcode[t:]])
 
 
 def _check_inline_option(source):
@@ -51,15 +54,48 @@ def build(source, modname, destname=None):
     mtree = ast.parse(source, modname)
     mtree.pyarmor_options = options
 
+    from utils import get_obfuscated_cache
+    cache = get_obfuscated_cache()
+    if cache is not None:
+        from cache import make_key
+        from config import sppmode_info
+        key = make_key('sppbuild', sppmode_info['version'], modname, options,
+                       ast.dump(mtree, include_attributes=True))
+        data = cache.get(key)
+        if data is not None:
+            logging.info('Use sppmode code object from cache')
+            return marshal.loads(data)
+
+    co = prepare(load=True)((mtree, modname))
+
+    if cache is not None:
+        try:
+            cache.put(key, marshal.dumps(co))
+        except ValueError as e:
+            logging.debug('Could not cache sppmode code object: %s', e)
+    return co
+
+
+def prepare(load=False):
+    '''Make sure sppmode library and c compiler are available. It's called
+    by the main process with `load` True before starting the workers, so
+    the library isn't downloaded and the compiler isn't checked by each
+    worker, and the error, for example, trial version, is raised at once.
+
+    If `load` is True, load the library and return the function
+    `sppbuild`, each process only loads it once.'''
     if not os.environ.get('PYARMOR_CC'):
         _check_ccompiler()
-
-    fb = _load_sppbuild()
-    return fb((mtree, modname))
+    if load:
+        return _load_sppbuild()
+    from utils import get_sppmode_files
+    get_sppmode_files()
 
 
 def _load_sppbuild():
-    global _spplib
+    global _spplib, _sppbuild
+    if _sppbuild is not None:
+        return _sppbuild
     if _spplib is None:
         from utils import get_sppmode_files
         name, licfile = get_sppmode_files()
@@ -71,10 +107,50 @@ def _load_sppbuild():
             raise RuntimeError('sppmode is not available in trial version')
         if ret != 0:
             raise RuntimeError('failed to init sppmode (%d)' % ret)
-    return PYFUNCTYPE(py_object, py_object)(('sppbuild', _spplib))
+    _sppbuild = PYFUNCTYPE(py_object, py_object)(('sppbuild', _spplib))
+    return _sppbuild
 
 
 def _check_ccompiler():
+    '''Find c compiler and set it to PYARMOR_CC. The found compiler is
+    saved in the file ".sppcc" of pyarmor home path, it's reused if
+    environment variable CC isn't changed, so no `cc --version` runs in
+    the next time.'''
+    from utils import HOME_PATH
+    ccfile = os.path.join(HOME_PATH, '.sppcc')
+    cc = _load_ccompiler(ccfile)
+    if cc is None:
+        cc = _find_ccompiler()
+        _save_ccompiler(ccfile, cc)
+    os.environ['PYARMOR_CC'] = cc
+    logging.info('Set PYARMOR_CC to "%s"', os.environ['PYARMOR_CC'])
+
+
+def _load_ccompiler(ccfile):
+    try:
+        with open(ccfile) as f:
+            env, cc = f.read().splitlines()[:2]
+    except (IOError, OSError, ValueError):
+        return
+    if env == os.environ.get('CC', '') and os.path.exists(cc):
+        return cc
+
+
+def _save_ccompiler(ccfile, cc):
+    try:
+        from shutil import which
+    except ImportError:
+        from distutils.spawn import find_executable as which
+    path = cc if os.path.isabs(cc) else which(cc)
+    if path:
+        try:
+            with open(ccfile, 'w') as f:
+                f.write('%s\n%s\n' % (os.environ.get('CC', ''), path))
+        except (IOError, OSError) as e:
+            logging.debug('Save c compiler to %s failed: %s', ccfile, e)
+
+
+def _find_ccompiler():
     from subprocess import check_output
     if sys.platform.startswith('linux'):
         cc = os.environ.get('CC', 'gcc')
@@ -93,5 +169,4 @@ def _check_ccompiler():
         check_output([cc, '--version'])
     except Exception:
         raise RuntimeError('No available c compiler found')
-    os.environ['PYARMOR_CC'] = cc
-    logging.info('Set PYARMOR_CC to "%s"', os.environ['PYARMOR_CC'])
+    return cc
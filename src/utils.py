@@ -23,7 +23,6 @@
 #
 #  All the routines of pytransform.
 #
-import hashlib
 import logging
 import os
 import re
@@ -31,23 +30,17 @@ import shutil
 import struct
 import sys
 from base64 import b64encode, b64decode
+from binascii import a2b_base64, b2a_base64, hexlify, unhexlify
 from codecs import BOM_UTF8
+from io import BytesIO, StringIO
 from glob import glob
-from json import dumps as json_dumps, loads as json_loads
-from subprocess import PIPE, Popen, check_output
 from time import gmtime, strftime
-from zipfile import ZipFile
-
-try:
-    from urllib.request import urlopen, Request
-except ImportError:
-    from urllib2 import urlopen, Request
 
 import pytransform
 from config import dll_ext, dll_name, entry_lines, protect_code_template, \
-    platform_url, platform_config, \
+    platform_url, platform_config, compact_payload, \
     core_version, capsule_filename, platform_old_urls, sppmode_info
-from sppmode import build as sppbuild, mixin as sppmixin
+from cache import ObfuscatedCache, make_key as make_cache_key
 
 PYARMOR_PATH = os.getenv('PYARMOR_PATH', os.path.dirname(__file__))
 PYARMOR_HOME = os.getenv('PYARMOR_HOME', os.path.join('~', '.pyarmor'))
@@ -61,6 +54,11 @@ DEFAULT_CAPSULE = os.path.join(HOME_PATH, capsule_filename)
 # From v6.2.0, change the location of default capsule to ~/.pyarmor/
 OLD_CAPSULE = os.path.join(HOME_PATH, '..', capsule_filename)
 
+# The parsed platform list file, refer to _get_platform_index
+_platform_index = {}
+# The sha256 of library files, refer to _get_file_digest
+_file_digests = {}
+
 FEATURE_ANTI = 1
 FEATURE_JIT = 2
 FEATURE_ADV = 4
@@ -85,6 +83,7 @@ def _search_downloaded_files(path, platid, libname):
 
 
 def pytransform_bootstrap(capsule=None, force=False):
+    from subprocess import check_output
     if pytransform._pytransform is not None and not force:
         logging.debug('No bootstrap, pytransform has been loaded')
         return
@@ -211,7 +210,47 @@ def _get_download_license_info():
     return rcode, _get_user_secret(licdata)
 
 
-def _get_remote_file(path, timeout=6.0, prefix=None):
+def _get_mirror_file(path, offset=0, timeout=6.0):
+    '''Get file from the mirror specified by PYARMOR_MIRROR, which has the
+    same layout as the cross platforms path. It may be a local path, or an
+    url starts with "file://", "http://" or "https://".'''
+    mirror = os.getenv('PYARMOR_MIRROR')
+    if re.match(r'https?://', mirror):
+        url = '/'.join([mirror.rstrip('/'), path])
+        logging.info('Getting mirror file: %s', url)
+        req = _url_request(url)
+        if offset:
+            req.add_header('Range', 'bytes=%d-' % offset)
+        return _urlopen(req, None, timeout)
+
+    if mirror.startswith('file:'):
+        try:
+            from urllib.request import url2pathname
+        except ImportError:
+            from urllib import url2pathname
+        mirror = os.path.normpath(url2pathname(mirror[5:]))
+    filename = os.path.join(mirror, *path.split('/'))
+    logging.info('Getting mirror file: %s', filename)
+    if not os.path.exists(filename):
+        raise RuntimeError('No %s found in the mirror' % path)
+    f = open(filename, 'rb')
+    f.seek(offset)
+    return f
+
+
+def _use_mirror():
+    '''Return True if PYARMOR_MIRROR is set. The trial version always gets
+    the old libraries from the remote server, the mirror is ignored.'''
+    if not os.getenv('PYARMOR_MIRROR'):
+        return False
+    if is_trial_version():
+        logging.warning('The trial version could not download files from '
+                        'the mirror %s', os.getenv('PYARMOR_MIRROR'))
+        return False
+    return True
+
+
+def _get_remote_file(path, timeout=6.0, prefix=None, offset=0):
     if is_trial_version():
         logging.warning('The trial version could not download '
                         'the latest platform library')
@@ -223,27 +262,46 @@ def _get_remote_file(path, timeout=6.0, prefix=None):
     url = '/'.join([url.format(version=core_version), path])
     logging.info('Getting remote file: %s', url)
 
-    req = Request(url)
+    req = _url_request(url)
     auth = b64encode(('%s:%s' % (rcode, secret)).encode())
     req.add_header('Authorization', 'Basic ' + auth.decode())
+    if offset:
+        req.add_header('Range', 'bytes=%d-' % offset)
     return _urlopen(req, None, timeout)
 
 
-def _get_platform_list(platid=None):
+def _get_platform_index():
+    '''Return the parsed platform list file with lookup tables by id and
+    name. It's parsed only once in one process unless the file is
+    changed.'''
+    from json import loads as json_loads
     filename = os.path.join(CROSS_PLATFORM_PATH, platform_config)
+    try:
+        st = os.stat(filename)
+        stamp = filename, st.st_size, st.st_mtime
+    except OSError:
+        stamp = None
+    if stamp is not None and _platform_index.get('stamp') == stamp:
+        return _platform_index
+
     logging.debug('Load platform list from %s', filename)
 
-    cached = os.path.exists(filename)
+    cached = stamp is not None
     if not cached:
-        res = _get_remote_file(platform_config, timeout=PYARMOR_TIMEOUT)
+        res = _get_mirror_file(platform_config, timeout=PYARMOR_TIMEOUT) \
+            if _use_mirror() else \
+            _get_remote_file(platform_config, timeout=PYARMOR_TIMEOUT)
         if res is None:
             raise RuntimeError('No platform list file %s found' % filename)
-        if not os.path.exists(CROSS_PLATFORM_PATH):
-            logging.info('Create platform path: %s' % CROSS_PLATFORM_PATH)
-            os.makedirs(CROSS_PLATFORM_PATH)
-        logging.info('Write cached platform list file %s', filename)
-        with open(filename, 'wb') as f:
-            f.write(res.read())
+        try:
+            if not os.path.exists(CROSS_PLATFORM_PATH):
+                logging.info('Create platform path: %s' % CROSS_PLATFORM_PATH)
+                os.makedirs(CROSS_PLATFORM_PATH)
+            logging.info('Write cached platform list file %s', filename)
+            with open(filename, 'wb') as f:
+                f.write(res.read())
+        finally:
+            res.close()
 
     with open(filename) as f:
         cfg = json_loads(f.read())
@@ -265,16 +323,32 @@ def _get_platform_list(platid=None):
         elif cached:
             logging.info('Remove cached platform list file %s', filename)
             os.remove(filename)
-            return _get_platform_list(platid)
+            return _get_platform_index()
 
         logging.warning('The core library excepted version is %s, '
                         'but got %s from platform list file %s',
                         core_version, ver, filename)
 
-    return cfg.get('platforms', []) if platid is None \
-        else [x for x in cfg.get('platforms', [])
-              if (platid is None
-                  or (x['id'] == platid)
+    platforms = cfg.get('platforms', [])
+    names = {}
+    for p in platforms:
+        names.setdefault(p['name'], []).append(p)
+
+    st = os.stat(filename)
+    _platform_index.clear()
+    _platform_index.update(
+        stamp=(filename, st.st_size, st.st_mtime),
+        platforms=platforms,
+        ids=dict([(p['id'], p) for p in platforms]),
+        names=names)
+    return _platform_index
+
+
+def _get_platform_list(platid=None):
+    platforms = _get_platform_index()['platforms']
+    return list(platforms) if platid is None \
+        else [x for x in platforms
+              if ((x['id'] == platid)
                   or (x['id'].find(platid + '.') == 0)
                   or (x['path'] == platid))]
 
@@ -309,34 +383,95 @@ def download_pytransform(platid, output=None, url=None, firstonly=False):
         logging.error('Cound not download library file to %s', output)
         raise RuntimeError('No write permission for target path')
 
-    for p in plist:
-        libname = p['filename']
-        path = '/'.join([p['path'], libname])
+    _download_libraries(plist, output=output, url=url)
 
-        dest = os.path.join(output, *p['id'].split('.'))
-        logging.info('Target path for %s: %s', p['id'], dest)
-        makedirs(dest, exist_ok=True)
+    return result
 
-        logging.info('Downloading library file for %s ...', p['id'])
-        res = _get_remote_file(path, timeout=PYARMOR_TIMEOUT, prefix=url)
 
-        if res is None:
-            raise RuntimeError('Download library file failed')
+def _download_library(p, output=None, url=None):
+    '''Download the library of one platform, the sha256 is calculated
+    while downloading. The data is written to a ".part" file first, next
+    time it resumes from the end of this file.'''
+    import hashlib
+    libname = p['filename']
+    dest = os.path.join(output or CROSS_PLATFORM_PATH, *p['id'].split('.'))
+    logging.info('Target path for %s: %s', p['id'], dest)
+    makedirs(dest, exist_ok=True)
+
+    target = os.path.join(dest, libname)
+    partfile = target + '.part'
+    h = hashlib.sha256()
+    offset = 0
+    if os.path.exists(partfile):
+        with open(partfile, 'rb') as f:
+            for chunk in iter(lambda: f.read(0x10000), b''):
+                h.update(chunk)
+                offset += len(chunk)
+        logging.info('Resume downloading %s from %d', p['id'], offset)
+
+    logging.info('Downloading library file for %s ...', p['id'])
+    try:
+        if url is None and _use_mirror():
+            path = '/'.join(p['id'].split('.') + [libname])
+            res = _get_mirror_file(path, offset=offset,
+                                   timeout=PYARMOR_TIMEOUT)
+        else:
+            path = '/'.join([p['path'], libname])
+            res = _get_remote_file(path, timeout=PYARMOR_TIMEOUT, prefix=url,
+                                   offset=offset)
+    except Exception as e:
+        # 416: the part file has been completed
+        if not (offset and getattr(e, 'code', None) == 416):
+            raise
+        res = BytesIO()
+
+    if res is None:
+        raise RuntimeError('Download library file failed')
+
+    if offset and hasattr(res, 'getcode') and res.getcode() != 206:
+        logging.info('Server does not support resume, download again')
+        h = hashlib.sha256()
+        offset = 0
 
-        data = res.read()
-        if hashlib.sha256(data).hexdigest() != p['sha256']:
-            raise RuntimeError('Verify dynamic library failed, try to '
-                               'reinstall the latest pyarmor and run '
-                               '"pyarmor download -u" to fix it')
-
-        target = os.path.join(dest, libname)
-        logging.info('Writing target file: %s', target)
-        with open(target, 'wb') as f:
-            f.write(data)
+    try:
+        with open(partfile, 'ab' if offset else 'wb') as f:
+            for chunk in iter(lambda: res.read(0x10000), b''):
+                h.update(chunk)
+                f.write(chunk)
+    finally:
+        res.close()
 
-        logging.info('Download dynamic library %s OK', p['id'])
+    if h.hexdigest() != p['sha256']:
+        os.remove(partfile)
+        raise RuntimeError('Verify dynamic library failed, try to '
+                           'reinstall the latest pyarmor and run '
+                           '"pyarmor download -u" to fix it')
 
-    return result
+    logging.info('Writing target file: %s', target)
+    if os.path.exists(target):
+        os.remove(target)
+    os.rename(partfile, target)
+
+    logging.info('Download dynamic library %s OK', p['id'])
+
+
+def _download_libraries(plist, output=None, url=None):
+    '''Download the libraries of all the platforms in parallel.'''
+    jobs = min(len(plist), 8)
+    if jobs < 2:
+        for p in plist:
+            _download_library(p, output=output, url=url)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    logging.info('Download %d libraries with %d threads', len(plist), jobs)
+    pool = ThreadPool(jobs)
+    try:
+        pool.map(lambda p: _download_library(p, output=output, url=url),
+                 plist)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def update_pytransform(pattern):
@@ -345,10 +480,11 @@ def update_pytransform(pattern):
         logging.info('Removed cached platform index file %s', platfile)
         os.remove(platfile)
 
-    platforms = dict([(p['id'], p) for p in _get_platform_list()])
+    platforms = _get_platform_index()['ids']
     path = os.path.join(CROSS_PLATFORM_PATH, '*', '*', '*')
-    flist = glob(os.path.join(path, '_pytransform.*')) + \
-        glob(os.path.join(path, 'py*', 'pytransform.*'))
+    flist = [x for x in glob(os.path.join(path, '_pytransform.*')) +
+             glob(os.path.join(path, 'py*', 'pytransform.*'))
+             if not x.endswith('.part')]
 
     plist = []
     n = len(CROSS_PLATFORM_PATH) + 1
@@ -360,9 +496,7 @@ def update_pytransform(pattern):
         if p is None:
             logging.warning('No %s found in supported platforms', platid)
         else:
-            with open(filename, 'rb') as f:
-                data = f.read()
-            if hashlib.sha256(data).hexdigest() == p['sha256']:
+            if _get_file_digest(filename) == p['sha256']:
                 logging.info('The platform %s has been the latest', platid)
             else:
                 plist.append(p['id'])
@@ -371,8 +505,7 @@ def update_pytransform(pattern):
         logging.info('Nothing updated')
         return
 
-    for platid in plist:
-        download_pytransform(platid)
+    _download_libraries([platforms[x] for x in plist])
     logging.info('Update library successfully')
 
 
@@ -478,6 +611,7 @@ def make_entry(entris, path, output, rpath=None, relative=None, suffix='',
 
 
 def obfuscate_scripts(filepairs, mode, capsule, output):
+    from zipfile import ZipFile
     makedirs(output, exist_ok=True)
 
     prokey = os.path.join(output, 'product.key')
@@ -518,42 +652,112 @@ def _get_library_filename(platid, checksums=None):
     #     if names:
     #         return os.path.join(path, names[0])
 
+    filename = _find_library_file(platid, checksums)
+    if filename is None:
+        download_pytransform(platid)
+        return _get_library_filename(platid, checksums)
+    return filename
+
+
+def _get_file_digest(filename):
+    '''Return the sha256 of the file. The digests are saved in the cache
+    by the path, size and modified time of the file, so the unchanged file
+    needn't be read again.'''
+    import hashlib
+    from json import loads as json_loads
+    st = os.stat(filename)
+    mtime = getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9))
+    key = '%s:%d:%d' % (os.path.abspath(filename), st.st_size, mtime)
+
+    path = get_cache_path()
+    dbfile = None if path is None else os.path.join(path, 'digests.json')
+    if dbfile and not _file_digests and os.path.exists(dbfile):
+        try:
+            with open(dbfile, 'r') as f:
+                _file_digests.update(json_loads(f.read()))
+        except Exception as e:
+            logging.debug('Load file digests failed: %s', e)
+
+    if key not in _file_digests:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(0x100000), b''):
+                h.update(chunk)
+        _file_digests[key] = h.hexdigest()
+        if dbfile:
+            for x in list(_file_digests):
+                if not os.path.exists(x.rsplit(':', 2)[0]):
+                    del _file_digests[x]
+            _save_json_file(dbfile, _file_digests)
+    return _file_digests[key]
+
+
+def _save_json_file(filename, data):
+    '''Write json file by renaming a temporary file, any error is ignored
+    because it's only used as cache.'''
+    from json import dumps as json_dumps
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(tmpname, 'w') as f:
+            f.write(json_dumps(data))
+        if os.path.exists(filename) and sys.platform == 'win32':
+            os.remove(filename)
+        os.rename(tmpname, filename)
+    except Exception as e:
+        logging.debug('Write %s failed: %s', filename, e)
+
+
+def _find_library_file(platid, checksums=None):
+    '''Return the downloaded library of this platform, or None if it's not
+    found or out of date.'''
     names = None
-    path = os.path.join(CROSS_PLATFORM_PATH, *xlist)
+    path = os.path.join(CROSS_PLATFORM_PATH, *platid.split('.'))
     if os.path.exists(path):
-        names = [x for x in os.listdir(path) if x.find('pytransform.') > -1]
+        names = [x for x in os.listdir(path)
+                 if x.find('pytransform.') > -1 and not x.endswith('.part')]
         if len(names) > 1:
             raise RuntimeError('Invalid platform data, there is more than '
                                '1 file in the path %s', path)
     if not names:
-        download_pytransform(platid)
-        return _get_library_filename(platid, checksums)
+        return None
 
     filename = os.path.join(path, names[0])
     if checksums is not None and platid in checksums:
-        with open(filename, 'rb') as f:
-            data = f.read()
-        if hashlib.sha256(data).hexdigest() != checksums[platid]:
+        if _get_file_digest(filename) != checksums[platid]:
             if hasattr(sys, '_debug_pyarmor'):
                 logging.warning('Found library %s for platform %s, but it does'
                                 ' not match this pyarmor', filename, platid)
                 return filename
             logging.info('The platform %s is out of date', platid)
-            download_pytransform(platid)
-            return _get_library_filename(platid, checksums)
+            return None
 
     return filename
 
 
 def _build_platforms(platforms):
     results = []
-    checksums = dict([(p['id'], p['sha256']) for p in _get_platform_list()])
+    plist = _get_platform_list()
+    checksums = dict([(p['id'], p['sha256']) for p in plist])
     n = len(platforms)
 
     if not os.path.exists(CROSS_PLATFORM_PATH):
         logging.info('Create cross platforms path: %s', CROSS_PLATFORM_PATH)
         os.makedirs(CROSS_PLATFORM_PATH)
 
+    # Download all the missing libraries at the same time
+    found, missing = {}, []
+    for platid in platforms:
+        if os.path.isabs(platid) or os.path.isfile(platid) or \
+           len(platid.split('.')) < 3:
+            continue
+        found[platid] = _find_library_file(platid, checksums)
+        if found[platid] is None:
+            missing.extend([p for p in plist if p not in missing and (
+                p['id'] == platid or p['id'].startswith(platid + '.'))])
+    if len(missing) > 1:
+        _download_libraries(missing)
+
     for platid in platforms:
         if (n > 1) and (os.path.isabs(platid) or os.path.isfile(platid)):
             raise RuntimeError('Invalid platform `%s`, for multiple platforms '
@@ -561,7 +765,8 @@ def _build_platforms(platforms):
         if (n > 1) and platid.startswith('vs2015.'):
             raise RuntimeError('The platform `%s` does not work '
                                'in multiple platforms target' % platid)
-        filename = _get_library_filename(platid, checksums)
+        filename = found.get(platid) or \
+            _get_library_filename(platid, checksums)
         results.append(filename)
 
     logging.debug('Target dynamic library: %s', results)
@@ -569,6 +774,7 @@ def _build_platforms(platforms):
 
 
 def _build_license_file(capsule, licfile, output=None):
+    from zipfile import ZipFile
     if licfile is None:
         myzip = ZipFile(capsule, 'r')
         try:
@@ -601,8 +807,94 @@ def _build_license_file(capsule, licfile, output=None):
     return lickey
 
 
+def _get_default_library():
+    libfile = pytransform._pytransform._name
+    if not os.path.exists(libfile):
+        libname = dll_name + dll_ext
+        libfile = os.path.join(PYARMOR_PATH, libname)
+        if not os.path.exists(libfile):
+            pname = pytransform.format_platform()
+            libpath = os.path.join(PYARMOR_PATH, 'platforms')
+            libfile = os.path.join(libpath, pname, libname)
+    return libfile
+
+
+def _make_runtime_key(capsule, licfile, platforms, *args):
+    filelist = _build_platforms(platforms) if platforms \
+        else [_get_default_library()]
+    stamps = []
+    for filename in filelist:
+        st = os.stat(filename)
+        stamps.append((os.path.abspath(filename), st.st_size, st.st_mtime))
+
+    data = []
+    for filename in (capsule, licfile):
+        if filename and os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                data.append(f.read())
+    return make_cache_key(licfile, platforms, stamps, args, *data)
+
+
+def _copy_runtime_files(src, dst):
+    for path, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(path, src))
+        makedirs(target, exist_ok=True)
+        for x in files:
+            if x != '.checklist':
+                shutil.copy2(os.path.join(path, x), os.path.join(target, x))
+
+
 def make_runtime(capsule, output, licfile=None, platforms=None, package=False,
                  suffix='', supermode=False):
+    '''Generate runtime files, return the checklist of patched libraries
+    which is used by cross protection code.
+
+    The generated files are saved in the cache path by the hash of all the
+    settings, next time they're copied from the cache directly.'''
+    from json import dumps as json_dumps, loads as json_loads
+    from tempfile import mkdtemp
+    path = get_cache_path('runtimes')
+    if path is None:
+        return _make_runtime(capsule, output, licfile=licfile,
+                             platforms=platforms, package=package,
+                             suffix=suffix, supermode=supermode)
+
+    key = _make_runtime_key(capsule, licfile, platforms, package, suffix,
+                            supermode)
+    cached = os.path.join(path, key)
+    if os.path.exists(os.path.join(cached, '.checklist')):
+        logging.info('Copying runtime files from cache %s', relpath(cached))
+    else:
+        makedirs(path, exist_ok=True)
+        tmpdir = mkdtemp(dir=path)
+        try:
+            checklist = _make_runtime(capsule, tmpdir, licfile=licfile,
+                                      platforms=platforms, package=package,
+                                      suffix=suffix, supermode=supermode)
+            with open(os.path.join(tmpdir, '.checklist'), 'w') as f:
+                f.write(json_dumps(checklist))
+        except Exception:
+            shutil.rmtree(tmpdir)
+            raise
+        try:
+            os.rename(tmpdir, cached)
+            logging.info('Save runtime files to cache %s', relpath(cached))
+        except OSError:
+            # Another process has saved the same runtime files
+            cached = tmpdir
+
+    try:
+        with open(os.path.join(cached, '.checklist'), 'r') as f:
+            checklist = json_loads(f.read())
+        _copy_runtime_files(cached, output)
+    finally:
+        if cached != os.path.join(path, key):
+            shutil.rmtree(cached)
+    return checklist
+
+
+def _make_runtime(capsule, output, licfile=None, platforms=None,
+                  package=False, suffix='', supermode=False):
     if supermode:
         return _make_super_runtime(capsule, output, platforms, licfile=licfile,
                                    suffix=suffix)
@@ -631,14 +923,7 @@ def make_runtime(capsule, output, licfile=None, platforms=None, package=False,
         checklist.append(sum(bytearray(data)))
 
     if not platforms:
-        libfile = pytransform._pytransform._name
-        if not os.path.exists(libfile):
-            libname = dll_name + dll_ext
-            libfile = os.path.join(PYARMOR_PATH, libname)
-            if not os.path.exists(libfile):
-                pname = pytransform.format_platform()
-                libpath = os.path.join(PYARMOR_PATH, 'platforms')
-                libfile = os.path.join(libpath, pname, libname)
+        libfile = _get_default_library()
         logging.info('Copying %s', libfile)
         copy3(libfile, output)
 
@@ -741,6 +1026,7 @@ def copy_runtime(path, output, licfile=None, dryrun=False):
 
 
 def make_license_key(capsule, code, output=None, key=None, legency=0):
+    from zipfile import ZipFile
     prikey = ZipFile(capsule, 'r').read('private.key') \
         if key is None else key
     size = len(prikey) if not legency else -len(prikey)
@@ -952,19 +1238,35 @@ def _frozen_modname(filename, filename2):
 
 def _guess_encoding(filename):
     with open(filename, 'rb') as f:
-        line = f.read(80)
-        if line and line[:3] == BOM_UTF8:
-            return 'utf-8'
-        if line and line[0] == 35:
-            n = line.find(b'\n')
-            m = re.search(r'coding[=:]\s*([-\w.]+)', line[:n].decode())
-            if m:
-                return m.group(1)
-            if n > -1 and len(line) > (n+1) and line[n+1] == 35:
-                k = n + 1
-                n = line.find(b'\n', k)
-                m = re.search(r'coding[=:]\s*([-\w.]+)', line[k:n].decode())
-                return m and m.group(1)
+        return _guess_source_encoding(f.read(80))
+
+
+def _guess_source_encoding(line):
+    if line and line[:3] == BOM_UTF8:
+        return 'utf-8'
+    if line and line[0] == 35:
+        n = line.find(b'\n')
+        m = re.search(r'coding[=:]\s*([-\w.]+)', line[:n].decode())
+        if m:
+            return m.group(1)
+        if n > -1 and len(line) > (n+1) and line[n+1] == 35:
+            k = n + 1
+            n = line.find(b'\n', k)
+            m = re.search(r'coding[=:]\s*([-\w.]+)', line[k:n].decode())
+            return m and m.group(1)
+
+
+def _strip_bom(lines, encoding):
+    # Try to remove any UTF BOM bytes
+    if encoding == 'utf-8' and lines:
+        i = 0
+        for c in lines[0]:
+            if ord(c) < 128:
+                break
+            i += 1
+        if i:
+            lines[0] = lines[0][i:]
+    return lines
 
 
 def _readlines(filename):
@@ -980,23 +1282,42 @@ def _readlines(filename):
             encoding = 'utf-8'
             with open(filename, 'r', encoding=encoding) as f:
                 lines = f.readlines()
-        # Try to remove any UTF BOM bytes
-        if encoding == 'utf-8' and lines:
-            i = 0
-            for c in lines[0]:
-                if ord(c) < 128:
-                    break
-                i += 1
-            if i:
-                lines[0] = lines[0][i:]
+        _strip_bom(lines, encoding)
     return lines
 
 
-def encrypt_script(pubkey, filename, destname, wrap_mode=1, obf_code=1,
-                   obf_mod=1, adv_mode=0, rest_mode=1, entry=0, protection=0,
-                   platforms=None, plugins=None, rpath=None, suffix='',
-                   sppmode=False):
-    lines = _readlines(filename)
+def _splitlines(source):
+    '''Same as `_readlines`, but the source is string or bytes.'''
+    if sys.version_info[0] == 2:
+        return source.splitlines(True)
+    encoding = None
+    if isinstance(source, bytes):
+        encoding = _guess_source_encoding(source[:80])
+        try:
+            source = source.decode(encoding or 'utf-8')
+        except UnicodeDecodeError:
+            encoding = 'utf-8'
+            source = source.decode(encoding)
+    return _strip_bom(StringIO(source, newline=None).readlines(), encoding)
+
+
+def get_cache_path(name=''):
+    '''Return the cache path, or None if the cache is disabled by setting
+    PYARMOR_CACHE_SIZE to 0.'''
+    if int(os.getenv('PYARMOR_CACHE_SIZE', '512')) > 0:
+        path = os.getenv('PYARMOR_CACHE', os.path.join(HOME_PATH, 'cache'))
+        return os.path.abspath(os.path.join(os.path.expanduser(path), name))
+
+
+def get_obfuscated_cache():
+    path = get_cache_path('scripts')
+    if path is not None:
+        size = int(os.getenv('PYARMOR_CACHE_SIZE', '512'))
+        return ObfuscatedCache(path, size << 20)
+
+
+def _patch_script(lines, plugins=None, protection=0):
+    '''Insert plugins and protection code to the lines of script.'''
     if plugins:
         n = 0
         k = -1
@@ -1046,29 +1367,59 @@ def encrypt_script(pubkey, filename, destname, wrap_mode=1, obf_code=1,
                 break
             n += 1
 
-    if hasattr(sys, '_debug_pyarmor') and (protection or plugins):
-        patched_script = filename + '.pyarmor-patched'
-        logging.info('Write patched script for debugging: %s', patched_script)
-        with open(patched_script, 'w') as f:
-            f.write(''.join(lines))
+    return lines
+
+
+def find_payload(s):
+    '''Return the start and end position of the payload in the obfuscated
+    script `s`, the payload is the third argument of `__pyarmor__`.'''
+    i = s.find('__file__, ')
+    if i == -1:
+        raise RuntimeError('No payload found in the obfuscated script')
+    i += len('__file__, ')
+    return i, s.find(', ', i)
 
-    modname = _frozen_modname(filename, destname)
+
+def decode_payload(payload):
+    '''Return the bytes of payload in hex literal or compact format.
+
+    The helper scripts merge.py and buildext.py have their own copy of
+    this function, because they could be run alone.'''
+    prefix = compact_payload.split('%s')[0]
+    if payload.startswith(prefix):
+        return a2b_base64(payload[len(prefix):-2])
+    if payload.startswith("b'\\x"):
+        return unhexlify(payload[2:-1].replace('\\x', ''))
+    return eval(payload)
+
+
+def encode_payload(data, compact=False):
+    '''Return the payload of bytes `data` in hex literal or compact format.
+    The compact one is about 3 times smaller than hex literal.'''
+    if compact:
+        return compact_payload % b2a_base64(data).decode().strip()
+    return "b'%s'" % re.sub('(..)', r'\\x\1', hexlify(data).decode())
+
+
+def is_compact_payload(s):
+    return s.find(compact_payload.split('%s')[0]) > 0
+
+
+def compact_script(s):
+    '''Convert the payload of the obfuscated script `s` to compact format.'''
+    i, j = find_payload(s)
+    return s[:i] + encode_payload(decode_payload(s[i:j]), True) + s[j:]
+
+
+def _encrypt_lines(pubkey, lines, modname, wrap_mode=1, obf_code=1,
+                   obf_mod=1, adv_mode=0, rest_mode=1, entry=0,
+                   suffix='', sppmode=False, excludes=None, compact=False):
+    import hashlib
+    from sppmode import build as sppbuild, mixin as sppmixin
     if sppmode:
         if sys.version_info[0] * 100 + sys.version_info[1] < 307:
             raise RuntimeError('This Python version is not supported by spp '
                                'mode, only Python 3.7+ works')
-        co = sppbuild(''.join(lines), modname, destname)
-        if not co:
-            logging.info('Ignore this module because of %s',
-                         'sppmode inline option' if co is False else
-                         'no any function available for sppmode')
-            sppmode = False
-            co = compile(''.join(lines), modname, 'exec')
-    else:
-        co = compile(''.join(lines), modname, 'exec')
-
-    if (adv_mode & 0x7) > 1 and sys.version_info[0] > 2 and not sppmode:
-        co = _check_code_object_for_super_mode(co, lines, modname)
 
     if rest_mode > 100:
         if sum(sys.version_info[:2]) < 10:
@@ -1080,22 +1431,335 @@ def encrypt_script(pubkey, filename, destname, wrap_mode=1, obf_code=1,
     else:
         rest_mod_dict_flag = 0
 
+    # The bootstrap code of entry script is checked by cross protection
+    compact = compact and not entry
+
     flags = obf_code | obf_mod << 8 | (wrap_mode | (adv_mode << 4)) << 16 | \
         ((0xB4 if rest_mode == 5 else 0xB0 if rest_mode == 4
           else 0xF0 if rest_mode == 3 else 0x70 if rest_mode == 2
           else 0x10 if rest_mode else 0)
          | (8 if entry else 0) | rest_mod_dict_flag) << 24
-    s = pytransform.encrypt_code_object(pubkey, co, flags, suffix=suffix)
 
+    cache = get_obfuscated_cache()
+    if cache is not None:
+        key = make_cache_key(''.join(lines), modname, flags,
+                             hashlib.sha256(pubkey).hexdigest(), suffix,
+                             sppmode, excludes)
+        data = cache.get(key)
+        if data is not None:
+            logging.info('Use obfuscated script from cache')
+            return compact_script(data.decode()) if compact \
+                else data.decode()
+
+    if sppmode:
+        co = sppbuild(''.join(lines), modname)
+        if not co:
+            logging.info('Ignore this module because of %s',
+                         'sppmode inline option' if co is False else
+                         'no any function available for sppmode')
+            sppmode = False
+            co = compile(''.join(lines), modname, 'exec')
+    else:
+        co = compile(''.join(lines), modname, 'exec')
+
+    if (adv_mode & 0x7) > 1 and sys.version_info[0] > 2 and not sppmode:
+        co = _check_code_object_for_super_mode(co, lines, modname)
+
+    if excludes:
+        logging.info('Exclude functions: %s', ', '.join(excludes))
+        exclude_functions(','.join(excludes))
+    try:
+        s = pytransform.encrypt_code_object(pubkey, co, flags, suffix=suffix)
+    finally:
+        if excludes:
+            exclude_functions()
+    s = sppmixin(s.decode()) if sppmode else s.decode()
+
+    if cache is not None:
+        cache.put(key, s.encode())
+    return compact_script(s) if compact else s
+
+
+def encrypt_script(pubkey, filename, destname, wrap_mode=1, obf_code=1,
+                   obf_mod=1, adv_mode=0, rest_mode=1, entry=0, protection=0,
+                   platforms=None, plugins=None, rpath=None, suffix='',
+                   sppmode=False, excludes=None, compact=False):
+    lines = _patch_script(_readlines(filename), plugins, protection)
+
+    if hasattr(sys, '_debug_pyarmor') and (protection or plugins):
+        patched_script = filename + '.pyarmor-patched'
+        logging.info('Write patched script for debugging: %s', patched_script)
+        with open(patched_script, 'w') as f:
+            f.write(''.join(lines))
+
+    s = _encrypt_lines(pubkey, lines, _frozen_modname(filename, destname),
+                       wrap_mode=wrap_mode, obf_code=obf_code,
+                       obf_mod=obf_mod, adv_mode=adv_mode,
+                       rest_mode=rest_mode, entry=entry, suffix=suffix,
+                       sppmode=sppmode, excludes=excludes, compact=compact)
     with open(destname, 'w') as f:
-        f.write(sppmixin(s.decode()) if sppmode else s.decode())
+        f.write(s)
+
+
+def encrypt_source(pubkey, source, modname, protection=0, plugins=None,
+                   **kwargs):
+    '''Same as `encrypt_script`, but the script is string or bytes, and
+    the obfuscated script is returned as string.
+
+    `modname` is the filename of code object, for example "<frozen foo>".
+    '''
+    lines = _patch_script(_splitlines(source), plugins, protection)
+    return _encrypt_lines(pubkey, lines, modname, **kwargs)
+
+
+def _format_error(e):
+    try:
+        return e.args[0] % e.args[1:]
+    except Exception:
+        return str(e)
+
+
+def _run_obfuscate_task(pubkey, task):
+    name, filename, destname, plugins, kwargs = task
+    logging.info('\t%s -> %s', name, relpath(destname))
+    try:
+        if is_pyscript(filename):
+            encrypt_script(pubkey, filename, destname,
+                           plugins=search_plugins(plugins), **kwargs)
+        else:
+            shutil.copy2(filename, destname)
+    except Exception as e:
+        if hasattr(sys, '_debug_pyarmor'):
+            raise
+        return _format_error(e)
+
+
+class _LogCollector(logging.Handler):
+    '''Keep the log records of one worker, the parent process will
+    replay them in the order of tasks.'''
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+_worker_context = {}
+
+
+def _init_obfuscate_worker(pubkey, level, sppmode=False):
+    from sppmode import prepare as sppprepare
+    collector = _LogCollector()
+    root = logging.getLogger()
+    root.handlers[:] = [collector]
+    root.setLevel(level)
+
+    # Do not raise exception here, the pool will start new worker again
+    # and again, instead return the error by each task
+    try:
+        pytransform_bootstrap()
+        if sppmode:
+            sppprepare(load=True)
+        error = None
+    except Exception as e:
+        error = _format_error(e)
+    collector.records = []
+
+    _worker_context['pubkey'] = pubkey
+    _worker_context['collector'] = collector
+    _worker_context['error'] = error
+
+
+def _obfuscate_worker(task):
+    collector = _worker_context['collector']
+    collector.records = []
+    error = _worker_context['error'] or \
+        _run_obfuscate_task(_worker_context['pubkey'], task)
+    return collector.records, error
+
+
+def obfuscate_files(pubkey, tasks, jobs=1):
+    '''Obfuscate the scripts or copy the other files to output path.
+
+    Each task is a tuple `(name, filename, destname, plugins, kwargs)`,
+    `kwargs` are the extra arguments of `encrypt_script`. The parent
+    path of `destname` must exist.
+
+    If `jobs` is greater than 1, the tasks are run in a process pool, 0
+    means the number of cpus. The log of each task is replayed by the
+    parent process, so the output is same as running them one by one.
+    If `jobs` is None, it's 0 when any task uses sppmode, otherwise 1.
+
+    It yields `(task, error)` in the order of tasks, `error` is None if
+    the task is done, otherwise it's the error message. It doesn't stop
+    on the first failed task.
+    '''
+    from sppmode import prepare as sppprepare
+    sppmode = any([x[-1].get('sppmode') for x in tasks])
+    if jobs is None:
+        jobs = 0 if sppmode else 1
+    if jobs == 0:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    jobs = min(jobs, len(tasks))
+
+    if jobs < 2:
+        for task in tasks:
+            yield task, _run_obfuscate_task(pubkey, task)
+    else:
+        from multiprocessing import Pool
+        logging.info('Obfuscate scripts with %d processes', jobs)
+        if sppmode:
+            sppprepare(load=True)
+        level = logging.getLogger().getEffectiveLevel()
+        chunksize = max(1, min(16, len(tasks) // (jobs * 4)))
+        pool = Pool(jobs, _init_obfuscate_worker, (pubkey, level, sppmode))
+        try:
+            results = pool.imap(_obfuscate_worker, tasks, chunksize)
+            for task, (records, error) in zip(tasks, results):
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                yield task, error
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    if tasks:
+        _prune_obfuscated_cache()
+
+
+def _prune_obfuscated_cache():
+    cache = get_obfuscated_cache()
+    if cache is not None:
+        n, size = cache.autoprune()
+        if n:
+            logging.info('Remove %d items (%d bytes) from cache', n, size)
+
+
+def _source_modname(name):
+    '''Return the filename of code object for the script `name`, it's the
+    relative path in the package, "pkg/__init__.py" is "<frozen pkg>".'''
+    names = name.replace('\\', '/').strip('/').split('/')
+    if names[-1] == '__init__.py' and len(names) > 1:
+        names.pop()
+    else:
+        names[-1] = names[-1][:-3]
+    return '<frozen %s>' % '.'.join(names)
+
+
+def _insert_bootstrap_code(name, source, code, supermode=False,
+                           relative=None, suffix='', advanced=0):
+    '''Same as `make_super_bootstrap` or `make_entry`, but insert bootstrap
+    code to the obfuscated string `code` of the script `name`.'''
+    names = name.replace('\\', '/').strip('/').split('/')
+    pkg = names[-1] == '__init__.py'
+    if supermode:
+        level = '.' * len(names) if (relative is True) or \
+            ((relative is None) and pkg) else ''
+        lines = ['from %spytransform%s import pyarmor\n' % (level, suffix)]
+    else:
+        paras = ['suffix=%s' % repr(suffix)] if suffix else []
+        if advanced:
+            paras.append('advanced=1')
+        lines = [entry_lines[0] % ('.' if (relative is True) or (
+            (relative is None) and pkg) else '', suffix),
+                 entry_lines[1] % ', '.join(paras)]
+
+    head = source[:60]
+    head = head if isinstance(head, bytes) else head.encode('utf-8')
+    if head[:2] == b'#!' and head.find(b'\n') > 0:
+        lines.insert(0, head[:head.find(b'\n')+1].decode('utf-8'))
+    lines.append(code)
+    return ''.join(lines)
+
+
+def _run_source_task(pubkey, task):
+    name, source, plugins, kwargs, bootstrap = task
+    logging.info('\t%s', name)
+    if not is_pyscript(name):
+        return name, source, None
+    try:
+        code = encrypt_source(pubkey, source, _source_modname(name),
+                              plugins=search_plugins(plugins), **kwargs)
+        if bootstrap is not None:
+            code = _insert_bootstrap_code(name, source, code, **bootstrap)
+    except Exception as e:
+        if hasattr(sys, '_debug_pyarmor'):
+            raise
+        return name, None, _format_error(e)
+    return name, code, None
+
+
+def _source_worker(task):
+    collector = _worker_context['collector']
+    collector.records = []
+    error = _worker_context['error']
+    result = (task[0], None, error) if error else \
+        _run_source_task(_worker_context['pubkey'], task)
+    return collector.records, result
+
+
+def obfuscate_sources(pubkey, tasks, jobs=1, sppmode=False):
+    '''Same as `obfuscate_files`, but obfuscate the scripts in memory.
+
+    Each task is a tuple `(name, source, plugins, kwargs, bootstrap)`,
+    `name` is the relative path of script in the package, `source` is
+    string or bytes, `kwargs` are the extra arguments of `encrypt_source`.
+    If `bootstrap` is not None, it's a dict of the arguments to insert
+    the bootstrap code. The file which is not script is kept as it is.
+
+    The tasks could be any iterable, they're read one by one. It yields
+    `(name, data)` in the order of tasks, and raises RuntimeError on the
+    first failed task. If any task uses sppmode, `sppmode` should be True
+    so that each worker prepares sppmode only once.
+    '''
+    from sppmode import prepare as sppprepare
+    if jobs == 0:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+
+    if jobs < 2:
+        pool = None
+        results = (([], _run_source_task(pubkey, x)) for x in tasks)
+    else:
+        from multiprocessing import Pool
+        logging.info('Obfuscate scripts with %d processes', jobs)
+        if sppmode:
+            sppprepare(load=True)
+        level = logging.getLogger().getEffectiveLevel()
+        pool = Pool(jobs, _init_obfuscate_worker, (pubkey, level, sppmode))
+        results = pool.imap(_source_worker, tasks, 4)
+
+    try:
+        for records, (name, data, error) in results:
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            if error:
+                raise RuntimeError('Obfuscate "%s" failed: %s'
+                                   % (name, error))
+            yield name, data
+        if pool is not None:
+            pool.close()
+        _prune_obfuscated_cache()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
 
 def get_product_key(capsule):
+    from zipfile import ZipFile
     return ZipFile(capsule).read('product.key')
 
 
 def upgrade_capsule(capsule):
+    from zipfile import ZipFile
     myzip = ZipFile(capsule, 'r')
     try:
         if 'pytransform.key' in myzip.namelist():
@@ -1120,6 +1784,7 @@ def upgrade_capsule(capsule):
 
 
 def load_config(filename):
+    from json import loads as json_loads
     if os.path.exists(filename):
         with open(filename, 'r') as f:
             cfg = json_loads(f.read())
@@ -1129,6 +1794,7 @@ def load_config(filename):
 
 
 def save_config(cfg, filename=None):
+    from json import dumps as json_dumps
     s = json_dumps(cfg, indent=2)
     with open(filename, 'w') as f:
         f.write(s)
@@ -1143,6 +1809,7 @@ def relpath(path, start=os.curdir):
 
 
 def _reboot_pytransform(platid):
+    from subprocess import Popen
     os.putenv('PYARMOR_PLATFORM', platid)
     if sys.platform == 'win32' and sys.argv[0].endswith('pyarmor'):
         p = Popen(sys.argv)
@@ -1180,7 +1847,7 @@ def _get_preferred_platid(platname, features=None):
     if '8' in features or '11' in features or '25' in features:
         pyver = 'py%d%d' % sys.version_info[:2]
 
-    plist = [x['id'] for x in _get_platform_list() if x['name'] == name]
+    plist = [x['id'] for x in _get_platform_index()['names'].get(name, [])]
     for platid in plist:
         ns = [str(x) for x in platid.split('.')]
         if (features is None or str(ns[2]) in features) \
@@ -1332,6 +1999,63 @@ def get_bind_key(filename):
     return sum(struct.unpack(fmt, buf[:size*4]))
 
 
+def make_bundle(output, names, suffix=''):
+    '''Pack the obfuscated scripts `names` in the path `output` to one
+    bundle file, then remove them. The names are relative to `output`,
+    the bundle file is saved in the runtime path. Return the bundle file
+    and the number of packed scripts.'''
+    import marshal
+
+    # If the output path is a package, for example, "dist/mypkg", the
+    # modules in it are imported as "mypkg.foo", and "mypkg/__init__.py"
+    # is kept to find this package
+    prefix = []
+    if os.path.exists(os.path.join(output, '__init__.py')):
+        prefix = [os.path.basename(os.path.abspath(output))]
+        if not re.match(r'^[A-Za-z_]\w*$', prefix[0]):
+            raise RuntimeError('The output path "%s" is a package, but "%s" '
+                               'is not a valid package name'
+                               % (output, prefix[0]))
+
+    runtime = os.path.join(output, 'pytransform' + suffix)
+    if not os.path.exists(os.path.join(runtime, '__init__.py')):
+        runtime = output
+        if not os.path.exists(os.path.join(output, 'pytransform%s.py'
+                                           % suffix)):
+            logging.warning('No runtime files found in %s, the bundle file '
+                            'should be moved to the runtime path', output)
+    filename = os.path.join(runtime, 'pytransform%s.bundle' % suffix)
+
+    modules = {}
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<8sQQ', pytransform.BUNDLE_MAGIC, 0, 0))
+        for name in sorted(names):
+            name = name.replace('\\', '/')
+            parts = os.path.splitext(name)[0].split('/')
+            pkg = parts[-1] == '__init__'
+            if pkg:
+                parts.pop()
+            if not parts or [x for x in parts if not re.match(
+                    r'^[A-Za-z_]\w*$', x)]:
+                logging.info('Keep %s out of bundle', name)
+                continue
+            with open(os.path.join(output, name), 'rb') as fs:
+                data = fs.read()
+            modules['.'.join(prefix + parts)] = f.tell(), len(data), pkg, name
+            f.write(data)
+        offset = f.tell()
+        root = os.path.relpath(output, runtime).replace('\\', '/')
+        index = marshal.dumps(dict(root=root, modules=modules), 2)
+        f.write(index)
+        f.seek(0)
+        f.write(struct.pack('<8sQQ', pytransform.BUNDLE_MAGIC, offset,
+                            len(index)))
+
+    for x in modules.values():
+        os.remove(os.path.join(output, x[3]))
+    return filename, len(modules)
+
+
 def make_super_bootstrap(source, filename, output, relative=None, suffix=''):
     pkg = os.path.basename(filename) == '__init__.py'
     level = ''
@@ -1356,12 +2080,79 @@ def make_super_bootstrap(source, filename, output, relative=None, suffix=''):
         f.write(''.join(lines))
 
 
+def _read_extension_header(data, offset, big_endian=False):
+    if offset + 32 <= len(data):
+        fmt = '>8I' if big_endian else '<8I'
+        header = struct.unpack(fmt, bytes(data[offset:offset+32]))
+        if header[0] == 0x0f007060 and sum(header[2:]) in (912, 1452):
+            return header
+
+
+def _search_extension_offsets(data):
+    '''Return the offset of key area, byte order and the offsets of all
+    the suffix markers in the library.'''
+    for patkey, big_endian in ((b'\x60\x70\x00\x0f', False),
+                               (b'\x0f\x00\x70\x60', True)):
+        i = data.find(patkey)
+        while i > -1:
+            if _read_extension_header(data, i, big_endian):
+                break
+            i = data.find(patkey, i + 1)
+        else:
+            continue
+        break
+    else:
+        raise RuntimeError('Invalid extension, no data found')
+
+    markers = []
+    k = data.find(b'_vax_000000')
+    while k > -1:
+        markers.append(k)
+        k = data.find(b'_vax_000000', k + 1)
+
+    return i, big_endian, markers
+
+
+def _get_extension_offsets(data):
+    '''Same as _search_extension_offsets, but the result is saved in the
+    cache by the sha256 of the library, so it needn't search next time.'''
+    import hashlib
+    from json import loads as json_loads
+    path = get_cache_path()
+    if path is None:
+        return _search_extension_offsets(data)
+
+    key = hashlib.sha256(data).hexdigest()
+    filename = os.path.join(path, 'patch-offsets.json')
+    try:
+        with open(filename, 'r') as f:
+            offsets = json_loads(f.read())
+    except Exception:
+        offsets = {}
+
+    if key in offsets:
+        i, big_endian, markers = offsets[key]
+        if _read_extension_header(data, i, big_endian):
+            return i, big_endian, markers
+
+    result = _search_extension_offsets(data)
+    offsets[key] = result
+    _save_json_file(filename, offsets)
+    return result
+
+
 def _patch_extension(filename, keylist, suffix='', supermode=True):
     logging.debug('Patching %s', relpath(filename))
-    patkey = b'\x60\x70\x00\x0f'
-    patlen = len(patkey)
     sizelist = [len(x) for x in keylist]
-    big_endian = False
+
+    with open(filename, 'rb') as f:
+        data = bytearray(f.read())
+
+    i, big_endian, markers = _get_extension_offsets(data)
+    logging.debug('Found pattern at %x', i)
+    max_size = _read_extension_header(data, i, big_endian)[1]
+    if sum(sizelist) > max_size:
+        raise RuntimeError('Too much license data')
 
     def write_integer(data, offset, value):
         if big_endian:
@@ -1374,40 +2165,6 @@ def _patch_extension(filename, keylist, suffix='', supermode=True):
             offset += step
             value >>= 8
 
-    with open(filename, 'rb') as f:
-        data = bytearray(f.read())
-
-    n = len(data)
-    for i in range(n):
-        if data[i:i+patlen] == patkey:
-            fmt = 'I' * 8
-            header = struct.unpack(fmt, bytes(data[i:i+32]))
-            if sum(header[2:]) not in (912, 1452):
-                continue
-            logging.debug('Found pattern at %x', i)
-            max_size = header[1]
-            if sum(sizelist) > max_size:
-                raise RuntimeError('Too much license data')
-
-            break
-    else:
-        # Maybe big endian
-        patkey = b'\x0f\x00\x70\x60'
-        for i in range(n):
-            if data[i:i+patlen] == patkey:
-                fmt = 'I' * 8
-                header = struct.unpack('>' + fmt, bytes(data[i:i+32]))
-                if sum(header[2:]) not in (912, 1452):
-                    continue
-                logging.debug('Found pattern at %x', i)
-                max_size = header[1]
-                if sum(sizelist) > max_size:
-                    raise RuntimeError('Too much license data')
-                big_endian = True
-                break
-        else:
-            raise RuntimeError('Invalid extension, no data found')
-
     write_integer(data, i + 12, sizelist[0])
     write_integer(data, i + 16, sizelist[0])
     write_integer(data, i + 20, sizelist[1])
@@ -1423,12 +2180,10 @@ def _patch_extension(filename, keylist, suffix='', supermode=True):
             offset += size
 
     if suffix:
-        marker = bytes(b'_vax_000000')
-        k = len(marker)
-        for i in range(n):
-            if data[i:i+k] == marker:
-                logging.debug('Found marker at %x', i)
-                data[i:i+k] = bytes(suffix.encode())
+        marker = bytes(suffix.encode())
+        for k in reversed(markers):
+            logging.debug('Found marker at %x', k)
+            data[k:k+11] = marker
 
         if supermode and data[0] == 0x7f and data[1:4] == b'ELF':
             if not _fix_up_gnu_hash(data, suffix):
@@ -1445,6 +2200,7 @@ def _patch_extension(filename, keylist, suffix='', supermode=True):
 
 
 def _build_keylist(capsule, licfile):
+    from zipfile import ZipFile
     myzip = ZipFile(capsule, 'r')
     if 'pytransform.key' not in myzip.namelist():
         raise RuntimeError('No pytransform.key found in capsule')
@@ -1644,7 +2400,19 @@ def _check_code_object_for_super_mode(co, lines, name):
     return co
 
 
+def _url_request(url):
+    try:
+        from urllib.request import Request
+    except ImportError:
+        from urllib2 import Request
+    return Request(url)
+
+
 def _urlopen(*args, **kwargs):
+    try:
+        from urllib.request import urlopen
+    except ImportError:
+        from urllib2 import urlopen
     try:
         return urlopen(*args, **kwargs)
     except Exception:
@@ -1712,6 +2480,7 @@ def exclude_functions(names=''):
 
 
 def get_sppmode_files(timeout=None):
+    import hashlib
     licfile = os.path.join(HOME_PATH, 'license.lic')
     sppver = sppmode_info['version']
     spplatforms = sppmode_info['platforms']
@@ -1740,7 +2509,7 @@ def get_sppmode_files(timeout=None):
         logging.info('Getting remote file: %s', url)
 
         timeout = PYARMOR_TIMEOUT if timeout is None else timeout
-        req = Request(url)
+        req = _url_request(url)
         auth = b64encode(('%s:%s' % (rcode, secret)).encode())
         req.add_header('Authorization', 'Basic ' + auth.decode())
         res = _urlopen(req, None, timeout)
@@ -1765,6 +2534,7 @@ def get_sppmode_files(timeout=None):
 
 
 def sign_binary(filename):
+    from subprocess import PIPE, Popen, check_output
     if not sys.platform.startswith('darwin'):
         return
 
@@ -1793,6 +2563,7 @@ def osx_is_universal_platforms(platforms):
 
 
 def osx_merge_binary(target, *filelist):
+    from subprocess import PIPE, Popen
     cmdlist = ['lipo', '-create', '-output', target]
     for filename in filelist:
         arch = os.path.basename(filename).split('.')[1]
@@ -285,6 +285,25 @@ check_return_value
 check_file_content $dist/result.log 'Got data: def protect_pytransform'
 check_file_content $dist/result.log 'aaaaaaaaaa' not
 
+$PYTHON -m helper.build_data_module --chunk 100 protect_code2.pt \
+        > protect_chunk.py
+cat <<EOF > safechunk.py
+import protect_chunk
+with protect_chunk.Safebytes(4, 20) as buf:
+    print('Got range: %s' % buf.decode())
+n = sum([len(x) for x in protect_chunk.iterchunks()])
+print('Got size: %s' % (n == protect_chunk.size))
+EOF
+
+$PYARMOR obfuscate --exact -O $dist safechunk.py >result.log 2>&1
+$PYARMOR obfuscate --exact -O $dist --no-runtime --no-bootstrap \
+         --restrict 4 protect_chunk.py >result.log 2>&1
+
+(cd $dist; $PYTHON safechunk.py >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log 'Got range: protect_pytransform'
+check_file_content $dist/result.log 'Got size: True'
+
 csih_inform "20. Obfuscate scripts with --runtime"
 dist=test-with-runtime
 $PYARMOR obfuscate --runtime test-runtime-suffix -O $dist \
@@ -589,6 +589,109 @@ cat $dist/foo-c-45.py >> $dist/foo.py
 check_return_value
 check_file_content $dist/result.log "Outer license OK"
 
+csih_inform "C-46. Test obfuscate command with --jobs"
+dist=test-c-46
+$PYARMOR obfuscate --jobs 2 -r -O $dist examples/testpkg/main.py \
+         >result.log 2>&1
+check_return_value
+check_file_exists $dist/mypkg/foo.py
+check_file_content $dist/mypkg/foo.py '__pyarmor__(__name__'
+
+(cd $dist; $PYTHON main.py >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log "Hello! PyArmor Test Case"
+
+csih_inform "C-47. Test obfuscate command with cache"
+dist=test-c-47
+export PYARMOR_CACHE=$(pwd)/pyarmor-cache
+$PYARMOR obfuscate -O $dist examples/simple/queens.py >result.log 2>&1
+check_return_value
+
+$PYARMOR obfuscate -O $dist examples/simple/queens.py >result.log 2>&1
+check_return_value
+check_file_content result.log 'Use obfuscated script from cache'
+
+(cd $dist; $PYTHON queens.py >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log 'Found 92 solutions'
+
+$PYARMOR cache prune --size 0 >result.log 2>&1
+check_return_value
+check_file_content result.log 'Total 0 items'
+unset PYARMOR_CACHE
+
+csih_inform "C-48. Test profile command and obfuscate with policy"
+dist=test-c-48
+$PYARMOR profile -O $dist.json -n 3 examples/simple/queens.py >result.log 2>&1
+check_return_value
+check_file_content $dist.json '"functions"'
+
+$PYARMOR obfuscate --policy $dist.json -O $dist examples/simple/queens.py >result.log 2>&1
+check_return_value
+check_file_content result.log 'Exclude functions'
+
+(cd $dist; $PYTHON queens.py >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log 'Found 92 solutions'
+
+csih_inform "C-49. Test obfuscate scripts with option --bundle"
+dist=test-c-49
+$PYARMOR obfuscate -r --bundle -O $dist examples/testpkg/main.py >result.log 2>&1
+check_return_value
+check_file_content result.log 'Pack 2 modules to'
+check_file_exists $dist/pytransform/pytransform.bundle
+check_file_not_exists $dist/mypkg/foo.py
+
+(cd $dist; $PYTHON main.py >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log 'Hello'
+
+csih_inform "C-50. Test obfuscate scripts with option --compact"
+dist=test-c-50
+$PYARMOR obfuscate -r --compact -O $dist examples/testpkg/main.py >result.log 2>&1
+check_file_content result.log 'Option --compact only works with "--restrict 0"'
+check_file_not_exists $dist/mypkg/foo.py
+
+$PYARMOR obfuscate -r --compact --restrict 0 -O $dist \
+         examples/testpkg/main.py >result.log 2>&1
+check_return_value
+check_file_content $dist/mypkg/foo.py "__import__('binascii').a2b_base64('"
+check_file_content $dist/main.py "__import__('binascii')" not
+
+(cd $dist; $PYTHON main.py >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log 'Hello'
+
+csih_inform "C-51. Test building compact script to extension"
+dist=test-c-51
+$PYARMOR obfuscate -r --compact --no-cross-protection --restrict 0 \
+         -O $dist examples/testpkg/main.py >result.log 2>&1
+check_return_value
+check_file_content $dist/mypkg/foo.py "__import__('binascii').a2b_base64('"
+
+$PYTHON helper/buildext.py -i $dist/mypkg/foo.py >result.log 2>&1
+check_return_value
+check_file_not_exists $dist/mypkg/foo.py
+
+(cd $dist; $PYTHON main.py >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log 'Hello'
+
+csih_inform "C-52. Test obfuscate package with option --bundle"
+dist=test-c-52
+$PYARMOR obfuscate --bundle -O $dist/mypkg \
+         examples/testpkg/mypkg/__init__.py >result.log 2>&1
+check_return_value
+check_file_content result.log 'Pack 1 modules to'
+check_file_exists $dist/mypkg/pytransform/pytransform.bundle
+check_file_exists $dist/mypkg/__init__.py
+check_file_not_exists $dist/mypkg/foo.py
+
+(cd $dist; $PYTHON -c "import mypkg; mypkg.proxy_hello('Bundle')" \
+                   >result.log 2>&1)
+check_return_value
+check_file_content $dist/result.log 'Hello! Bundle'
+
 echo ""
 echo "-------------------- Command End -----------------------------"
 echo ""
@@ -1119,6 +1222,46 @@ check_return_value
 (cd $PROPATH/dist; $PYTHON queens.py >result.log 2>&1)
 check_file_content $PROPATH/dist/result.log 'Found 92 solutions'
 
+csih_inform "Case P-18: increment build project by content hash"
+PROPATH=projects/test-increment-build
+mkdir -p $PROPATH/src
+echo "print('Hello')" > $PROPATH/src/foo.py
+echo "print('World')" > $PROPATH/src/bar.py
+$PYARMOR init --src=$PROPATH/src --entry foo.py $PROPATH  >result.log 2>&1
+(cd $PROPATH; $ARMOR build >result.log 2>&1)
+check_return_value
+check_file_exists $PROPATH/.pyarmor_manifest
+
+touch $PROPATH/src/foo.py
+(cd $PROPATH; $ARMOR build >result.log 2>&1)
+check_return_value
+check_file_content $PROPATH/result.log '0 scripts has been obfuscated'
+
+rm $PROPATH/src/bar.py
+(cd $PROPATH; $ARMOR build >result.log 2>&1)
+check_return_value
+check_file_not_exists $PROPATH/dist/bar.py
+check_file_exists $PROPATH/dist/foo.py
+
+csih_inform "Case P-19: build project with per-path rules"
+PROPATH=projects/test-rules
+mkdir -p $PROPATH/src/core
+echo "print('Hello')" > $PROPATH/src/foo.py
+echo "def add(a, b): return a + b" > $PROPATH/src/core/fast.py
+$PYARMOR init --src=$PROPATH/src --entry foo.py $PROPATH  >result.log 2>&1
+$PYTHON -c "import json
+p = '$PROPATH/.pyarmor_config'
+d = json.load(open(p))
+d['rules'] = [{'pattern': 'core/*.py', 'obf_code': 0, 'wrap_mode': 0}]
+json.dump(d, open(p, 'w'))"
+$PYARMOR info $PROPATH >result.log 2>&1
+check_return_value
+check_file_content result.log 'core/fast.py                                    0        2        0'
+
+(cd $PROPATH; $ARMOR build >result.log 2>&1)
+check_return_value
+check_file_exists $PROPATH/dist/core/fast.py
+
 echo ""
 echo "-------------------- Test Project End ------------------------"
 echo ""
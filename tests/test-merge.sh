@@ -146,6 +146,27 @@ check_file_content $dist/result2.log 'Found 92 solutions'
 
 fi
 
+csih_inform "3. Merge scripts with compact payload"
+dist=merged_compact_dist
+$PYARMOR1 obfuscate -r --compact --restrict 0 -O compact_dist1 \
+    examples/testpkg/main.py >result.log 2>&1
+$PYARMOR2 obfuscate -r --compact --restrict 0 -O compact_dist2 \
+    examples/testpkg/main.py >result.log 2>&1
+${PYTHON} helper/merge.py -O $dist \
+          compact_dist1 compact_dist2 >result.log 2>&1
+check_return_value
+check_file_content $dist/mypkg/foo.py "__import__('binascii').a2b_base64('"
+
+csih_inform "run merged script by $PYTHON1"
+(cd $dist; $PYTHON1 main.py >result1.log 2>&1)
+check_return_value
+check_file_content $dist/result1.log 'Hello'
+
+csih_inform "run merged script by $PYTHON2"
+(cd $dist; $PYTHON2 main.py >result2.log 2>&1)
+check_return_value
+check_file_content $dist/result2.log 'Hello'
+
 # ======================================================================
 #
 # Finished and cleanup.
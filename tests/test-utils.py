@@ -0,0 +1,1221 @@
+# -*- coding: utf-8 -*-
+#
+# Unit tests of the routines which need not the core library, run it in
+# the path "tests"
+#
+#     python test-utils.py
+#
+import hashlib
+import json
+import logging
+import os
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import pathname2url
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import pathname2url
+
+srcpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, os.path.normpath(srcpath))
+
+import config
+import server
+import sppmode
+import utils
+
+
+def make_library(elf=True, markers=2, big_endian=False):
+    '''Make a fake runtime library with key area, suffix markers and the
+    gnu hash table of PyInit_pytransform/initpytransform.'''
+    arr = [0] * 0x200
+    for i, key in ((40, 0xb4239787), (80, 0xe746a6ab)):
+        arr[i] = key
+        arr[i-12], arr[i-10], arr[i-9] = 3, 1, 6
+    data = bytearray(struct.pack('I' * len(arr), *arr))
+    if elf:
+        data[:4] = b'\x7fELF'
+
+    fmt = '>8I' if big_endian else '<8I'
+    header = struct.pack(fmt, 0x0f007060, 1024, 100, 200, 300, 112, 100, 100)
+    data.extend(b'\x00' * 64 + header + b'\x00' * 1024)
+    for i in range(markers):
+        data.extend(b'PyInit_pytransform_vax_000000\x00' + b'\x01' * 99)
+    return data
+
+
+def old_patch_extension(data, keylist, suffix='', supermode=True):
+    '''The implementation of _patch_extension in v7.5.0.'''
+    data = bytearray(data)
+    patkey = b'\x60\x70\x00\x0f'
+    patlen = len(patkey)
+    sizelist = [len(x) for x in keylist]
+    big_endian = []
+
+    def write_integer(data, offset, value):
+        if big_endian:
+            offset += 3
+            step = -1
+        else:
+            step = 1
+        for i in range(4):
+            data[offset] = value & 0xFF
+            offset += step
+            value >>= 8
+
+    n = len(data)
+    for i in range(n):
+        if data[i:i+patlen] == patkey:
+            header = struct.unpack('I' * 8, bytes(data[i:i+32]))
+            if sum(header[2:]) in (912, 1452):
+                break
+    else:
+        patkey = b'\x0f\x00\x70\x60'
+        for i in range(n):
+            if data[i:i+patlen] == patkey:
+                header = struct.unpack('>' + 'I' * 8, bytes(data[i:i+32]))
+                if sum(header[2:]) in (912, 1452):
+                    big_endian.append(True)
+                    break
+        else:
+            raise RuntimeError('Invalid extension, no data found')
+
+    write_integer(data, i + 12, sizelist[0])
+    write_integer(data, i + 16, sizelist[0])
+    write_integer(data, i + 20, sizelist[1])
+    write_integer(data, i + 24, sizelist[0] + sizelist[1])
+    write_integer(data, i + 28, sizelist[2])
+
+    offset = i + 32
+    for j in range(3):
+        size = sizelist[j]
+        if size:
+            data[offset:offset+size] = keylist[j]
+            offset += size
+
+    if suffix:
+        marker = bytes(b'_vax_000000')
+        k = len(marker)
+        for i in range(n):
+            if data[i:i+k] == marker:
+                data[i:i+k] = bytes(suffix.encode())
+
+        if supermode and data[0] == 0x7f and data[1:4] == b'ELF':
+            if not utils._fix_up_gnu_hash(data, suffix):
+                raise RuntimeError('Failed to add symbol suffix')
+
+    return data
+
+
+class BaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workpath = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['PYARMOR_CACHE'] = os.path.join(self.workpath, 'cache')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.workpath)
+
+
+class PatchExtensionTestCases(BaseTestCase):
+
+    keylist = b'a' * 100, b'b' * 200, b'c' * 300
+
+    def patch(self, data, suffix='', supermode=True):
+        filename = os.path.join(self.workpath, 'pytransform.so')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        utils._patch_extension(filename, self.keylist, suffix, supermode)
+        with open(filename, 'rb') as f:
+            return bytearray(f.read())
+
+    def check_patch(self, data, suffix='', supermode=True):
+        expected = old_patch_extension(data, self.keylist, suffix, supermode)
+        self.assertEqual(self.patch(data, suffix, supermode), expected)
+        # The second time the offsets come from the cache
+        self.assertEqual(self.patch(data, suffix, supermode), expected)
+        return expected
+
+    def test_super_mode_without_suffix(self):
+        data = make_library()
+        result = self.check_patch(data)
+        self.assertEqual(result[:0x800], data[:0x800])
+
+    def test_super_mode_with_suffix(self):
+        data = make_library()
+        result = self.check_patch(data, suffix='_vax_000001')
+        self.assertNotEqual(result[:0x800], data[:0x800])
+        self.assertEqual(result.count(b'_vax_000001'), 2)
+
+    def test_not_super_mode(self):
+        data = make_library()
+        self.check_patch(data, supermode=False)
+        self.check_patch(data, suffix='_vax_000001', supermode=False)
+
+    def test_not_elf(self):
+        data = make_library(elf=False)
+        self.check_patch(data)
+        self.check_patch(data, suffix='_vax_000001', supermode=False)
+
+    def test_big_endian(self):
+        data = make_library(elf=False, markers=0, big_endian=True)
+        self.check_patch(data, supermode=False)
+
+    def test_no_key_area(self):
+        data = make_library()[:0x800]
+        self.assertRaises(RuntimeError, self.patch, data)
+
+
+class ObfuscateWorkerTestCases(BaseTestCase):
+
+    def setUp(self):
+        super(ObfuscateWorkerTestCases, self).setUp()
+        self.patched = sppmode.prepare, utils.pytransform_bootstrap
+        self.pid = os.getpid()
+        utils.pytransform_bootstrap = lambda *args: None
+        # Avoid hanging forever if the pool restarts the workers again and
+        # again
+        if hasattr(signal, 'alarm'):
+            signal.alarm(60)
+
+    def tearDown(self):
+        if hasattr(signal, 'alarm'):
+            signal.alarm(0)
+        sppmode.prepare, utils.pytransform_bootstrap = self.patched
+        super(ObfuscateWorkerTestCases, self).tearDown()
+
+    def sppprepare(self, load=False):
+        raise RuntimeError('sppmode is not available in trial version')
+
+    def sppprepare_in_worker(self, load=False):
+        if os.getpid() != self.pid:
+            raise RuntimeError('sppmode is not available in trial version')
+
+    def make_tasks(self, n=4):
+        return [('foo%d.py' % i, 'foo%d.py' % i, 'dist/foo%d.py' % i, [],
+                 dict(sppmode=True)) for i in range(n)]
+
+    def test_obfuscate_files_trial(self):
+        sppmode.prepare = self.sppprepare
+        tasks = self.make_tasks()
+        self.assertRaises(RuntimeError, list,
+                          utils.obfuscate_files(None, tasks, jobs=2))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_obfuscate_files_worker_error(self):
+        sppmode.prepare = self.sppprepare_in_worker
+        tasks = self.make_tasks()
+        result = list(utils.obfuscate_files(None, tasks, jobs=2))
+        self.assertEqual([x[0] for x in result], tasks)
+        for task, error in result:
+            self.assertTrue(error.find('trial version') > 0)
+
+    def test_obfuscate_sources_trial(self):
+        sppmode.prepare = self.sppprepare
+        tasks = [('foo.py', 'print(1)', [], {}, None)]
+        self.assertRaises(RuntimeError, list, utils.obfuscate_sources(
+            None, tasks, jobs=2, sppmode=True))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+    def test_obfuscate_sources_worker_error(self):
+        sppmode.prepare = self.sppprepare_in_worker
+        tasks = [('foo.py', 'print(1)', [], {}, None)]
+        try:
+            list(utils.obfuscate_sources(None, tasks, jobs=2, sppmode=True))
+        except RuntimeError as e:
+            self.assertTrue(str(e).find('trial version') > 0)
+        else:
+            self.fail('No error raised')
+
+
+
+class LibraryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        rng = self.headers.get('Range')
+        server.requests.append((self.path, rng))
+        server.active += 1
+        server.max_active = max(server.active, server.max_active)
+        try:
+            time.sleep(0.1)
+            self.send_file(rng if server.ranges else None)
+        finally:
+            server.active -= 1
+
+    def send_file(self, rng):
+        path = self.path.strip('/').split('/')
+        filename = os.path.join(self.server.root, *path)
+        if not os.path.isfile(filename):
+            self.send_error(404)
+            return
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if rng:
+            start = int(rng[6:].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class LibraryServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, root):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), LibraryHandler)
+        self.root = root
+        self.ranges = True
+        self.requests = []
+        self.active = self.max_active = 0
+
+
+class DownloadLibraryTestCases(BaseTestCase):
+
+    platids = 'test.x86_64.7', 'test.x86_64.11.py38', 'test.x86_64.11.py39'
+
+    def setUp(self):
+        super(DownloadLibraryTestCases, self).setUp()
+        self.mirror = os.path.join(self.workpath, 'mirror')
+        self.output = os.path.join(self.workpath, 'platforms')
+        self.libs = {}
+        platforms = []
+        for platid in self.platids:
+            data = os.urandom(0x30000)
+            path = os.path.join(self.mirror, *platid.split('.'))
+            os.makedirs(path)
+            with open(os.path.join(path, '_pytransform.so'), 'wb') as f:
+                f.write(data)
+            self.libs[platid] = data
+            platforms.append(dict(
+                id=platid, name=platid, path=platid.replace('.', '/'),
+                filename='_pytransform.so',
+                sha256=hashlib.sha256(data).hexdigest()))
+        with open(os.path.join(self.mirror, 'index.json'), 'w') as f:
+            json.dump(dict(version=config.core_version,
+                           platforms=platforms), f)
+
+        self.server = LibraryServer(self.mirror)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        os.environ['PYARMOR_MIRROR'] = 'http://127.0.0.1:%d' % \
+            self.server.server_address[1]
+
+        self.patched = utils.CROSS_PLATFORM_PATH, utils.is_trial_version, \
+            utils._get_old_remote_file
+        utils.CROSS_PLATFORM_PATH = self.output
+        utils.is_trial_version = lambda: False
+        utils._platform_index.clear()
+        utils._file_digests.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        utils.CROSS_PLATFORM_PATH, utils.is_trial_version, \
+            utils._get_old_remote_file = self.patched
+        utils._platform_index.clear()
+        utils._file_digests.clear()
+        super(DownloadLibraryTestCases, self).tearDown()
+
+    def target(self, platid):
+        path = os.path.join(self.output, *platid.split('.'))
+        return os.path.join(path, '_pytransform.so')
+
+    def check_library(self, platid):
+        with open(self.target(platid), 'rb') as f:
+            self.assertEqual(f.read(), self.libs[platid])
+        self.assertFalse(os.path.exists(self.target(platid) + '.part'))
+
+    def make_part_file(self, platid, size):
+        os.makedirs(os.path.dirname(self.target(platid)))
+        with open(self.target(platid) + '.part', 'wb') as f:
+            f.write(self.libs[platid][:size])
+
+    def test_download_in_parallel(self):
+        result = utils.download_pytransform('test.x86_64', self.output)
+        self.assertEqual(result, list(self.platids))
+        for platid in self.platids:
+            self.check_library(platid)
+        self.assertTrue(self.server.max_active > 1)
+
+    def test_resume(self):
+        platid = self.platids[1]
+        self.make_part_file(platid, 0x10000)
+        utils.download_pytransform(platid, self.output)
+        self.check_library(platid)
+        self.assertEqual(self.server.requests[-1][1], 'bytes=65536-')
+
+    def test_resume_completed_part_file(self):
+        platid = self.platids[1]
+        self.make_part_file(platid, 0x30000)
+        utils.download_pytransform(platid, self.output)
+        self.check_library(platid)
+
+    def test_resume_not_supported(self):
+        self.server.ranges = False
+        platid = self.platids[1]
+        self.make_part_file(platid, 0x10000)
+        utils.download_pytransform(platid, self.output)
+        self.check_library(platid)
+
+    def test_verify_failed(self):
+        platid = self.platids[1]
+        self.make_part_file(platid, 0x10000)
+        with open(self.target(platid) + '.part', 'ab') as f:
+            f.write(b'x')
+        self.assertRaises(RuntimeError, utils.download_pytransform,
+                          platid, self.output)
+        self.assertFalse(os.path.exists(self.target(platid) + '.part'))
+
+    def test_file_mirror(self):
+        os.environ['PYARMOR_MIRROR'] = 'file:' + pathname2url(self.mirror)
+        platid = self.platids[0]
+        self.make_part_file(platid, 0x10000)
+        utils.download_pytransform('test.x86_64', self.output)
+        for platid in self.platids:
+            self.check_library(platid)
+        self.assertEqual(self.server.requests, [])
+
+    def test_trial_version(self):
+        paths = []
+
+        def get_old_remote_file(path, timeout=6.0):
+            paths.append(path)
+            return open(os.path.join(self.mirror, *path.split('/')), 'rb')
+
+        utils.is_trial_version = lambda: True
+        utils._get_old_remote_file = get_old_remote_file
+        platid = self.platids[1]
+        utils.download_pytransform(platid, self.output)
+        self.check_library(platid)
+        self.assertEqual(paths, ['index.json', platid.replace('.', '/') +
+                                 '/_pytransform.so'])
+        self.assertEqual(self.server.requests, [])
+
+    def test_ignore_part_file(self):
+        platid = self.platids[1]
+        utils.download_pytransform(platid, self.output)
+        with open(self.target(platid) + '.part', 'wb') as f:
+            f.write(b'x')
+        self.assertEqual(utils._find_library_file(platid),
+                         self.target(platid))
+        checksums = {platid: hashlib.sha256(self.libs[platid]).hexdigest()}
+        self.assertEqual(utils._find_library_file(platid, checksums),
+                         self.target(platid))
+
+
+
+from helper import merge
+
+
+def make_payload(ver, size=100):
+    header = bytearray(64)
+    header[9:11] = bytearray(ver)
+    return bytes(header) + os.urandom(size)
+
+
+def make_obfuscated_script(payload, compact=False):
+    return '\n'.join([
+        '# pyarmor',
+        'from pytransform import pyarmor_runtime',
+        '__pyarmor__(__name__, __file__, %s, 2)' %
+        utils.encode_payload(payload, compact),
+        ''])
+
+
+class CompactPayloadTestCases(BaseTestCase):
+
+    def write_script(self, filename, data):
+        filename = os.path.join(self.workpath, filename)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(data)
+        return filename
+
+    def test_compact_restrict_mode(self):
+        import pyarmor
+        parser = pyarmor._parser()
+        for argv in (['--compact'], ['--compact', '--restrict', '2']):
+            args = parser.parse_args(['obfuscate'] + argv + ['foo.py'])
+            self.assertRaises(RuntimeError, args.func, args)
+
+    def test_encode_payload(self):
+        data = os.urandom(300)
+        hexcode = utils.encode_payload(data)
+        code = utils.encode_payload(data, True)
+        self.assertTrue(code.startswith(config.compact_payload[:20]))
+        self.assertTrue(len(code) * 2 < len(hexcode))
+        self.assertEqual(eval(code), data)
+        for decode in (utils.decode_payload, merge.decode_payload):
+            self.assertEqual(decode(code), data)
+            self.assertEqual(decode(hexcode), data)
+        if buildext is not None:
+            self.assertEqual(buildext.decode_payload(code), data)
+        self.assertEqual(merge.COMPACT_PREFIX,
+                         config.compact_payload.split('%s')[0])
+
+    def test_compact_script(self):
+        data = make_payload((3, 8))
+        script = make_obfuscated_script(data)
+        self.assertFalse(utils.is_compact_payload(script))
+        s = utils.compact_script(script)
+        self.assertEqual(s, make_obfuscated_script(data, True))
+        self.assertTrue(utils.is_compact_payload(s))
+        i, j = utils.find_payload(s)
+        self.assertEqual(utils.decode_payload(s[i:j]), data)
+
+    def test_sppmode_mixin(self):
+        import sppmode
+        data = make_payload((3, 8))
+        hexcode = sppmode.mixin(make_obfuscated_script(data), b'x' * 32)
+        code = sppmode.mixin(make_obfuscated_script(data, True), b'x' * 32)
+        self.assertFalse(utils.is_compact_payload(hexcode))
+        self.assertTrue(utils.is_compact_payload(code))
+        self.assertEqual(utils.compact_script(hexcode), code)
+
+    def check_merged_script(self, filename, compact, vers):
+        with open(filename) as f:
+            s = f.read()
+        self.assertEqual(utils.is_compact_payload(s), compact)
+        n, flag, code, infos = merge.parse_script(filename)
+        self.assertEqual(flag, 2)
+        self.assertEqual([x[-1] for x in infos], vers)
+        return s
+
+    def test_merge_scripts(self):
+        payloads = make_payload((3, 8)), make_payload((2, 7))
+        results = []
+        for compact in (False, True):
+            scripts = [self.write_script(
+                'dist%d%d/foo.py' % (i, compact),
+                make_obfuscated_script(x, compact))
+                for i, x in enumerate(payloads)]
+            output = os.path.join(self.workpath, 'merged%d' % compact)
+            merge.merge_scripts(scripts, output)
+            s = self.check_merged_script(output, compact, [(2, 7), (3, 8)])
+            results.append(s)
+        self.assertEqual(utils.compact_script(results[0]), results[1])
+
+    def test_merge_trees(self):
+        paths = [os.path.join(self.workpath, x) for x in ('py38', 'py27')]
+        tasks = []
+        for i in range(4):
+            name = os.path.join('pkg', 'foo%d.py' % i)
+            scripts = [self.write_script(
+                os.path.join(path, name),
+                make_obfuscated_script(make_payload(ver), True))
+                for path, ver in zip(paths, ((3, 8), (2, 7)))]
+            tasks.append((scripts, os.path.join(self.workpath, 'merged',
+                                                name), False))
+        merge.merge_many(tasks, jobs=2)
+        for scripts, output, check in tasks:
+            self.check_merged_script(output, True, [(2, 7), (3, 8)])
+
+    def test_makedirs_made_by_others(self):
+        path = os.path.join(self.workpath, 'merged', 'pkg')
+        os.makedirs(path)
+        exists = os.path.exists
+        # Check it before the other worker makes the path
+        os.path.exists = lambda x: False
+        try:
+            merge.makedirs(path, exist_ok=True)
+            self.assertRaises(OSError, merge.makedirs, path)
+        finally:
+            os.path.exists = exists
+
+
+try:
+    from helper import buildext
+except ImportError:
+    buildext = None
+
+# The fake runtime module to record the arguments of __pyarmor__
+fake_pytransform = '''
+import sys
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+def __pyarmor__(name, filename, code, mode):
+    builtins.__records__.append((name, bytes(code), mode))
+
+def pyarmor_runtime():
+    builtins.__pyarmor__ = __pyarmor__
+'''
+
+fake_script = '''from pytransform import pyarmor_runtime
+pyarmor_runtime()
+__pyarmor__(__name__, __file__, b'%s', 2)
+'''
+
+check_script = '''
+import json
+import sys
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+builtins.__records__ = []
+for name in sys.argv[1:]:
+    __import__(name)
+print(json.dumps([(x[0], x[1].decode('latin-1'), x[2])
+                  for x in builtins.__records__]))
+'''
+
+
+@unittest.skipIf(buildext is None, 'requires distutils')
+class BuildextTestCases(BaseTestCase):
+
+    def setUp(self):
+        super(BuildextTestCases, self).setUp()
+        self.cwd = os.getcwd()
+        os.chdir(self.workpath)
+        os.makedirs('dist')
+        with open(os.path.join('dist', 'pytransform.py'), 'w') as f:
+            f.write(fake_pytransform)
+        self.payloads = {}
+        self.messages = []
+        handler = logging.Handler()
+        handler.emit = lambda r: self.messages.append(r.getMessage())
+        buildext.logger.addHandler(handler)
+        buildext.logger.setLevel(logging.INFO)
+        buildext.logger.propagate = False
+        self.handler = handler
+
+    def tearDown(self):
+        buildext.logger.removeHandler(self.handler)
+        buildext.logger.setLevel(logging.NOTSET)
+        buildext.logger.propagate = True
+        os.chdir(self.cwd)
+        super(BuildextTestCases, self).tearDown()
+
+    def make_script(self, name, size=64):
+        payload = os.urandom(size)
+        filename = os.path.join('dist', *name.split('.')) + '.py'
+        with open(filename, 'w') as f:
+            f.write(fake_script % ''.join(['\\x%02x' % x for x in
+                                           bytearray(payload)]))
+        self.payloads[name] = payload
+        return filename
+
+    def make_sources(self, names, nocache=False):
+        return [buildext.make_c_source(self.make_script(x), nocache=nocache)
+                for x in names]
+
+    def import_modules(self, names, path='dist'):
+        output = subprocess.check_output(
+            [sys.executable, '-c', check_script] + names, cwd=path)
+        return [(x[0], x[1].encode('latin-1'), x[2])
+                for x in json.loads(output.decode())]
+
+    def check_modules(self, names, imports=None):
+        records = self.import_modules(imports or names)
+        self.assertEqual(records, [(x, self.payloads[x], 2) for x in names])
+
+    def read_file(self, filename):
+        with open(filename) as f:
+            return f.read()
+
+    def test_make_extensions(self):
+        names = ['foo', 'foo2', 'foo3']
+        sources = self.make_sources(names)
+        outputs = buildext.make_extensions(sources, jobs=2)
+        self.assertEqual(len(outputs), 3)
+        self.assertTrue('Build with 2 processes' in self.messages)
+        for x in names:
+            os.remove(os.path.join('dist', x + '.py'))
+        self.check_modules(names)
+
+    def test_object_cache(self):
+        sources = self.make_sources(['foo', 'foo2'])
+        csources = [self.read_file(x) for x in sources]
+        buildext.make_extensions(sources, jobs=1)
+        self.assertEqual(len([x for x in self.messages
+                              if x.startswith('Compile')]), 2)
+
+        # The unchanged script gets the same .c file and object
+        del self.messages[:]
+        sources = [buildext.make_c_source(os.path.join('dist', x))
+                   for x in ('foo.py', 'foo2.py')]
+        self.assertEqual([self.read_file(x) for x in sources], csources)
+        buildext.make_extensions(sources, jobs=1)
+        self.assertEqual(len([x for x in self.messages
+                              if x.startswith('Use cached object')]), 2)
+        os.remove(os.path.join('dist', 'foo.py'))
+        self.check_modules(['foo'])
+
+        del self.messages[:]
+        buildext.make_extensions(sources, jobs=1, nocache=True)
+        self.assertEqual(len([x for x in self.messages
+                              if x.startswith('Compile')]), 2)
+
+    def test_compact_script(self):
+        filename = self.make_script('foo')
+        with open(filename) as f:
+            script = utils.compact_script(f.read())
+        with open(filename, 'w') as f:
+            f.write(script)
+        source = buildext.make_c_source(filename)
+        buildext.make_extensions([source], jobs=1)
+        os.remove(filename)
+        self.check_modules(['foo'])
+
+    def test_customize_one_byte(self):
+        # Both the customized bytecodes are the first one
+        filename = self.make_script('foo', size=1)
+        source = buildext.make_c_source(filename, nocache=True)
+        buildext.make_extensions([source], jobs=1, nocache=True)
+        os.remove(filename)
+        self.check_modules(['foo'])
+
+    def test_customized_bytecodes(self):
+        source = self.make_sources(['foo'])[0]
+        data = self.read_file(source)
+
+        # The customization is not derived from the script
+        os.environ['PYARMOR_CACHE'] = os.path.join(self.workpath, 'cache2')
+        filename = os.path.join('dist', 'foo.py')
+        self.assertNotEqual(self.read_file(buildext.make_c_source(filename)),
+                            data)
+
+        # No cache, it's different each time
+        data = self.read_file(buildext.make_c_source(filename, nocache=True))
+        self.assertNotEqual(self.read_file(buildext.make_c_source(
+            filename, nocache=True)), data)
+        buildext.make_extensions([source], jobs=1, nocache=True)
+        os.remove(filename)
+        self.check_modules(['foo'])
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'requires Python 3')
+    def test_make_library(self):
+        names = ['foo', 'foo2']
+        sources = self.make_sources(names)
+        libsrc, output = buildext.make_library(sources, '_mylib', jobs=2)
+        self.assertTrue(os.path.exists(output))
+        for x in names:
+            os.remove(os.path.join('dist', x + '.py'))
+        self.check_modules(names, imports=['_mylib'] + names)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'requires Python 3')
+    def test_make_library_in_package(self):
+        os.makedirs(os.path.join('dist', 'pkg'))
+        with open(os.path.join('dist', 'pkg', '__init__.py'), 'w') as f:
+            f.write('')
+        names = ['pkg.foo', 'pkg.foo2']
+        sources = self.make_sources(names)
+        buildext.make_library(sources, '_mylib', jobs=1)
+        for x in names:
+            os.remove(os.path.join('dist', *x.split('.')) + '.py')
+        self.check_modules(names, imports=['pkg._mylib'] + names)
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'requires Python 3')
+    def test_make_library_in_different_paths(self):
+        os.makedirs(os.path.join('dist', 'pkg'))
+        sources = self.make_sources(['foo', 'pkg.foo2'])
+        self.assertRaises(RuntimeError, buildext.make_library,
+                          sources, '_mylib')
+        self.assertRaises(RuntimeError, buildext.make_library,
+                          sources[:1], 'foo')
+
+
+def serve_main(argv):
+    cmd = argv[0]
+    if cmd == 'obfuscate':
+        print('Obfuscate %s' % ' '.join(argv[1:]))
+        logging.info('Work path is %s', os.getcwd())
+    elif cmd == 'build':
+        sys.exit(3)
+    elif cmd == 'licenses':
+        raise RuntimeError('Invalid license "%s"', argv[1])
+    elif cmd == 'runtime':
+        time.sleep(float(argv[1]))
+
+
+def find_zombies(ppid):
+    zombies = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', name, 'stat')) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError):
+            continue
+        if fields[0] == 'Z' and int(fields[1]) == ppid:
+            zombies.append(int(name))
+    return zombies
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'requires fork')
+class ObfuscatedCacheTestCases(BaseTestCase):
+
+    def setUp(self):
+        super(ObfuscatedCacheTestCases, self).setUp()
+        self.cache = utils.get_obfuscated_cache()
+        self.cache.maxsize = 100
+        self.listed = []
+        items = self.cache.items
+
+        def list_items():
+            self.listed.append(True)
+            return items()
+        self.cache.items = list_items
+
+    def test_usage(self):
+        self.assertEqual(self.cache.usage(), None)
+        self.cache.put('a' * 64, b'x' * 30)
+        self.cache.put('b' * 64, b'x' * 20)
+        self.assertEqual(self.cache.usage(), 50)
+
+    def test_autoprune_no_usage(self):
+        self.cache.put('a' * 64, b'x' * 30)
+        os.remove(self.cache._usage_file())
+        self.assertEqual(self.cache.autoprune(), (0, 0))
+        self.assertEqual(len(self.listed), 1)
+        self.assertEqual(self.cache.usage(), 30)
+
+    def test_autoprune_not_full(self):
+        for i in range(3):
+            self.cache.put(str(i) * 64, b'x' * 30)
+            self.assertEqual(self.cache.autoprune(), (0, 0))
+        self.assertEqual(self.listed, [])
+
+    def test_autoprune_full(self):
+        for i in range(4):
+            self.cache.put(str(i) * 64, b'x' * 30)
+            os.utime(self.cache._filename(str(i) * 64), (i, i))
+        self.assertEqual(self.cache.autoprune(), (1, 30))
+        self.assertEqual(len(self.listed), 1)
+        self.assertEqual(self.cache.usage(), 90)
+        self.assertEqual(self.cache.get('0' * 64), None)
+        self.assertEqual(self.cache.get('1' * 64), b'x' * 30)
+
+
+class ServerTestCases(BaseTestCase):
+
+    def setUp(self):
+        super(ServerTestCases, self).setUp()
+        self.path = os.path.join(self.workpath, 'pyarmor.sock')
+        self.pid = None
+
+    def tearDown(self):
+        if self.pid is not None:
+            self.stop_server()
+        super(ServerTestCases, self).tearDown()
+
+    def stop_server(self):
+        # KeyboardInterrupt is ignored if it's raised in the fork handlers,
+        # so send SIGINT again until the server exits
+        for i in range(50):
+            os.kill(self.pid, signal.SIGINT)
+            time.sleep(0.1)
+            if os.waitpid(self.pid, os.WNOHANG)[0]:
+                break
+        else:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        self.pid = None
+
+    def start_server(self, jobs=2):
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                server.serve(serve_main, path=self.path, jobs=jobs)
+            finally:
+                os._exit(0)
+        # Wait until the server is listening, the socket file may be stale
+        for i in range(100):
+            sock = server.socket.socket(server.socket.AF_UNIX)
+            try:
+                sock.connect(self.path)
+                break
+            except server.socket.error:
+                time.sleep(0.1)
+            finally:
+                sock.close()
+        else:
+            self.fail('The server is not started')
+
+    def request(self, *argv):
+        return server.request(argv, cwd=self.workpath, path=self.path)
+
+    def test_request(self):
+        self.start_server()
+        returncode, output = self.request('obfuscate', 'foo.py')
+        self.assertEqual(returncode, 0)
+        self.assertTrue(output.find('Obfuscate foo.py') > -1)
+        self.assertTrue(output.find('INFO     Work path is %s' %
+                                    os.path.realpath(self.workpath)) > -1)
+
+    def test_request_failed(self):
+        self.start_server()
+        self.assertEqual(self.request('build'), (3, ''))
+        self.assertEqual(self.request('licenses', 'foo'),
+                         (1, 'ERROR    Invalid license "foo"\n'))
+        returncode, output = self.request('register', 'foo')
+        self.assertEqual(returncode, 1)
+        self.assertTrue(output.find('Only these commands are served') > 0)
+
+    def test_queue(self):
+        self.start_server(jobs=1)
+        results = []
+
+        def target():
+            results.append(self.request('runtime', '0.5'))
+
+        t0 = time.time()
+        threads = [threading.Thread(target=target) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [(0, '')] * 3)
+        self.assertTrue(time.time() - t0 >= 1.5)
+
+    def test_socket_mode(self):
+        self.start_server()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/stat'), 'requires /proc')
+    def test_reap_children_when_idle(self):
+        self.start_server()
+        for i in range(3):
+            self.assertEqual(self.request('runtime', '0'), (0, ''))
+        time.sleep(2.5)
+        self.assertEqual(find_zombies(self.pid), [])
+
+    def test_server_is_running(self):
+        self.start_server()
+        self.assertRaises(RuntimeError, server.serve, serve_main,
+                          path=self.path)
+
+    def test_stop_server(self):
+        self.start_server()
+        self.stop_server()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_stale_socket(self):
+        sock = server.socket.socket(server.socket.AF_UNIX)
+        sock.bind(self.path)
+        sock.close()
+        self.start_server()
+        self.assertEqual(self.request('runtime', '0'), (0, ''))
+
+
+# Enable the stats and import the modules in a new process, print the stats
+stats_script = '''
+import json
+import sys
+sys.path.insert(0, %r)
+
+from importlib.abc import MetaPathFinder
+from importlib.machinery import SourceFileLoader
+from importlib.util import spec_from_loader
+
+calls = []
+
+
+class CountFinder(MetaPathFinder):
+
+    def find_spec(self, fullname, path=None, target=None):
+        calls.append(fullname)
+
+
+class MarkLoader(SourceFileLoader):
+
+    def get_code(self, fullname):
+        return compile('__pyarmor__ = 1', self.path, 'exec')
+
+    def exec_module(self, module):
+        module.marked = True
+        super(MarkLoader, self).exec_module(module)
+
+
+class CountLoader(SourceFileLoader):
+
+    def get_code(self, fullname):
+        calls.append('get_code')
+        return super(CountLoader, self).get_code(fullname)
+
+
+class MarkFinder(MetaPathFinder):
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname == 'marked':
+            return spec_from_loader(fullname, MarkLoader(fullname, %r))
+        if fullname == 'counted':
+            return spec_from_loader(fullname, CountLoader(fullname, %r))
+
+
+finder = CountFinder()
+sys.meta_path.append(finder)
+
+import pytransform
+stats = pytransform.enable_stats()
+
+sys.meta_path.insert(0, MarkFinder())
+
+import pkg
+try:
+    import missing_module
+except ImportError:
+    pass
+import marked
+import counted
+
+# The wrapped finder could be removed as before
+sys.meta_path.remove(finder)
+assert finder not in sys.meta_path
+json.dump(dict(modules=stats.modules, calls=calls,
+               marked=getattr(marked, 'marked', False)), sys.stdout)
+'''
+
+
+@unittest.skipIf(sys.version_info[:2] < (3, 4), 'requires Python 3.4+')
+class RuntimeStatsTestCases(BaseTestCase):
+
+    def run_script(self):
+        pkgpath = os.path.join(self.workpath, 'pkg')
+        os.makedirs(pkgpath)
+        with open(os.path.join(pkgpath, '__init__.py'), 'w') as f:
+            f.write('from . import foo\n')
+        with open(os.path.join(pkgpath, 'foo.py'), 'w') as f:
+            f.write('import time\ntime.sleep(0.1)\n')
+        filename = os.path.join(self.workpath, 'marked.py')
+        with open(filename, 'w') as f:
+            f.write('__pyarmor__ = 1\n')
+        counted = os.path.join(self.workpath, 'counted.py')
+        with open(counted, 'w') as f:
+            f.write('x = 1\n')
+        script = stats_script % (os.path.normpath(srcpath), filename,
+                                 counted)
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         cwd=self.workpath)
+        result = json.loads(output.decode())
+        result['modules'] = dict((x['name'], x) for x in result['modules'])
+        return result
+
+    def test_import_time(self):
+        modules = self.run_script()['modules']
+        pkg, foo = modules['pkg'], modules['pkg.foo']
+        self.assertTrue(foo['total'] >= 0.1)
+        self.assertTrue(pkg['total'] >= foo['total'])
+        self.assertTrue(pkg['self'] < 0.1)
+        self.assertTrue(foo['load'] > 0)
+        self.assertFalse(foo['obfuscated'])
+        self.assertEqual(foo['filename'],
+                         os.path.join(self.workpath, 'pkg', 'foo.py'))
+
+    def test_loader_exec_module(self):
+        result = self.run_script()
+        self.assertTrue(result['marked'])
+        self.assertTrue(result['modules']['marked']['obfuscated'])
+
+    def test_missing_module(self):
+        result = self.run_script()
+        self.assertEqual(result['calls'].count('missing_module'), 1)
+        self.assertTrue('missing_module' not in result['modules'])
+
+    def test_get_code_once(self):
+        result = self.run_script()
+        self.assertEqual(result['calls'].count('get_code'), 1)
+        self.assertFalse(result['modules']['counted']['obfuscated'])
+
+
+@unittest.skipIf(sys.version_info[:2] < (3, 4), 'requires Python 3.4+')
+class BundleTestCases(BaseTestCase):
+
+    def write_file(self, filename, source):
+        filename = os.path.join(self.workpath, filename)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(source)
+
+    def test_package_output(self):
+        output = os.path.join(self.workpath, 'mypkg')
+        self.write_file('mypkg/__init__.py', '\n'.join([
+            'import os, sys',
+            'sys.path.insert(0, %r)' % os.path.normpath(srcpath),
+            'from pytransform import load_bundle',
+            'load_bundle(os.path.join(os.path.dirname(__file__), '
+            '"pytransform.bundle"))',
+            'from . import sub',
+            'from .sub2 import foo']))
+        self.write_file('mypkg/pytransform.py', '')
+        self.write_file('mypkg/sub.py', 'name = __name__')
+        self.write_file('mypkg/sub2/__init__.py', 'from . import foo')
+        self.write_file('mypkg/sub2/foo.py', 'name = __name__')
+        names = ['sub.py', 'sub2/__init__.py', 'sub2/foo.py']
+        filename, n = utils.make_bundle(output, names)
+        self.assertEqual(n, 3)
+        importer = utils.pytransform.BundleImporter(filename)
+        self.assertEqual(sorted(importer.modules),
+                         ['mypkg.sub', 'mypkg.sub2', 'mypkg.sub2.foo'])
+        for x in names:
+            self.assertFalse(os.path.exists(os.path.join(output, x)))
+
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import mypkg; print(mypkg.sub.name, mypkg.foo.name)'],
+            cwd=self.workpath)
+        self.assertEqual(output.decode().split(),
+                         ['mypkg.sub', 'mypkg.sub2.foo'])
+
+    def test_invalid_package_name(self):
+        output = os.path.join(self.workpath, 'my-pkg')
+        self.write_file('my-pkg/__init__.py', '')
+        self.write_file('my-pkg/sub.py', '')
+        self.assertRaises(RuntimeError, utils.make_bundle, output,
+                          ['sub.py'])
+
+
+class RuleModesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        import pyarmor
+        self.pyarmor = pyarmor
+        # The available advanced values depend on Python version
+        self.patched = pyarmor._check_advanced_value
+        pyarmor._check_advanced_value = lambda n: None
+
+    def tearDown(self):
+        self.pyarmor._check_advanced_value = self.patched
+
+    def check(self, rule, restrict=1, advanced=0):
+        rule = dict(rule, pattern='foo.py')
+        self.pyarmor._check_rule_modes(rule, restrict, advanced)
+
+    def test_same_modes(self):
+        self.check({})
+        self.check(dict(restrict_mode=2, advanced_mode=0))
+        self.check(dict(advanced_mode=1), advanced=1)
+        self.check(dict(advanced_mode=5), advanced=2)
+
+    def test_restrict_mode(self):
+        self.assertRaises(RuntimeError, self.check, dict(restrict_mode=0))
+        self.assertRaises(RuntimeError, self.check, dict(restrict_mode=1),
+                          restrict=0)
+
+    def test_advanced_mode(self):
+        for n, advanced in ((1, 0), (0, 1), (2, 0), (1, 2), (3, 4)):
+            self.assertRaises(RuntimeError, self.check,
+                              dict(advanced_mode=n), advanced=advanced)
+
+
+class FailedPopen(object):
+
+    returncode = 1
+
+    def communicate(self):
+        return b'Benchmark bootstrap failed', None
+
+    def wait(self):
+        return self.returncode
+
+
+class BenchmarkTestCases(BaseTestCase):
+
+    def setUp(self):
+        super(BenchmarkTestCases, self).setUp()
+        import benchmark
+        import pyarmor
+        self.benchmark, self.pyarmor = benchmark, pyarmor
+        self.popen = pyarmor.subprocess.Popen
+        self.cwd = os.getcwd()
+        sys.path.insert(0, self.workpath)
+        os.chdir(self.workpath)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.path.remove(self.workpath)
+        sys.modules.pop('bfoo', None)
+        self.pyarmor.subprocess.Popen = self.popen
+        super(BenchmarkTestCases, self).tearDown()
+
+    def fake_popen(self, cmd, *args, **kwargs):
+        if 'benchmark.py' in cmd:
+            return FailedPopen()
+        return self.popen(cmd, *args, **kwargs)
+
+    def test_all_modes_failed(self):
+        self.pyarmor.subprocess.Popen = self.fake_popen
+        output = os.path.join(self.workpath, 'result.json')
+        args = self.pyarmor._parser().parse_args(
+            ['benchmark', '-m', '0,1', '-O', output])
+        self.assertRaises(RuntimeError, args.func, args)
+        self.assertFalse(os.path.exists(output))
+
+    def test_re_import(self):
+        scenarios = [x for x in self.benchmark.SCENARIOS
+                     if x[1] == 're_import']
+        self.assertEqual(len(scenarios), 1)
+        self.benchmark.make_test_script('bfoo.py')
+        result = self.benchmark.run_scenario(scenarios[0], 'bfoo', repeat=3)
+        self.assertEqual(result['wall']['n'], 3)
+        self.assertTrue('bfoo' in sys.modules)
+
+
+class PolicyTestCases(BaseTestCase):
+
+    def make_script(self, source):
+        filename = os.path.join(self.workpath, 'foo.py')
+        with open(filename, 'w') as f:
+            f.write(source)
+        return filename
+
+    def test_small_source_path(self):
+        from policy import make_policy
+        script = self.make_script(
+            'def a():\n    pass\n\n'
+            'def b():\n    pass\n\n'
+            'def c():\n    pass\n\n'
+            'for i in range(3):\n    a()\nb()\n')
+        policy = make_policy(script)
+        self.assertEqual(policy['functions'], {'foo.py': ['a']})
+
+    def test_zero_budget(self):
+        from policy import make_policy
+        script = self.make_script('def a():\n    pass\n\na()\n')
+        policy = make_policy(script, budget=0)
+        self.assertEqual(policy['functions'], {})
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.WARNING,
+        format='%(levelname)-8s %(message)s',
+    )
+    unittest.main()